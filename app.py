@@ -1,44 +1,2899 @@
-from flask import Flask, request, jsonify, render_template_string, send_file
+from flask import Flask, Response, request, jsonify, render_template_string, send_file, g
 import logging
-from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from datetime import date, datetime
 import subprocess
 import time
 import os
+import threading
+import queue
+import json
+import base64
+import math
+import uuid
+import zlib
+import sqlite3
+import gzip
+import io
+import re
+import tarfile
+import tempfile
+import atexit
+import itertools
+import mmap
+import fcntl
+import struct
+import random
+import bisect
+import functools
+from array import array
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout, wait, FIRST_COMPLETED
+from collections import deque
+
+# numpy is optional; telemetry ring buffers fall back to plain array.array without it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Optional compact encodings for edge uploads and command responses
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+app = Flask(__name__)
+
+# Logging: request threads only queue records; a listener thread formats
+# and writes them. LOG_FORMAT is 'json' (one object per line, extra= fields
+# included) or 'text'. When the queue is full, records are dropped and counted.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+# High-frequency request logs are tagged extra={'endpoint': ...}: the fraction
+# kept per endpoint (endpoint=rate,...), then at most LOG_RATE_LIMIT lines per
+# second per endpoint (0: unlimited)
+LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', 'edge_data=0.01,edge_commands=0.01')
+LOG_RATE_LIMIT = float(os.environ.get('LOG_RATE_LIMIT', '10'))
+
+_LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and any extra= fields"""
+
+    def format(self, record):
+        out = {
+            'time': datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        out.update((k, v) for k, v in vars(record).items() if k not in _LOG_RECORD_FIELDS)
+        if record.exc_text:
+            out['exception'] = record.exc_text
+        return json.dumps(out, default=str)
+
+
+class LogSampler(logging.Filter):
+    """
+    Sampling and a per-endpoint token bucket for records logged with
+    extra={'endpoint': ...}; other records pass. The next record let through
+    for an endpoint carries the number suppressed since the last one.
+    """
+
+    def __init__(self, rates, per_second):
+        super().__init__()
+        self.rates = rates
+        self.per_second = per_second
+        self._buckets = {}  # endpoint -> [tokens, refilled at, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        endpoint = getattr(record, 'endpoint', None)
+        if endpoint is None:
+            return True
+        with self._lock:
+            bucket = self._buckets.get(endpoint)
+            if bucket is None:
+                bucket = self._buckets[endpoint] = [self.per_second, time.monotonic(), 0]
+            if random.random() >= self.rates.get(endpoint, 1.0):
+                bucket[2] += 1
+                return False
+            if self.per_second > 0:
+                now = time.monotonic()
+                bucket[0] = min(self.per_second, bucket[0] + (now - bucket[1]) * self.per_second)
+                bucket[1] = now
+                if bucket[0] < 1:
+                    bucket[2] += 1
+                    return False
+                bucket[0] -= 1
+            if bucket[2]:
+                record.suppressed, bucket[2] = bucket[2], 0
+        return True
+
+
+class AsyncLogHandler(QueueHandler):
+    """Queues records unformatted (the listener formats them) and drops them when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # a traceback can only be rendered while it exists; everything else stays lazy
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _parse_sample_rates(spec):
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        endpoint, _, rate = item.partition('=')
+        rates[endpoint.strip()] = float(rate)
+    return rates
+
+
+def _configure_logging():
+    """Root logger -> AsyncLogHandler -> bounded queue -> QueueListener thread -> stderr"""
+    stream = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = AsyncLogHandler(log_queue)
+    handler.addFilter(LogSampler(_parse_sample_rates(LOG_SAMPLE_RATES), LOG_RATE_LIMIT))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    listener = QueueListener(log_queue, stream, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def _restart_log_listener():
+    # a forked child has the queue but not the listener thread
+    global log_listener
+    log_listener = _configure_logging()
+
+
+log_listener = _configure_logging()
+os.register_at_fork(after_in_child=_restart_log_listener)
+# registered first so it runs last: records logged by other exit handlers are still written
+atexit.register(lambda: log_listener.stop())
+logger = logging.getLogger(__name__)
+
+# Metrics (GET /metrics, Prometheus text format). Each worker counts in its
+# own memory; with METRICS_DIR set (gunicorn.conf.py does) it also writes its
+# counters there every METRICS_FLUSH_INTERVAL seconds, so whichever worker is
+# scraped reports the sum over all workers, including ones that have exited.
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# name -> (type, help), in exposition order
+METRIC_FAMILIES = {
+    'http_requests_total': ('counter', 'HTTP requests by route, method and status'),
+    'http_request_duration_seconds': ('histogram', 'Time to build the response by route (streams: until headers)'),
+    'edge_ingest_records_total': ('counter', 'Telemetry records ingested'),
+    'edge_devices': ('gauge', 'Registered edge devices'),
+    'edge_messages_retained': ('gauge', 'Telemetry samples kept in device data histories'),
+    'command_queue_depth': ('gauge', 'Commands ready for delivery, per device with any'),
+    'command_queue_depth_total': ('gauge', 'Commands ready for delivery over all devices'),
+    'k8s_api_request_duration_seconds': ('histogram', 'Kubernetes API call latency by method (including queueing)'),
+    'k8s_api_errors_total': ('counter', 'Failed or refused Kubernetes API calls by method and status'),
+    'k8s_cache_age_seconds': ('gauge', 'Seconds since the informer cache last heard from the API server'),
+    'k8s_cache_objects': ('gauge', 'Objects in the informer cache'),
+    'stream_subscribers': ('gauge', 'Open dashboard push streams'),
+    'longpoll_parked': ('gauge', 'Parked command long-polls'),
+    'wal_pending_records': ('gauge', 'Changes waiting for the write-ahead log writer'),
+}
+
+
+def _metric_labels(**labels):
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for k, v in labels.items())
+
+
+class Metrics:
+    """
+    Process-local counters and latency histograms keyed by (name, label
+    string); updates are a dict add under one lock. Gauges are not stored:
+    they are read from the live state when /metrics is rendered.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        # also called in a forked child, which starts counting from zero
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}  # key -> [count per bucket..., count above the last bucket, sum]
+        self._thread = None
+
+    def inc(self, name, labels='', value=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            h[bucket] += 1
+            h[-1] += seconds
+
+    def dump(self):
+        with self._lock:
+            return {'counters': [[n, l, v] for (n, l), v in self._counters.items()],
+                    'histograms': [[n, l, list(h)] for (n, l), h in self._histograms.items()]}
+
+    def start(self):
+        if not METRICS_DIR or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                os.makedirs(METRICS_DIR, exist_ok=True)
+                self._thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Writing metrics failed: {e}")
+
+    def flush(self):
+        path = os.path.join(METRICS_DIR, f"worker-{os.getpid()}.json")
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.dump(), f)
+        os.replace(path + '.tmp', path)
+
+    def collect(self):
+        """(counters, histograms) of this process plus the last flush of every other worker"""
+        counters, histograms = {}, {}
+        dumps = [self.dump()]
+        if METRICS_DIR and os.path.isdir(METRICS_DIR):
+            own = f"worker-{os.getpid()}.json"
+            for name in os.listdir(METRICS_DIR):
+                if name.startswith('worker-') and name.endswith('.json') and name != own:
+                    try:
+                        with open(os.path.join(METRICS_DIR, name)) as f:
+                            dumps.append(json.load(f))
+                    except (OSError, ValueError):
+                        continue
+        for dump in dumps:
+            for n, l, v in dump['counters']:
+                counters[(n, l)] = counters.get((n, l), 0) + v
+            for n, l, h in dump['histograms']:
+                total = histograms.get((n, l))
+                histograms[(n, l)] = h if total is None else [a + b for a, b in zip(total, h)]
+        return counters, histograms
+
+
+metrics = Metrics()
+os.register_at_fork(after_in_child=metrics._reset)
+
+# Kubernetes client settings
+K8S_POOL_MAXSIZE = int(os.environ.get('K8S_POOL_MAXSIZE', '8'))
+K8S_CONNECT_TIMEOUT = float(os.environ.get('K8S_CONNECT_TIMEOUT', '3'))
+K8S_READ_TIMEOUT = float(os.environ.get('K8S_READ_TIMEOUT', '15'))
+# how long to wait before retrying after no Kubernetes config could be loaded
+K8S_CONFIG_RETRY = float(os.environ.get('K8S_CONFIG_RETRY', '30'))
+
+_k8s_api = None
+_k8s_failed_at = None
+_k8s_lock = threading.Lock()
+
+
+def _create_k8s_client():
+    # the kubernetes package is slow to import, so only pay for it on first use
+    from kubernetes import client, config
+
+    # Try to load kubeconfig (first tries in-cluster, then fallback path)
+    configuration = client.Configuration()
+    try:
+        config.load_incluster_config(client_configuration=configuration)
+        logger.info("Loaded in-cluster Kubernetes config")
+    except Exception:
+        kubeconf = os.environ.get('KUBECONFIG') or os.path.expanduser("~/.kube/config")
+        try:
+            config.load_kube_config(kubeconf, client_configuration=configuration)
+            logger.info(f"Loaded kubeconfig from {kubeconf}")
+        except Exception as e:
+            logger.warning("Could not load any Kubernetes config: " + str(e))
+            return None
+
+    configuration.connection_pool_maxsize = K8S_POOL_MAXSIZE
+    try:
+        return client.CoreV1Api(client.ApiClient(configuration))
+    except Exception as e:
+        logger.warning("Failed to create CoreV1Api client: " + str(e))
+        return None
+
+
+def get_k8s():
+    """
+    CoreV1Api for this process, created on first use so importing the app
+    (and answering /health or edge requests) never waits on Kubernetes, and
+    every forked worker gets its own urllib3 connection pool.
+    Returns None if no Kubernetes config can be loaded.
+    """
+    global _k8s_api, _k8s_failed_at
+    if _k8s_api is not None:
+        return _k8s_api
+    if _k8s_failed_at is not None and time.monotonic() - _k8s_failed_at < K8S_CONFIG_RETRY:
+        return None
+    with _k8s_lock:
+        if _k8s_api is None:
+            _k8s_api = _create_k8s_client()
+            _k8s_failed_at = time.monotonic() if _k8s_api is None else None
+    return _k8s_api
+
+
+def _api_status(e):
+    """HTTP status of a kubernetes ApiException (None for any other error)"""
+    return getattr(e, 'status', None) if type(e).__name__ == 'ApiException' else None
+
+# Request-path Kubernetes calls run on a small dedicated pool so a slow API
+# server can only ever hold K8S_MAX_PENDING request threads, never the
+# threads edge devices need for ingest and command polls
+K8S_MAX_CONCURRENCY = int(os.environ.get('K8S_MAX_CONCURRENCY', '8'))
+# calls running or queued on the pool; beyond this requests get 503 right away
+K8S_MAX_PENDING = int(os.environ.get('K8S_MAX_PENDING', '16'))
+# consecutive failures that open the circuit, and how long it stays open (seconds)
+K8S_BREAKER_FAILURES = int(os.environ.get('K8S_BREAKER_FAILURES', '5'))
+K8S_BREAKER_RESET = float(os.environ.get('K8S_BREAKER_RESET', '30'))
+
+
+class K8sUnavailable(Exception):
+    """Kubernetes call refused or abandoned; carries the HTTP status to answer with"""
+
+    def __init__(self, message, status=503, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+@app.errorhandler(K8sUnavailable)
+def _k8s_unavailable(e):
+    resp = jsonify({'error': str(e)})
+    if e.retry_after:
+        resp.headers['Retry-After'] = str(max(1, int(e.retry_after + 0.5)))
+    return resp, e.status
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures; while open every call is
+    refused until `reset_after` seconds have passed, then a single trial call
+    decides whether it closes again.
+    """
+
+    def __init__(self, threshold, reset_after):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self.reset_after:
+                return False
+            self._trial = True
+            return True
+
+    def retry_after(self):
+        with self._lock:
+            if self._opened_at is None:
+                return None
+            return max(0.0, self.reset_after - (time.monotonic() - self._opened_at))
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.threshold:
+                if self._opened_at is None or self._trial:
+                    logger.warning(f"Kubernetes API circuit opened after {self._failures} failures")
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if self._trial or time.monotonic() - self._opened_at >= self.reset_after:
+                return 'half-open'
+            return 'open'
+
+
+class K8sGateway:
+    """Bounded, time-limited, circuit-broken access to CoreV1Api for request handlers"""
+
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._reset()
+
+    def _reset(self):
+        # also called in a forked child: the parent's pool threads do not exist there
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+        self.breaker = CircuitBreaker(K8S_BREAKER_FAILURES, K8S_BREAKER_RESET)
+
+    def _finished(self, method, started, future):
+        with self._lock:
+            self._pending -= 1
+        if future.cancelled():
+            return
+        metrics.observe('k8s_api_request_duration_seconds', _metric_labels(method=method), time.perf_counter() - started)
+        e = future.exception()
+        status = _api_status(e) if e is not None else None
+        if e is not None:
+            metrics.inc('k8s_api_errors_total', _metric_labels(method=method, status=status or 'error'))
+        # 4xx answers mean the API server is healthy
+        if e is not None and (status is None or status >= 500 or status == 429):
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+
+    def submit(self, method, *args, **kwargs):
+        """
+        Start getattr(CoreV1Api, method)(*args, **kwargs) on the pool and return
+        its Future. Raises K8sUnavailable when there is no client, the pool is
+        full or the circuit is open.
+        """
+        api = get_k8s()
+        if api is None:
+            raise K8sUnavailable('Kubernetes client not available', 500)
+        kwargs.setdefault('_request_timeout', (K8S_CONNECT_TIMEOUT, K8S_READ_TIMEOUT))
+
+        with self._lock:
+            if self._pending >= self.max_pending:
+                metrics.inc('k8s_api_errors_total', _metric_labels(method=method, status='overloaded'))
+                raise K8sUnavailable('Too many Kubernetes API calls in flight', 503, retry_after=1)
+            self._pending += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='k8s')
+        if not self.breaker.allow():
+            with self._lock:
+                self._pending -= 1
+            metrics.inc('k8s_api_errors_total', _metric_labels(method=method, status='circuit_open'))
+            raise K8sUnavailable('Kubernetes API unavailable (circuit open)', 503, retry_after=self.breaker.retry_after())
+        started = time.perf_counter()
+        try:
+            future = self._executor.submit(getattr(api, method), *args, **kwargs)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        # the slot is held until the call really finishes, not just until the caller stops waiting
+        future.add_done_callback(functools.partial(self._finished, method, started))
+        return future
+
+    def call(self, method, *args, timeout=None, **kwargs):
+        """
+        submit() and wait at most `timeout` seconds (default K8S_READ_TIMEOUT)
+        for the result. Raises K8sUnavailable when the call is refused or
+        times out; API errors are re-raised unchanged.
+        """
+        timeout = timeout or K8S_READ_TIMEOUT
+        kwargs.setdefault('_request_timeout', (K8S_CONNECT_TIMEOUT, timeout))
+        future = self.submit(method, *args, **kwargs)
+        try:
+            return future.result(timeout=timeout + K8S_CONNECT_TIMEOUT)
+        except FutureTimeout:
+            future.cancel()
+            metrics.inc('k8s_api_errors_total', _metric_labels(method=method, status='timeout'))
+            raise K8sUnavailable(f'Kubernetes API call {method} timed out', 504)
+
+    def status(self):
+        with self._lock:
+            pending = self._pending
+        return {'breaker': self.breaker.state(), 'pending': pending, 'max_pending': self.max_pending}
+
+
+k8s_gateway = K8sGateway(K8S_MAX_CONCURRENCY, K8S_MAX_PENDING)
+
+# Live pod log streaming (/api/k8s/pod/logs/stream)
+LOG_STREAM_MAX = int(os.environ.get('LOG_STREAM_MAX', '8'))
+LOG_STREAM_CHUNK = int(os.environ.get('LOG_STREAM_CHUNK', '16384'))
+# chunks buffered between the container readers and the client
+LOG_STREAM_QUEUE_SIZE = int(os.environ.get('LOG_STREAM_QUEUE_SIZE', '64'))
+# a stream with no log output for this long is ended (clients reconnect with since_seconds)
+LOG_STREAM_IDLE_TIMEOUT = float(os.environ.get('LOG_STREAM_IDLE_TIMEOUT', '300'))
+# longer lines are passed on in pieces rather than buffered
+LOG_STREAM_MAX_LINE = 64 * 1024
+
+
+class LogStream:
+    """
+    Relays container log responses opened with _preload_content=False to one
+    client. A reader thread per container splits the bytes into lines and
+    hands them over through a single bounded queue, so a slow client stalls
+    the readers, which stop reading from the API server (TCP backpressure)
+    instead of buffering the log in memory.
+    """
+
+    _open = set()
+    _open_lock = threading.Lock()
+
+    def __init__(self, responses):
+        self.responses = responses  # container name -> urllib3 response
+        self._queue = queue.Queue(maxsize=LOG_STREAM_QUEUE_SIZE)
+        self._stop = threading.Event()
+
+    @classmethod
+    def reserve(cls):
+        """New LogStream slot, or None if at LOG_STREAM_MAX or shutting down"""
+        stream = cls({})
+        with cls._open_lock:
+            if len(cls._open) >= LOG_STREAM_MAX or shutting_down.is_set():
+                return None
+            cls._open.add(stream)
+        return stream
+
+    @classmethod
+    def close_all(cls):
+        with cls._open_lock:
+            streams = list(cls._open)
+        for stream in streams:
+            stream.close()
+
+    def start(self):
+        for container, resp in self.responses.items():
+            threading.Thread(target=self._read, args=(container, resp),
+                             name=f'logs-{container}', daemon=True).start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read(self, container, resp):
+        reason = 'eof'
+        partial = b''
+        try:
+            for chunk in resp.stream(LOG_STREAM_CHUNK, decode_content=True):
+                lines = (partial + chunk).split(b'\n')
+                partial = lines.pop()
+                if len(partial) > LOG_STREAM_MAX_LINE:
+                    lines.append(partial)
+                    partial = b''
+                if lines and not self._put((container, lines, None)):
+                    return
+        except Exception as e:
+            if self._stop.is_set():
+                return
+            reason = f'error: {e}'
+        if partial:
+            self._put((container, [partial], None))
+        self._put((container, None, reason))
+
+    def items(self, heartbeat):
+        """
+        Yields (container, lines, None) for log output, (container, None, reason)
+        when a container's log ends, and None after `heartbeat` idle seconds.
+        """
+        remaining = len(self.responses)
+        while remaining and not self._stop.is_set():
+            try:
+                item = self._queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield None
+                continue
+            if item[1] is None:
+                remaining -= 1
+            yield item
+
+    def close(self):
+        """Stop the readers and drop the API server connections (idempotent)"""
+        self._stop.set()
+        with self._open_lock:
+            self._open.discard(self)
+        for resp in self.responses.values():
+            try:
+                resp.close()
+            except Exception:
+                pass
+
+# Informer settings (seconds)
+INFORMER_WATCH_TIMEOUT = int(os.environ.get('INFORMER_WATCH_TIMEOUT', '300'))
+INFORMER_LIST_TIMEOUT = float(os.environ.get('INFORMER_LIST_TIMEOUT', '60'))
+INFORMER_RETRY_BACKOFF = float(os.environ.get('INFORMER_RETRY_BACKOFF', '5'))
+INFORMER_SYNC_WAIT = float(os.environ.get('INFORMER_SYNC_WAIT', '2'))
+
+
+class Informer:
+    """
+    Keeps a local copy of a Kubernetes resource list in sync using
+    list-then-watch, so request handlers never have to call the API server.
+    A 410 Gone from the watch (resourceVersion too old) triggers a full relist.
+    Optional indexers map an index name to a function returning the index
+    value for an object, e.g. {'node': lambda pod: pod.spec.node_name}.
+    """
+
+    def __init__(self, name, list_method, key_func=None, indexers=None):
+        self.name = name
+        self.list_method = list_method
+        self.key_func = key_func or (lambda obj: obj.metadata.name)
+        self.indexers = indexers or {}
+        self._handlers = []
+        self._reset()
+
+    def _reset(self):
+        # also called in a forked child: the parent's watch thread does not exist there
+        self._items = {}
+        self._indexes = {index: {} for index in self.indexers}
+        self._lock = threading.Lock()
+        self._resource_version = None
+        self._last_sync = None
+        self._synced = threading.Event()
+        self._thread = None
+        self._first_read = True
+        # None until the watch thread knows whether a Kubernetes client exists
+        self.available = None
+
+    def add_handler(self, handler):
+        """Call handler(event_type, old_obj, new_obj) after each change to the cache"""
+        self._handlers.append(handler)
+
+    def _notify(self, changes):
+        for etype, old, new in changes:
+            for handler in self._handlers:
+                try:
+                    handler(etype, old, new)
+                except Exception as e:
+                    logger.warning(f"{self.name} informer: handler failed: {e}")
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"informer-{self.name}", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while get_k8s() is None:
+            self.available = False
+            time.sleep(K8S_CONFIG_RETRY)
+        self.available = True
+        while True:
+            try:
+                if self._resource_version is None:
+                    self._relist()
+                self._watch()
+            except Exception as e:
+                if _api_status(e) == 410:
+                    logger.info(f"{self.name} informer: resourceVersion expired, relisting")
+                    self._resource_version = None
+                    continue
+                logger.warning(f"{self.name} informer: watch failed: {e}")
+                time.sleep(INFORMER_RETRY_BACKOFF)
+
+    def _relist(self):
+        started = time.perf_counter()
+        try:
+            resp = getattr(get_k8s(), self.list_method)(_request_timeout=(K8S_CONNECT_TIMEOUT, INFORMER_LIST_TIMEOUT))
+        except Exception as e:
+            metrics.inc('k8s_api_errors_total', _metric_labels(method=self.list_method, status=_api_status(e) or 'error'))
+            raise
+        metrics.observe('k8s_api_request_duration_seconds', _metric_labels(method=self.list_method),
+                        time.perf_counter() - started)
+        items = {self.key_func(obj): obj for obj in resp.items}
+        with self._lock:
+            old_items = self._items
+            self._items = {}
+            self._indexes = {index: {} for index in self.indexers}
+            for key, obj in items.items():
+                self._store(key, obj)
+            self._resource_version = resp.metadata.resource_version
+            self._last_sync = time.monotonic()
+        self._synced.set()
+        # report what changed while we were not watching
+        changes = [('DELETED', old, None) for key, old in old_items.items() if key not in items]
+        for key, obj in items.items():
+            old = old_items.get(key)
+            if old is None:
+                changes.append(('ADDED', None, obj))
+            elif old.metadata.resource_version != obj.metadata.resource_version:
+                changes.append(('MODIFIED', old, obj))
+        self._notify(changes)
+        logger.info(f"{self.name} informer: listed {len(items)} objects at resourceVersion {self._resource_version}")
+
+    def _watch(self):
+        from kubernetes import watch
+        w = watch.Watch()
+        for event in w.stream(getattr(get_k8s(), self.list_method),
+                              resource_version=self._resource_version,
+                              timeout_seconds=INFORMER_WATCH_TIMEOUT,
+                              allow_watch_bookmarks=True,
+                              # the server ends the watch at timeout_seconds; anything longer is a dead connection
+                              _request_timeout=(K8S_CONNECT_TIMEOUT, INFORMER_WATCH_TIMEOUT + 30)):
+            # Watch tracks the latest resourceVersion, including BOOKMARK events
+            etype = event['type'] if event else None
+            old = None
+            with self._lock:
+                if etype == 'DELETED':
+                    old = self._remove(self.key_func(event['object']))
+                elif etype in ('ADDED', 'MODIFIED'):
+                    old = self._store(self.key_func(event['object']), event['object'])
+                self._resource_version = w.resource_version or self._resource_version
+                self._last_sync = time.monotonic()
+            if etype == 'DELETED' and old is not None:
+                self._notify([(etype, old, None)])
+            elif etype in ('ADDED', 'MODIFIED'):
+                self._notify([('MODIFIED' if old is not None else 'ADDED', old, event['object'])])
+        # a watch that ran to its server-side timeout was healthy the whole time
+        with self._lock:
+            self._last_sync = time.monotonic()
+
+    # _store/_remove must be called with self._lock held
+    def _store(self, key, obj):
+        old = self._remove(key)
+        self._items[key] = obj
+        for index, func in self.indexers.items():
+            self._indexes[index].setdefault(func(obj), set()).add(key)
+        return old
+
+    def _remove(self, key):
+        old = self._items.pop(key, None)
+        if old is None:
+            return None
+        for index, func in self.indexers.items():
+            keys = self._indexes[index].get(func(old))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._indexes[index][func(old)]
+        return old
+
+    def _wait_synced(self):
+        self.start()
+        # only the very first read waits (briefly) for the initial list;
+        # after that reads never block on the API server
+        if self._first_read:
+            self._first_read = False
+            deadline = time.monotonic() + INFORMER_SYNC_WAIT
+            while not self._synced.is_set() and self.available is not False and time.monotonic() < deadline:
+                self._synced.wait(0.05)
+
+    def list(self):
+        self._wait_synced()
+        with self._lock:
+            return list(self._items.values())
+
+    def get(self, key):
+        self._wait_synced()
+        with self._lock:
+            return self._items.get(key)
+
+    def by_index(self, **criteria):
+        """Objects matching every index=value criterion, e.g. by_index(node='edge-1')"""
+        self._wait_synced()
+        with self._lock:
+            keys = None
+            for index, value in criteria.items():
+                matched = self._indexes[index].get(value, set())
+                keys = set(matched) if keys is None else keys & matched
+            if keys is None:
+                return list(self._items.values())
+            return [self._items[k] for k in keys]
+
+    @property
+    def synced(self):
+        return self._synced.is_set()
+
+    def age(self):
+        """Seconds since the cache was last confirmed in sync with the API server"""
+        if self._last_sync is None:
+            return None
+        return round(time.monotonic() - self._last_sync, 3)
+
+    def status(self):
+        return {
+            'synced': self.synced,
+            'age_seconds': self.age(),
+            'resource_version': self._resource_version,
+            'count': len(self._items)
+        }
+
+
+node_informer = Informer('nodes', 'list_node')
+pod_informer = Informer(
+    'pods', 'list_pod_for_all_namespaces',
+    key_func=lambda p: f"{p.metadata.namespace}/{p.metadata.name}",
+    indexers={
+        'node': lambda p: p.spec.node_name or 'unknown',
+        'namespace': lambda p: p.metadata.namespace,
+        'phase': lambda p: p.status.phase if p.status else None,
+    }
+)
+
+
+def _reset_k8s_after_fork():
+    global _k8s_api, _k8s_failed_at, _k8s_lock
+    _k8s_api, _k8s_failed_at, _k8s_lock = None, None, threading.Lock()
+    node_informer._reset()
+    pod_informer._reset()
+    k8s_gateway._reset()
+
+
+# a forked worker must not reuse the parent's connection pool, informer or gateway threads
+os.register_at_fork(after_in_child=_reset_k8s_after_fork)
+
+# Push stream settings
+STREAM_QUEUE_SIZE = int(os.environ.get('STREAM_QUEUE_SIZE', '1000'))
+STREAM_HEARTBEAT = float(os.environ.get('STREAM_HEARTBEAT', '15'))
+# each open stream holds a server thread, so cap them per worker
+STREAM_MAX_SUBSCRIBERS = int(os.environ.get('STREAM_MAX_SUBSCRIBERS', '100'))
+
+
+class EventBroker:
+    """
+    Fan-out of dashboard events to /api/stream subscribers. Each event is
+    serialized once; a subscriber that falls too far behind is dropped and
+    gets a fresh snapshot when its EventSource reconnects.
+    """
+
+    def __init__(self, queue_size=STREAM_QUEUE_SIZE, max_subscribers=STREAM_MAX_SUBSCRIBERS):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def subscribe(self):
+        """New subscriber queue, or None if closed or at STREAM_MAX_SUBSCRIBERS"""
+        q = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            if self._closed or len(self._subscribers) >= self.max_subscribers:
+                return None
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def publish(self, event, data):
+        if not self._subscribers:
+            return
+        message = f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                self._drop(q)
+
+    def _drop(self, q):
+        self.unsubscribe(q)
+        with q.mutex:
+            q.queue.clear()
+        q.put_nowait(None)  # tells the stream generator to close
+
+    def close_all(self):
+        """End every open stream and refuse new ones (graceful shutdown)"""
+        with self._lock:
+            self._closed = True
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            self._drop(q)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+
+event_broker = EventBroker()
+
+# Deleted-device tombstones kept for ?since= delta queries
+STATE_TOMBSTONE_LIMIT = int(os.environ.get('STATE_TOMBSTONE_LIMIT', '10000'))
+
+
+class StateTracker:
+    """
+    Monotonically increasing version over edge devices, command queues and
+    the node cache. Every change records the version at which each device
+    last changed, so clients can ask for ETag revalidation or for only the
+    devices that changed after a given version.
+    """
+
+    def __init__(self):
+        # random per-process prefix so an ETag from before a restart never matches
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self._device_versions = {}
+        self._removed = {}
+        # oldest version for which changed_since() is still exact
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def bump(self, device_id=None, removed=False):
+        with self._lock:
+            self.version += 1
+            if device_id is not None:
+                if removed:
+                    self._device_versions.pop(device_id, None)
+                    self._removed[device_id] = self.version
+                    if len(self._removed) > STATE_TOMBSTONE_LIMIT:
+                        oldest = min(self._removed, key=self._removed.get)
+                        self._floor = self._removed.pop(oldest)
+                else:
+                    self._device_versions[device_id] = self.version
+                    self._removed.pop(device_id, None)
+            return self.version
+
+    def changed_since(self, since):
+        """Return (changed_ids, removed_ids), or None if a full resync is needed"""
+        with self._lock:
+            if since < self._floor or since > self.version:
+                return None
+            changed = [d for d, v in self._device_versions.items() if v > since]
+            removed = [d for d, v in self._removed.items() if v > since]
+            return changed, removed
+
+    def etag(self, version=None):
+        return f"{self.epoch}-{self.version if version is None else version}"
+
+
+# Long-poll settings for GET /edge/commands/<device_id>?wait=<seconds>
+LONGPOLL_MAX_WAIT = float(os.environ.get('LONGPOLL_MAX_WAIT', '30'))
+LONGPOLL_MAX_PARKED = int(os.environ.get('LONGPOLL_MAX_PARKED', '256'))
+
+# Registry settings
+REGISTRY_LOCK_STRIPES = int(os.environ.get('REGISTRY_LOCK_STRIPES', '64'))
+DATA_HISTORY_LIMIT = 20
+
+
+# Command queue settings (per device; seconds)
+COMMAND_QUEUE_MAX = int(os.environ.get('COMMAND_QUEUE_MAX', '100'))
+COMMAND_DEFAULT_TTL = float(os.environ.get('COMMAND_DEFAULT_TTL', '3600'))
+COMMAND_MAX_TTL = float(os.environ.get('COMMAND_MAX_TTL', '86400'))
+# a fetched command is delivered again if no result arrives within the lease
+COMMAND_LEASE_SECONDS = float(os.environ.get('COMMAND_LEASE_SECONDS', '60'))
+COMMAND_MAX_ATTEMPTS = int(os.environ.get('COMMAND_MAX_ATTEMPTS', '5'))
+# broadcast aggregates kept for /command/broadcast/<id>
+BROADCAST_HISTORY = int(os.environ.get('BROADCAST_HISTORY', '1000'))
+
+# Device liveness: a device is expected to send data (or re-register) every
+# heartbeat interval (seconds; a device may override it with the
+# heartbeat_interval registration metadata). After STALE_MISSED missed
+# heartbeats it becomes 'stale', after OFFLINE_MISSED 'offline'.
+DEVICE_HEARTBEAT_INTERVAL = float(os.environ.get('DEVICE_HEARTBEAT_INTERVAL', '30'))
+DEVICE_STALE_MISSED = float(os.environ.get('DEVICE_STALE_MISSED', '3'))
+DEVICE_OFFLINE_MISSED = float(os.environ.get('DEVICE_OFFLINE_MISSED', '10'))
+# resolution of the liveness timer wheel (seconds per slot)
+LIVENESS_TICK = float(os.environ.get('LIVENESS_TICK', '1'))
+LIVENESS_WHEEL_SLOTS = int(os.environ.get('LIVENESS_WHEEL_SLOTS', '512'))
+
+
+def _iso(ts):
+    return datetime.fromtimestamp(ts).isoformat() if ts is not None else None
+
+
+_CROCKFORD32 = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+
+class ULIDGenerator:
+    """
+    Monotonic ULIDs: a 48-bit millisecond timestamp and 80 random bits as 26
+    Crockford base32 characters, so IDs sort by creation time. Within one
+    millisecond the random part is incremented, so IDs from one process are
+    strictly increasing; the random bits keep workers and replicas apart.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        # also called in a forked child, which must not continue the parent's sequence
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._last_rand = 0
+
+    def new(self, prefix=''):
+        with self._lock:
+            ms = time.time_ns() // 1000000
+            if ms <= self._last_ms:
+                # same millisecond (or the clock stepped back): keep counting up
+                ms, rand = self._last_ms, self._last_rand + 1
+                if rand >> 80:
+                    ms, rand = ms + 1, int.from_bytes(os.urandom(10), 'big')
+            else:
+                rand = int.from_bytes(os.urandom(10), 'big')
+            self._last_ms, self._last_rand = ms, rand
+        value = (ms << 80) | rand
+        return prefix + ''.join(_CROCKFORD32[(value >> shift) & 31] for shift in range(125, -1, -5))
+
+
+id_generator = ULIDGenerator()
+os.register_at_fork(after_in_child=id_generator._reset)
+
+
+def _dedup_key(command, params):
+    """Commands with the same name and params coalesce while still waiting for delivery"""
+    return command + ':' + json.dumps(params, sort_keys=True, default=str)
+
+
+def _heartbeat_interval(metadata):
+    """Expected seconds between check-ins: metadata heartbeat_interval, else DEVICE_HEARTBEAT_INTERVAL"""
+    try:
+        interval = float(metadata.get('heartbeat_interval'))
+    except (AttributeError, TypeError, ValueError):
+        return DEVICE_HEARTBEAT_INTERVAL
+    return interval if 0 < interval <= 86400 else DEVICE_HEARTBEAT_INTERVAL
+
+
+def _liveness_deadlines(last_seen, interval=None):
+    """(stale_at, offline_at) for a device last seen at last_seen"""
+    interval = interval or DEVICE_HEARTBEAT_INTERVAL
+    return last_seen + interval * DEVICE_STALE_MISSED, last_seen + interval * DEVICE_OFFLINE_MISSED
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: keys are filed in the slot of their deadline's tick,
+    so scheduling, rescheduling and cancelling are O(1) and advance() only
+    visits the slots that came due since the last call. A deadline more than
+    one revolution ahead waits in its slot until its tick comes round.
+    """
+
+    def __init__(self, tick=LIVENESS_TICK, slots=LIVENESS_WHEEL_SLOTS):
+        self.tick = tick
+        self._slots = [{} for _ in range(slots)]  # key -> tick number
+        self._where = {}  # key -> slot index
+        self._current = None  # last tick processed by advance()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def __len__(self):
+        return len(self._where)
+
+    def schedule(self, key, deadline, replace=True):
+        """File key at deadline (epoch seconds); with replace=False an existing entry is kept"""
+        with self._lock:
+            old = self._where.get(key)
+            if old is not None:
+                if not replace:
+                    return
+                del self._slots[old][key]
+            tick = int(deadline // self.tick)
+            if self._current is not None and tick <= self._current:
+                tick = self._current + 1  # already overdue: fire on the next advance
+            index = tick % len(self._slots)
+            self._slots[index][key] = tick
+            self._where[key] = index
+
+    def cancel(self, key):
+        with self._lock:
+            index = self._where.pop(key, None)
+            if index is not None:
+                del self._slots[index][key]
+
+    def advance(self, now):
+        """Remove and return the keys whose deadline is at or before now"""
+        target = int(now // self.tick)
+        due = []
+        with self._lock:
+            if self._current is None:
+                self._current = target - len(self._slots)
+            # after a long pause one full revolution still visits every slot
+            for tick in range(max(self._current + 1, target - len(self._slots) + 1), target + 1):
+                slot = self._slots[tick % len(self._slots)]
+                for key, key_tick in list(slot.items()):
+                    if key_tick <= target:
+                        del slot[key]
+                        del self._where[key]
+                        due.append(key)
+            self._current = max(self._current, target)
+        return due
+
+
+class DeviceRecord:
+    """One registered edge device; timestamps are epoch seconds"""
+    __slots__ = ('device_id', 'registered_at', 'last_seen', 'status', 'metadata', 'heartbeat', 'data_history')
+
+    def __init__(self, device_id, now):
+        self.device_id = device_id
+        self.registered_at = now
+        self.last_seen = None
+        self.status = None
+        self.metadata = {}
+        self.heartbeat = DEVICE_HEARTBEAT_INTERVAL
+        self.data_history = deque(maxlen=DATA_HISTORY_LIMIT)  # (timestamp, payload)
+
+    def to_dict(self):
+        """Legacy JSON shape served by /devices, /device/<id> and the dashboard"""
+        return {
+            'device_id': self.device_id,
+            'registered_at': _iso(self.registered_at),
+            'last_seen': _iso(self.last_seen),
+            'status': self.status,
+            'metadata': self.metadata,
+            'data_history': [{'timestamp': _iso(ts), 'payload': payload} for ts, payload in self.data_history]
+        }
+
+
+class QueuedCommand:
+    __slots__ = ('entry', 'priority', 'seq', 'expires_at', 'lease_until', 'attempts', 'dedup_key', 'broadcast_id')
+
+    def __init__(self, entry, priority, seq, expires_at, dedup_key, broadcast_id=None):
+        self.entry = entry  # shared by every device of a broadcast
+        self.priority = priority
+        self.seq = seq
+        self.expires_at = expires_at
+        self.lease_until = None
+        self.attempts = 0
+        self.dedup_key = dedup_key
+        self.broadcast_id = broadcast_id
+
+    def deliverable(self, now):
+        if self.expires_at <= now:
+            return False
+        return self.lease_until is None or (self.lease_until <= now and self.attempts < COMMAND_MAX_ATTEMPTS)
+
+
+class CommandQueue:
+    """
+    One device's commands, at most COMMAND_QUEUE_MAX. Higher priority goes
+    first, then FIFO. Fetching leases a command for COMMAND_LEASE_SECONDS and
+    it is delivered again if no result arrives in time (at-least-once), up to
+    COMMAND_MAX_ATTEMPTS times; complete() removes it. Expired commands are
+    dropped lazily. Not thread-safe: DeviceRegistry guards it with the
+    device's stripe lock.
+    """
+    __slots__ = ('_items', '_seq', '_index', '_tally')
+
+    def __init__(self, index, tally):
+        self._items = {}  # command_id -> QueuedCommand
+        self._seq = 0
+        self._index = index  # registry-wide command_id -> device_id
+        self._tally = tally  # tally(broadcast_id, counter) for broadcast aggregates
+
+    def _drop(self, command_id, completed=False):
+        item = self._items.pop(command_id)
+        self._index.pop(command_id, None)
+        if item.broadcast_id:
+            self._tally(item.broadcast_id, 'completed' if completed else 'dropped')
+
+    def __len__(self):
+        return len(self._items)
+
+    def _expire(self, now):
+        for command_id, item in list(self._items.items()):
+            if item.expires_at <= now or (item.attempts >= COMMAND_MAX_ATTEMPTS and item.lease_until <= now):
+                self._drop(command_id)
+
+    def push(self, device_id, command_id, entry, priority, expires_at, dedup_key, now, broadcast_id=None):
+        """Returns (command_id, 'queued' | 'coalesced' | 'rejected')"""
+        self._expire(now)
+        if dedup_key is not None:
+            for queued_id, item in self._items.items():
+                if item.dedup_key == dedup_key and item.lease_until is None:
+                    item.priority = max(item.priority, priority)
+                    item.expires_at = max(item.expires_at, expires_at)
+                    return queued_id, 'coalesced'
+        if len(self._items) >= COMMAND_QUEUE_MAX:
+            # full: drop the least urgent, oldest undelivered command unless it outranks this one
+            waiting = [(item.priority, item.seq, queued_id) for queued_id, item in self._items.items()
+                       if item.lease_until is None]
+            if not waiting or min(waiting)[0] > priority:
+                return None, 'rejected'
+            self._drop(min(waiting)[2])
+        self._seq += 1
+        self._items[command_id] = QueuedCommand(entry, priority, self._seq, expires_at, dedup_key, broadcast_id)
+        self._index[command_id] = device_id
+        return command_id, 'queued'
+
+    def ready(self, now):
+        return sum(1 for item in self._items.values() if item.deliverable(now))
+
+    def lease(self, now, limit=None):
+        self._expire(now)
+        ready = sorted(((command_id, item) for command_id, item in self._items.items() if item.deliverable(now)),
+                       key=lambda pair: (-pair[1].priority, pair[1].seq))
+        out = []
+        for command_id, item in ready[:limit]:
+            item.lease_until = now + COMMAND_LEASE_SECONDS
+            item.attempts += 1
+            if item.attempts == 1 and item.broadcast_id:
+                self._tally(item.broadcast_id, 'delivered')
+            out.append(dict(item.entry, command_id=command_id, priority=item.priority,
+                            attempt=item.attempts, expires_at=_iso(item.expires_at)))
+        return out
+
+    def describe(self, command_id):
+        item = self._items.get(command_id)
+        if item is None:
+            return None
+        return _command_state(command_id, item.entry, item.priority, item.expires_at,
+                              item.lease_until, item.attempts, item.broadcast_id)
+
+    def describe_all(self, now):
+        items = sorted((pair for pair in self._items.items() if pair[1].expires_at > now),
+                       key=lambda pair: (-pair[1].priority, pair[1].seq))
+        return [self.describe(command_id) for command_id, _ in items]
+
+    def complete(self, command_id):
+        """Remove a command; returns its last state, or None if unknown"""
+        state = self.describe(command_id)
+        if state is not None:
+            self._drop(command_id, completed=True)
+        return state
+
+    def dump(self):
+        """JSON-friendly copy of the queue for a Journal snapshot"""
+        return [self._seq, [[command_id, item.entry, item.priority, item.seq, item.expires_at,
+                             item.lease_until, item.attempts, item.dedup_key, item.broadcast_id]
+                            for command_id, item in self._items.items()]]
+
+    def load(self, device_id, state):
+        self._seq, items = state
+        for command_id, entry, priority, seq, expires_at, lease_until, attempts, dedup_key, broadcast_id in items:
+            item = self._items[command_id] = QueuedCommand(entry, priority, seq, expires_at, dedup_key, broadcast_id)
+            item.lease_until, item.attempts = lease_until, attempts
+            self._index[command_id] = device_id
+
+
+def _command_state(command_id, entry, priority, expires_at, lease_until, attempts, broadcast_id):
+    """Status view of a queued command for /command/<id> and /device/<id>/commands"""
+    return {
+        'command_id': command_id,
+        'command': entry.get('command'),
+        'params': entry.get('params'),
+        'broadcast_id': broadcast_id,
+        'state': 'delivered' if attempts else 'queued',
+        'attempts': attempts,
+        'priority': priority,
+        'queued_at': entry.get('timestamp'),
+        'expires_at': _iso(expires_at),
+        'lease_expires_at': _iso(lease_until)
+    }
+
+
+def _broadcast_status(counts):
+    """Public view of a broadcast aggregate: counters plus commands still queued"""
+    out = dict(counts)
+    out['created_at'] = _iso(out['created_at'])
+    out['pending'] = out['queued'] - out['completed'] - out['dropped']
+    return out
+
+
+class DeviceRegistry:
+    """
+    In-memory (default) storage backend for edge devices and their command
+    queues, safe under a threaded server but private to one process.
+    Each device maps to one of REGISTRY_LOCK_STRIPES locks, so requests for
+    different devices rarely contend and there is no global lock. Long-polls
+    wait on a per-device condition that shares the device's stripe lock, so
+    queueing a command and waking its poller happen atomically.
+    Devices that are not offline sit in a timer wheel at their next liveness
+    deadline; a check-in only moves last_seen, and the wheel entry is
+    rechecked (and refiled) when it comes due.
+    """
+
+    def __init__(self, stripes=REGISTRY_LOCK_STRIPES, max_parked=LONGPOLL_MAX_PARKED):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._devices = {}
+        self._messages = [0] * stripes  # retained samples, counted per stripe lock
+        self._liveness = TimerWheel()
+        # write-ahead log (set when STATE_WAL_DIR is configured) and, per device,
+        # the LSN of the last logged change applied
+        self.journal = None
+        self._applied = {}
+        self._broadcasts_applied = 0
+        self._replaying = False
+        self._queues = {}
+        self._command_index = {}  # command_id -> device_id of every queued command
+        self._broadcasts = {}  # broadcast_id -> counters, oldest first
+        self._broadcast_lock = threading.Lock()
+        self._conditions = {}
+        self._waiters = {}
+        self._parked = threading.BoundedSemaphore(max_parked)
+        self.parked = 0
+        self._closing = False
+
+    def _lock(self, device_id):
+        # crc32 rather than hash() so the stripe is stable across processes
+        return self._locks[zlib.crc32(device_id.encode()) % len(self._locks)]
+
+    def _log(self, device_id, op, *args):
+        # called under the device's stripe lock, so its LSNs follow the order of its changes
+        if self.journal is not None:
+            self._applied[device_id] = self.journal.log('registry', op, device_id, *args)
+
+    def _log_broadcasts(self, op, *args):
+        # called under _broadcast_lock
+        if self.journal is not None:
+            self._broadcasts_applied = self.journal.log('registry', op, *args)
+
+    def register(self, device_id, metadata, now=None):
+        """Create or refresh a device; returns (device dict, created)"""
+        now = now or time.time()
+        with self._lock(device_id):
+            record = self._devices.get(device_id)
+            created = record is None
+            if created:
+                record = self._devices[device_id] = DeviceRecord(device_id, now)
+            else:
+                record.registered_at = now
+            record.last_seen = now
+            record.status = 'online'
+            record.metadata = metadata
+            record.heartbeat = _heartbeat_interval(metadata)
+            self._liveness.schedule(device_id, _liveness_deadlines(now, record.heartbeat)[0])
+            self._queues.setdefault(device_id, CommandQueue(self._command_index, self._tally))
+            self._log(device_id, 'register', metadata, now)
+            return record.to_dict(), created
+
+    def record_data(self, device_id, payload, ts=None, now=None):
+        """
+        Append a telemetry sample taken at ts (device time) and received at
+        now; returns (device dict if created, created, was_online)
+        """
+        now = now or time.time()
+        ts = ts or now
+        with self._lock(device_id):
+            record = self._devices.get(device_id)
+            created = record is None
+            if created:
+                record = self._devices[device_id] = DeviceRecord(device_id, now)
+            was_online = record.status == 'online'
+            record.last_seen = now
+            record.status = 'online'
+            # an online device's wheel entry is never later than its stale deadline
+            self._liveness.schedule(device_id, _liveness_deadlines(now, record.heartbeat)[0], replace=not was_online)
+            if len(record.data_history) < DATA_HISTORY_LIMIT:
+                self._messages[zlib.crc32(device_id.encode()) % len(self._messages)] += 1
+            record.data_history.append((ts, payload))
+            self._log(device_id, 'data', payload, ts, now)
+            return record.to_dict() if created else None, created, was_online
+
+    def expire_liveness(self, now=None):
+        """
+        Move devices that stopped checking in to 'stale', then 'offline';
+        returns (device_id, previous status, status, last_seen) transitions.
+        Only devices whose wheel entry came due are looked at.
+        """
+        now = now or time.time()
+        transitions = []
+        for device_id in self._liveness.advance(now):
+            with self._lock(device_id):
+                record = self._devices.get(device_id)
+                if record is None or record.last_seen is None or record.status == 'offline':
+                    continue
+                stale_at, offline_at = _liveness_deadlines(record.last_seen, record.heartbeat)
+                status = 'offline' if now >= offline_at else 'stale' if now >= stale_at else record.status
+                if status != record.status:
+                    transitions.append((device_id, record.status, status, record.last_seen))
+                    record.status = status
+                    self._log(device_id, 'status', status)
+                if status != 'offline':
+                    self._liveness.schedule(device_id, offline_at if status == 'stale' else stale_at)
+        return transitions
+
+    def get(self, device_id):
+        record = self._devices.get(device_id)
+        if record is None:
+            return None
+        with self._lock(device_id):
+            return record.to_dict()
+
+    def list(self):
+        out = []
+        for record in list(self._devices.values()):
+            with self._lock(record.device_id):
+                out.append(record.to_dict())
+        return out
+
+    def device_ids(self, status=None):
+        return [r.device_id for r in list(self._devices.values()) if status is None or r.status == status]
+
+    def profiles(self):
+        """(device_id, status, metadata) of every device, without telemetry history"""
+        return [(r.device_id, r.status, r.metadata) for r in list(self._devices.values())]
+
+    def __contains__(self, device_id):
+        return device_id in self._devices
+
+    def __len__(self):
+        return len(self._devices)
+
+    def total_messages(self):
+        """Samples kept in data histories (maintained on ingest rather than recounted)"""
+        return sum(self._messages)
+
+    def _push(self, device_id, command_id, entry, priority, expires_at, dedup_key, now, broadcast_id=None):
+        with self._lock(device_id):
+            q = self._queues.get(device_id)
+            if q is None:
+                q = self._queues[device_id] = CommandQueue(self._command_index, self._tally)
+            result = q.push(device_id, command_id, entry, priority, expires_at, dedup_key, now, broadcast_id)
+            self._log(device_id, 'push', command_id, entry, priority, expires_at, dedup_key, now, broadcast_id)
+            cond = self._conditions.get(device_id)
+            if cond is not None and result[1] == 'queued':
+                cond.notify_all()
+            return result
+
+    def enqueue(self, device_id, entry, priority=0, ttl=None, dedup_key=None, now=None):
+        """Queue a command; returns (command_id, 'queued' | 'coalesced' | 'rejected')"""
+        now = now or time.time()
+        return self._push(device_id, entry['command_id'], entry, priority,
+                          now + (ttl or COMMAND_DEFAULT_TTL), dedup_key, now)
+
+    def _tally(self, broadcast_id, counter):
+        if self._replaying:
+            return  # replayed from the logged 'tally' records instead
+        with self._broadcast_lock:
+            counts = self._broadcasts.get(broadcast_id)
+            if counts is not None:
+                counts[counter] += 1
+                self._log_broadcasts('tally', broadcast_id, counter)
+
+    def broadcast(self, device_ids, entry, priority=0, ttl=None, dedup_key=None, now=None):
+        """
+        Queue one command (entry, shared rather than copied) for every device,
+        each under its own command ID; returns the aggregate counters
+        """
+        now = now or time.time()
+        expires_at = now + (ttl or COMMAND_DEFAULT_TTL)
+        broadcast_id = entry['broadcast_id']
+        counts = {'broadcast_id': broadcast_id, 'command': entry['command'], 'created_at': now,
+                  'targeted': len(device_ids), 'queued': 0, 'coalesced': 0, 'rejected': 0,
+                  'delivered': 0, 'completed': 0, 'dropped': 0}
+        with self._broadcast_lock:
+            self._broadcasts[broadcast_id] = counts
+            while len(self._broadcasts) > BROADCAST_HISTORY:
+                del self._broadcasts[next(iter(self._broadcasts))]
+            self._log_broadcasts('broadcast', dict(counts))  # serialized later by the writer
+        outcomes = {'queued': 0, 'coalesced': 0, 'rejected': 0}
+        for device_id in device_ids:
+            _, outcome = self._push(device_id, id_generator.new('cmd_'), entry, priority, expires_at,
+                                    dedup_key, now, broadcast_id)
+            outcomes[outcome] += 1
+        with self._broadcast_lock:
+            counts.update(outcomes)
+            self._log_broadcasts('outcomes', broadcast_id, outcomes)
+            return _broadcast_status(counts)
+
+    def broadcast_status(self, broadcast_id):
+        with self._broadcast_lock:
+            counts = self._broadcasts.get(broadcast_id)
+            return _broadcast_status(counts) if counts is not None else None
+
+    def lease(self, device_id, limit=None, now=None):
+        """Lease up to `limit` deliverable commands for a device, most urgent first"""
+        now = now or time.time()
+        with self._lock(device_id):
+            q = self._queues.get(device_id)
+            leased = q.lease(now, limit) if q else []
+            if leased:
+                self._log(device_id, 'lease', limit, now)
+            return leased
+
+    def complete(self, device_id, command_id):
+        """
+        Remove a delivered command once its result arrives; returns the
+        command's last state, or None if it is not queued (any more)
+        """
+        with self._lock(device_id):
+            q = self._queues.get(device_id)
+            state = q.complete(command_id) if q else None
+            if state is not None:
+                self._log(device_id, 'complete', command_id)
+            return state
+
+    def locate_command(self, command_id):
+        """Device a queued command belongs to, or None (O(1) index lookup)"""
+        return self._command_index.get(command_id)
+
+    def command_state(self, command_id):
+        """State of a queued command plus its device_id, or None"""
+        device_id = self._command_index.get(command_id)
+        if device_id is None:
+            return None
+        with self._lock(device_id):
+            q = self._queues.get(device_id)
+            state = q.describe(command_id) if q else None
+        return dict(state, device_id=device_id) if state else None
+
+    def device_commands(self, device_id):
+        """Unexpired queued and delivered commands of a device, most urgent first"""
+        with self._lock(device_id):
+            q = self._queues.get(device_id)
+            return q.describe_all(time.time()) if q else []
+
+    def _ready(self, device_id):
+        q = self._queues.get(device_id)
+        return q.ready(time.time()) if q else 0
+
+    def queue_depths(self):
+        """{device_id: ready commands} for every device with any"""
+        now = time.time()
+        depths = {}
+        for device_id in list(self._queues):
+            with self._lock(device_id):
+                ready = self._queues[device_id].ready(now)
+            if ready:
+                depths[device_id] = ready
+        return depths
+
+    def queue_depth(self, device_id):
+        """Commands that a poll would receive right now"""
+        with self._lock(device_id):
+            return self._ready(device_id)
+
+    def wait_for_commands(self, device_id, timeout):
+        """
+        Block until a command is queued for device_id or timeout expires.
+        Returns False without waiting if LONGPOLL_MAX_PARKED polls are
+        already parked in this worker or the worker is shutting down.
+        """
+        if self._closing or not self._parked.acquire(blocking=False):
+            return False
+        lock = self._lock(device_id)
+        try:
+            with lock:
+                cond = self._conditions.get(device_id)
+                if cond is None:
+                    cond = self._conditions[device_id] = threading.Condition(lock)
+                self._waiters[device_id] = self._waiters.get(device_id, 0) + 1
+                self.parked += 1
+                try:
+                    cond.wait_for(lambda: self._ready(device_id) or self._closing, timeout)
+                finally:
+                    self.parked -= 1
+                    self._waiters[device_id] -= 1
+                    if not self._waiters[device_id]:
+                        del self._waiters[device_id]
+                        del self._conditions[device_id]
+            return True
+        finally:
+            self._parked.release()
+
+    def wake_all(self):
+        """Release every parked long-poll and stop parking new ones (graceful shutdown)"""
+        self._closing = True
+        for device_id, cond in list(self._conditions.items()):
+            with self._lock(device_id):
+                cond.notify_all()
+
+    def snapshot(self):
+        """Journal snapshot: broadcast counters, then each device copied under its own lock"""
+        with self._broadcast_lock:
+            broadcasts = ['broadcasts', self._broadcasts_applied, [dict(c) for c in self._broadcasts.values()]]
+        yield broadcasts
+        device_ids = list(self._devices)
+        device_ids += [d for d in list(self._queues) if d not in self._devices]
+        for device_id in device_ids:
+            with self._lock(device_id):
+                record = self._devices.get(device_id)
+                q = self._queues.get(device_id)
+                state = ['device', device_id, self._applied.get(device_id, 0),
+                         None if record is None else [record.registered_at, record.last_seen, record.status,
+                                                      record.metadata, record.heartbeat, list(record.data_history)],
+                         None if q is None else q.dump()]
+            yield state
+
+    def restore(self, state):
+        """Load one snapshot() item (at startup, before any request)"""
+        if state[0] == 'broadcasts':
+            _, self._broadcasts_applied, broadcasts = state
+            self._broadcasts = {counts['broadcast_id']: counts for counts in broadcasts}
+            return
+        _, device_id, applied, fields, queue_state = state
+        self._applied[device_id] = applied
+        if fields is not None:
+            record = self._devices[device_id] = DeviceRecord(device_id, fields[0])
+            record.last_seen, record.status, record.metadata, record.heartbeat, history = fields[1:]
+            record.data_history.extend((ts, payload) for ts, payload in history)
+            self._messages[zlib.crc32(device_id.encode()) % len(self._messages)] += len(record.data_history)
+            if record.last_seen is not None and record.status != 'offline':
+                self._liveness.schedule(device_id, _liveness_deadlines(record.last_seen, record.heartbeat)[0])
+        if queue_state is not None:
+            q = self._queues[device_id] = CommandQueue(self._command_index, self._tally)
+            q.load(device_id, queue_state)
+
+    def replay(self, lsn, op, args):
+        """Re-apply one logged change unless the restored snapshot already has it"""
+        if op in ('broadcast', 'outcomes', 'tally'):
+            if lsn <= self._broadcasts_applied:
+                return
+            if op == 'broadcast':
+                self._broadcasts[args[0]['broadcast_id']] = args[0]
+                while len(self._broadcasts) > BROADCAST_HISTORY:
+                    del self._broadcasts[next(iter(self._broadcasts))]
+            elif args[0] in self._broadcasts:
+                counts = self._broadcasts[args[0]]
+                if op == 'outcomes':
+                    counts.update(args[1])
+                else:
+                    counts[args[1]] += 1
+            self._broadcasts_applied = lsn
+            return
+        device_id = args[0]
+        if lsn <= self._applied.get(device_id, 0):
+            return
+        self._replaying = True
+        try:
+            if op == 'register':
+                self.register(device_id, args[1], now=args[2])
+            elif op == 'data':
+                self.record_data(device_id, args[1], args[2], now=args[3])
+            elif op == 'status':
+                record = self._devices.get(device_id)
+                if record is not None:
+                    record.status = args[1]
+            elif op == 'push':
+                self._push(device_id, *args[1:])
+            elif op == 'lease':
+                self.lease(device_id, args[1], now=args[2])
+            elif op == 'complete':
+                self.complete(device_id, args[1])
+        finally:
+            self._replaying = False
+        self._applied[device_id] = lsn
+
+
+# Shared state backend: 'memory' (default, one process) or 'sqlite' (WAL mode,
+# shared by every worker and replica that mounts STATE_SQLITE_PATH)
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory')
+STATE_SQLITE_PATH = os.environ.get('STATE_SQLITE_PATH', '/data/master-app.db')
+# how often a long-poll rechecks the shared queue for commands queued by other workers
+SQLITE_POLL_INTERVAL = float(os.environ.get('SQLITE_POLL_INTERVAL', '0.25'))
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS devices (
+    device_id TEXT PRIMARY KEY, registered_at REAL, last_seen REAL,
+    status TEXT, metadata TEXT, seq INTEGER NOT NULL DEFAULT 0,
+    heartbeat REAL, stale_at REAL, offline_at REAL
+);
+CREATE TABLE IF NOT EXISTS samples (
+    device_id TEXT, slot INTEGER, ts REAL, payload TEXT,
+    PRIMARY KEY (device_id, slot)
+);
+CREATE TABLE IF NOT EXISTS command_queue (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT, device_id TEXT, command_id TEXT,
+    priority INTEGER NOT NULL DEFAULT 0, expires_at REAL, lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0, dedup_key TEXT, entry TEXT, broadcast_id TEXT
+);
+CREATE INDEX IF NOT EXISTS command_queue_device ON command_queue (device_id, priority DESC, seq);
+CREATE INDEX IF NOT EXISTS command_queue_command ON command_queue (command_id);
+CREATE TABLE IF NOT EXISTS broadcasts (
+    broadcast_id TEXT PRIMARY KEY, command TEXT, created_at REAL, entry TEXT,
+    targeted INTEGER NOT NULL DEFAULT 0, queued INTEGER NOT NULL DEFAULT 0,
+    coalesced INTEGER NOT NULL DEFAULT 0, rejected INTEGER NOT NULL DEFAULT 0,
+    delivered INTEGER NOT NULL DEFAULT 0, completed INTEGER NOT NULL DEFAULT 0,
+    dropped INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS broadcasts_created ON broadcasts (created_at);
+CREATE TABLE IF NOT EXISTS command_results (
+    command_id TEXT PRIMARY KEY, device_id TEXT, broadcast_id TEXT, command TEXT,
+    status TEXT, received_at REAL, size INTEGER, result TEXT
+);
+CREATE INDEX IF NOT EXISTS command_results_device ON command_results (device_id, received_at);
+CREATE INDEX IF NOT EXISTS command_results_broadcast ON command_results (broadcast_id, status);
+CREATE INDEX IF NOT EXISTS command_results_received ON command_results (received_at);
+CREATE TABLE IF NOT EXISTS device_versions (
+    device_id TEXT PRIMARY KEY, version INTEGER, removed INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS telemetry_seq (
+    device_id TEXT, metric TEXT, seq INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (device_id, metric)
+);
+CREATE TABLE IF NOT EXISTS telemetry (
+    device_id TEXT, metric TEXT, slot INTEGER, ts REAL, value REAL,
+    PRIMARY KEY (device_id, metric, slot)
+);
+"""
+
+
+class SQLiteStore:
+    """SQLite database in WAL mode with one connection per thread (and per process after fork)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.connect().executescript(SQLITE_SCHEMA)
+        # commands left in the old FIFO table move into command_queue
+        if self.connect().execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'commands'").fetchone():
+            with self.transaction() as db:
+                db.execute("INSERT INTO command_queue (device_id, command_id, expires_at, entry) "
+                           "SELECT device_id, json_extract(entry, '$.command_id'), ?, entry FROM commands ORDER BY id",
+                           (time.time() + COMMAND_DEFAULT_TTL,))
+                db.execute('DROP TABLE commands')
+        columns = {row[1] for row in self.connect().execute('PRAGMA table_info(command_queue)')}
+        if 'broadcast_id' not in columns:
+            # broadcast commands keep their payload once, in broadcasts.entry
+            self.connect().execute('ALTER TABLE command_queue ADD COLUMN broadcast_id TEXT')
+        columns = {row[1] for row in self.connect().execute('PRAGMA table_info(devices)')}
+        if 'stale_at' not in columns:
+            for column in ('heartbeat', 'stale_at', 'offline_at'):
+                self.connect().execute(f'ALTER TABLE devices ADD COLUMN {column} REAL')
+            self.connect().execute('UPDATE devices SET stale_at = last_seen + ?, offline_at = last_seen + ?',
+                                   _liveness_deadlines(0))
+        # retained samples, kept current by record_data instead of COUNT(*) per dashboard request
+        self.connect().execute("INSERT OR IGNORE INTO meta (key, value) SELECT 'messages', COUNT(*) FROM samples")
+        # the liveness sweep reads only the devices whose deadline has passed
+        self.connect().execute('CREATE INDEX IF NOT EXISTS devices_stale ON devices (status, stale_at)')
+        self.connect().execute('CREATE INDEX IF NOT EXISTS devices_offline ON devices (status, offline_at)')
+
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def transaction(self):
+        return _SQLiteTransaction(self.connect())
+
+
+class _SQLiteTransaction:
+    # BEGIN IMMEDIATE takes the write lock up front, so read-modify-write
+    # sequences are atomic across every process sharing the database file
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+class SQLiteDeviceRegistry:
+    """DeviceRegistry backed by a SQLiteStore, shared by every process using the same file"""
+
+    def __init__(self, store):
+        self.store = store
+        self._local_conditions = {}
+        self._lock = threading.Lock()
+        self._parked = threading.BoundedSemaphore(LONGPOLL_MAX_PARKED)
+        self.parked = 0
+        self._closing = False
+
+    def _device_dict(self, db, row):
+        device_id, registered_at, last_seen, status, metadata = row[:5]
+        samples = db.execute(
+            'SELECT ts, payload FROM samples WHERE device_id = ? ORDER BY ts', (device_id,)
+        ).fetchall()
+        return {
+            'device_id': device_id,
+            'registered_at': _iso(registered_at),
+            'last_seen': _iso(last_seen),
+            'status': status,
+            'metadata': json.loads(metadata) if metadata else {},
+            'data_history': [{'timestamp': _iso(ts), 'payload': json.loads(payload)} for ts, payload in samples]
+        }
+
+    def register(self, device_id, metadata, now=None):
+        now = now or time.time()
+        heartbeat = _heartbeat_interval(metadata)
+        with self.store.transaction() as db:
+            created = db.execute('SELECT 1 FROM devices WHERE device_id = ?', (device_id,)).fetchone() is None
+            db.execute(
+                'INSERT INTO devices (device_id, registered_at, last_seen, status, metadata, heartbeat, stale_at, offline_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (device_id) DO UPDATE SET registered_at = excluded.registered_at, '
+                'last_seen = excluded.last_seen, status = excluded.status, metadata = excluded.metadata, '
+                'heartbeat = excluded.heartbeat, stale_at = excluded.stale_at, offline_at = excluded.offline_at',
+                (device_id, now, now, 'online', json.dumps(metadata), heartbeat) + _liveness_deadlines(now, heartbeat)
+            )
+            row = db.execute('SELECT * FROM devices WHERE device_id = ?', (device_id,)).fetchone()
+            return self._device_dict(db, row), created
+
+    def record_data(self, device_id, payload, ts=None, now=None):
+        now = now or time.time()
+        ts = ts or now
+        with self.store.transaction() as db:
+            row = db.execute('SELECT status, seq, heartbeat FROM devices WHERE device_id = ?', (device_id,)).fetchone()
+            created = row is None
+            if created:
+                db.execute('INSERT INTO devices (device_id, registered_at, metadata) VALUES (?, ?, ?)',
+                           (device_id, now, '{}'))
+                row = (None, 0, None)
+            was_online = row[0] == 'online'
+            # fixed slots per device make history a ring: O(1) per sample, bounded rows
+            db.execute('INSERT OR REPLACE INTO samples (device_id, slot, ts, payload) VALUES (?, ?, ?, ?)',
+                       (device_id, row[1] % DATA_HISTORY_LIMIT, ts, json.dumps(payload)))
+            if row[1] < DATA_HISTORY_LIMIT:
+                db.execute("UPDATE meta SET value = value + 1 WHERE key = 'messages'")
+            db.execute("UPDATE devices SET last_seen = ?, status = 'online', seq = seq + 1, stale_at = ?, offline_at = ? "
+                       "WHERE device_id = ?", (now,) + _liveness_deadlines(now, row[2]) + (device_id,))
+            device = None
+            if created:
+                row = db.execute('SELECT * FROM devices WHERE device_id = ?', (device_id,)).fetchone()
+                device = self._device_dict(db, row)
+            return device, created, was_online
+
+    def expire_liveness(self, now=None):
+        """
+        Same contract as DeviceRegistry.expire_liveness: two index range scans
+        find the overdue devices, and each transition is a compare-and-set on
+        (status, last_seen) so exactly one worker reports it.
+        """
+        now = now or time.time()
+        db = self.store.connect()
+        due = db.execute(
+            "SELECT device_id, status, last_seen, offline_at FROM devices WHERE status = 'online' AND stale_at <= ? "
+            "UNION ALL SELECT device_id, status, last_seen, offline_at FROM devices WHERE status = 'stale' AND offline_at <= ?",
+            (now, now)
+        ).fetchall()
+        if not due:
+            return []
+        transitions = []
+        with self.store.transaction() as db:
+            for device_id, previous, last_seen, offline_at in due:
+                status = 'offline' if offline_at <= now else 'stale'
+                changed = db.execute('UPDATE devices SET status = ? WHERE device_id = ? AND status = ? AND last_seen = ?',
+                                     (status, device_id, previous, last_seen)).rowcount
+                if changed:
+                    transitions.append((device_id, previous, status, last_seen))
+        return transitions
+
+    def get(self, device_id):
+        db = self.store.connect()
+        row = db.execute('SELECT * FROM devices WHERE device_id = ?', (device_id,)).fetchone()
+        return self._device_dict(db, row) if row else None
+
+    def list(self):
+        db = self.store.connect()
+        return [self._device_dict(db, row) for row in db.execute('SELECT * FROM devices ORDER BY rowid').fetchall()]
+
+    def device_ids(self, status=None):
+        db = self.store.connect()
+        if status is None:
+            return [r[0] for r in db.execute('SELECT device_id FROM devices ORDER BY rowid').fetchall()]
+        return [r[0] for r in db.execute('SELECT device_id FROM devices WHERE status = ? ORDER BY rowid', (status,)).fetchall()]
+
+    def __contains__(self, device_id):
+        return self.store.connect().execute('SELECT 1 FROM devices WHERE device_id = ?', (device_id,)).fetchone() is not None
+
+    def __len__(self):
+        return self.store.connect().execute('SELECT COUNT(*) FROM devices').fetchone()[0]
+
+    def total_messages(self):
+        return self.store.connect().execute("SELECT CAST(value AS INTEGER) FROM meta WHERE key = 'messages'").fetchone()[0]
+
+    def profiles(self):
+        return [(device_id, status, json.loads(metadata) if metadata else {}) for device_id, status, metadata in
+                self.store.connect().execute('SELECT device_id, status, metadata FROM devices ORDER BY rowid')]
+
+    def _tally(self, db, counts, counter):
+        db.executemany(f'UPDATE broadcasts SET {counter} = {counter} + ? WHERE broadcast_id = ?',
+                       [(n, broadcast_id) for broadcast_id, n in counts])
+
+    def _expire(self, db, device_id, now):
+        where = 'device_id = ? AND (expires_at <= ? OR (attempts >= ? AND lease_until <= ?))'
+        args = (device_id, now, COMMAND_MAX_ATTEMPTS, now)
+        self._tally(db, db.execute(f'SELECT broadcast_id, COUNT(*) FROM command_queue WHERE {where} '
+                                   'AND broadcast_id IS NOT NULL GROUP BY broadcast_id', args).fetchall(), 'dropped')
+        db.execute(f'DELETE FROM command_queue WHERE {where}', args)
+
+    def _push(self, db, device_id, command_id, entry, priority, expires_at, dedup_key, now, broadcast_id=None):
+        self._expire(db, device_id, now)
+        if dedup_key is not None:
+            row = db.execute('SELECT seq, command_id FROM command_queue '
+                             'WHERE device_id = ? AND dedup_key = ? AND lease_until IS NULL LIMIT 1',
+                             (device_id, dedup_key)).fetchone()
+            if row:
+                db.execute('UPDATE command_queue SET priority = MAX(priority, ?), expires_at = MAX(expires_at, ?) '
+                           'WHERE seq = ?', (priority, expires_at, row[0]))
+                return row[1], 'coalesced'
+        depth = db.execute('SELECT COUNT(*) FROM command_queue WHERE device_id = ?', (device_id,)).fetchone()[0]
+        if depth >= COMMAND_QUEUE_MAX:
+            victim = db.execute('SELECT seq, priority, broadcast_id FROM command_queue '
+                                'WHERE device_id = ? AND lease_until IS NULL ORDER BY priority, seq LIMIT 1',
+                                (device_id,)).fetchone()
+            if victim is None or victim[1] > priority:
+                return None, 'rejected'
+            db.execute('DELETE FROM command_queue WHERE seq = ?', (victim[0],))
+            if victim[2]:
+                self._tally(db, [(victim[2], 1)], 'dropped')
+        db.execute('INSERT INTO command_queue (device_id, command_id, priority, expires_at, dedup_key, entry, broadcast_id) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                   (device_id, command_id, priority, expires_at, dedup_key, entry, broadcast_id))
+        return command_id, 'queued'
+
+    def _notify(self, device_id):
+        cond = self._local_conditions.get(device_id)
+        if cond is not None:
+            with cond:
+                cond.notify_all()
+
+    def enqueue(self, device_id, entry, priority=0, ttl=None, dedup_key=None, now=None):
+        now = now or time.time()
+        with self.store.transaction() as db:
+            result = self._push(db, device_id, entry['command_id'], json.dumps(entry), priority,
+                                now + (ttl or COMMAND_DEFAULT_TTL), dedup_key, now)
+        if result[1] == 'queued':
+            self._notify(device_id)
+        return result
+
+    def broadcast(self, device_ids, entry, priority=0, ttl=None, dedup_key=None, now=None):
+        now = now or time.time()
+        expires_at = now + (ttl or COMMAND_DEFAULT_TTL)
+        broadcast_id = entry['broadcast_id']
+        outcomes = {'queued': 0, 'coalesced': 0, 'rejected': 0}
+        queued = []
+        with self.store.transaction() as db:
+            # every command of a broadcast expires within COMMAND_MAX_TTL, so older aggregates are safe to drop
+            db.execute('DELETE FROM broadcasts WHERE created_at < ? AND broadcast_id NOT IN '
+                       '(SELECT broadcast_id FROM broadcasts ORDER BY created_at DESC LIMIT ?)',
+                       (now - COMMAND_MAX_TTL, BROADCAST_HISTORY))
+            db.execute('INSERT INTO broadcasts (broadcast_id, command, created_at, entry, targeted) VALUES (?, ?, ?, ?, ?)',
+                       (broadcast_id, entry['command'], now, json.dumps(entry), len(device_ids)))
+            for device_id in device_ids:
+                _, outcome = self._push(db, device_id, id_generator.new('cmd_'), None, priority, expires_at,
+                                        dedup_key, now, broadcast_id)
+                outcomes[outcome] += 1
+                if outcome == 'queued':
+                    queued.append(device_id)
+            db.execute('UPDATE broadcasts SET queued = ?, coalesced = ?, rejected = ? WHERE broadcast_id = ?',
+                       (outcomes['queued'], outcomes['coalesced'], outcomes['rejected'], broadcast_id))
+        for device_id in queued:
+            self._notify(device_id)
+        return self.broadcast_status(broadcast_id)
+
+    def broadcast_status(self, broadcast_id):
+        db = self.store.connect()
+        cursor = db.execute('SELECT broadcast_id, command, created_at, targeted, queued, coalesced, rejected, '
+                            'delivered, completed, dropped FROM broadcasts WHERE broadcast_id = ?', (broadcast_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return _broadcast_status(dict(zip([c[0] for c in cursor.description], row)))
+
+    def lease(self, device_id, limit=None, now=None):
+        now = now or time.time()
+        with self.store.transaction() as db:
+            self._expire(db, device_id, now)
+            rows = db.execute('SELECT q.seq, q.command_id, q.priority, q.expires_at, q.attempts, '
+                              'COALESCE(q.entry, b.entry), q.broadcast_id FROM command_queue q '
+                              'LEFT JOIN broadcasts b ON b.broadcast_id = q.broadcast_id '
+                              'WHERE q.device_id = ? AND (q.lease_until IS NULL OR q.lease_until <= ?) '
+                              'ORDER BY q.priority DESC, q.seq LIMIT ?',
+                              (device_id, now, -1 if limit is None else limit)).fetchall()
+            db.executemany('UPDATE command_queue SET lease_until = ?, attempts = attempts + 1 WHERE seq = ?',
+                           [(now + COMMAND_LEASE_SECONDS, row[0]) for row in rows])
+            self._tally(db, [(row[6], 1) for row in rows if row[6] and row[4] == 0], 'delivered')
+            return [dict(json.loads(entry), command_id=command_id, priority=priority, attempt=attempts + 1,
+                         expires_at=_iso(expires_at))
+                    for _, command_id, priority, expires_at, attempts, entry, _ in rows]
+
+    def locate_command(self, command_id):
+        row = self.store.connect().execute('SELECT device_id FROM command_queue WHERE command_id = ?',
+                                           (command_id,)).fetchone()
+        return row[0] if row else None
+
+    _STATE_COLUMNS = ('q.command_id, COALESCE(q.entry, b.entry), q.priority, q.expires_at, q.lease_until, '
+                      'q.attempts, q.broadcast_id, q.device_id, q.seq FROM command_queue q '
+                      'LEFT JOIN broadcasts b ON b.broadcast_id = q.broadcast_id')
+
+    def _state(self, row):
+        command_id, entry, priority, expires_at, lease_until, attempts, broadcast_id = row[:7]
+        return _command_state(command_id, json.loads(entry), priority, expires_at, lease_until, attempts, broadcast_id)
+
+    def complete(self, device_id, command_id):
+        with self.store.transaction() as db:
+            row = db.execute(f'SELECT {self._STATE_COLUMNS} WHERE q.device_id = ? AND q.command_id = ?',
+                             (device_id, command_id)).fetchone()
+            if row is None:
+                return None
+            db.execute('DELETE FROM command_queue WHERE seq = ?', (row[8],))
+            if row[6]:
+                self._tally(db, [(row[6], 1)], 'completed')
+            return self._state(row)
+
+    def command_state(self, command_id):
+        row = self.store.connect().execute(f'SELECT {self._STATE_COLUMNS} WHERE q.command_id = ?',
+                                           (command_id,)).fetchone()
+        return dict(self._state(row), device_id=row[7]) if row else None
+
+    def device_commands(self, device_id):
+        rows = self.store.connect().execute(
+            f'SELECT {self._STATE_COLUMNS} WHERE q.device_id = ? AND q.expires_at > ? ORDER BY q.priority DESC, q.seq',
+            (device_id, time.time())
+        ).fetchall()
+        return [self._state(row) for row in rows]
+
+    def queue_depth(self, device_id):
+        now = time.time()
+        return self.store.connect().execute(
+            'SELECT COUNT(*) FROM command_queue WHERE device_id = ? AND expires_at > ? AND '
+            '(lease_until IS NULL OR (lease_until <= ? AND attempts < ?))',
+            (device_id, now, now, COMMAND_MAX_ATTEMPTS)
+        ).fetchone()[0]
+
+    def queue_depths(self):
+        now = time.time()
+        return dict(self.store.connect().execute(
+            'SELECT device_id, COUNT(*) FROM command_queue WHERE expires_at > ? AND '
+            '(lease_until IS NULL OR (lease_until <= ? AND attempts < ?)) GROUP BY device_id',
+            (now, now, COMMAND_MAX_ATTEMPTS)
+        ).fetchall())
+
+    def wait_for_commands(self, device_id, timeout):
+        """
+        Commands queued by this process wake the poll at once; commands
+        queued by other workers are noticed within SQLITE_POLL_INTERVAL.
+        """
+        if self._closing or not self._parked.acquire(blocking=False):
+            return False
+        with self._lock:
+            cond = self._local_conditions.setdefault(device_id, threading.Condition())
+            self.parked += 1
+        try:
+            deadline = time.monotonic() + timeout
+            while not self._closing and not self.queue_depth(device_id):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                with cond:
+                    cond.wait(min(remaining, SQLITE_POLL_INTERVAL))
+            return True
+        finally:
+            with self._lock:
+                self.parked -= 1
+            self._parked.release()
+
+    def wake_all(self):
+        self._closing = True
+        for cond in list(self._local_conditions.values()):
+            with cond:
+                cond.notify_all()
+
+
+class SQLiteStateTracker:
+    """StateTracker whose version, epoch and per-device versions live in a SQLiteStore"""
+
+    def __init__(self, store):
+        self.store = store
+        with store.transaction() as db:
+            db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('epoch', ?)", (uuid.uuid4().hex[:8],))
+            db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', '0')")
+            db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('floor', '0')")
+            self.epoch = db.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+
+    @property
+    def version(self):
+        return int(self.store.connect().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0])
+
+    def bump(self, device_id=None, removed=False):
+        with self.store.transaction() as db:
+            db.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'version'")
+            version = int(db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0])
+            if device_id is not None:
+                db.execute('INSERT OR REPLACE INTO device_versions (device_id, version, removed) VALUES (?, ?, ?)',
+                           (device_id, version, int(removed)))
+                if removed:
+                    excess = db.execute('SELECT COUNT(*) FROM device_versions WHERE removed = 1').fetchone()[0] - STATE_TOMBSTONE_LIMIT
+                    if excess > 0:
+                        oldest = db.execute('SELECT device_id, version FROM device_versions WHERE removed = 1 '
+                                            'ORDER BY version LIMIT ?', (excess,)).fetchall()
+                        db.executemany('DELETE FROM device_versions WHERE device_id = ?', [(d,) for d, _ in oldest])
+                        db.execute("UPDATE meta SET value = ? WHERE key = 'floor'", (str(oldest[-1][1]),))
+            return version
+
+    def changed_since(self, since):
+        db = self.store.connect()
+        floor = int(db.execute("SELECT value FROM meta WHERE key = 'floor'").fetchone()[0])
+        if since < floor or since > self.version:
+            return None
+        rows = db.execute('SELECT device_id, removed FROM device_versions WHERE version > ?', (since,)).fetchall()
+        return [d for d, removed in rows if not removed], [d for d, removed in rows if removed]
+
+    def etag(self, version=None):
+        return f"{self.epoch}-{self.version if version is None else version}"
+
+
+# Telemetry retention: points kept per device and numeric metric (20 up to tens of thousands)
+TELEMETRY_RETENTION = int(os.environ.get('TELEMETRY_RETENTION', '20'))
+# metrics tracked per device, so a misbehaving payload cannot grow memory without bound
+TELEMETRY_MAX_METRICS = int(os.environ.get('TELEMETRY_MAX_METRICS', '32'))
+
+
+def _numeric_fields(payload):
+    if not isinstance(payload, dict):
+        return []
+    return [(k, float(v)) for k, v in payload.items()
+            if isinstance(v, (int, float)) and not isinstance(v, bool)]
+
+
+class RingBuffer:
+    """Fixed-capacity series of (timestamp, value) floats; O(1) append, oldest point overwritten"""
+    __slots__ = ('capacity', 'ts', 'values', 'head', 'size')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ts = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.head = 0
+        self.size = 0
+
+    def append(self, ts, value):
+        self.ts[self.head] = ts
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    def arrays(self):
+        """Oldest-first copies of (timestamps, values): numpy arrays if available, else array('d')"""
+        if self.size < self.capacity:
+            ts, values = self.ts[:self.size], self.values[:self.size]
+        else:
+            ts = self.ts[self.head:] + self.ts[:self.head]
+            values = self.values[self.head:] + self.values[:self.head]
+        if np is not None:
+            return np.frombuffer(ts, dtype=np.float64), np.frombuffer(values, dtype=np.float64)
+        return ts, values
+
+
+def _select_range(ts, values, start, end):
+    if start is None and end is None:
+        return ts, values
+    start = float('-inf') if start is None else start
+    end = float('inf') if end is None else end
+    if np is not None:
+        mask = (ts >= start) & (ts <= end)
+        return ts[mask], values[mask]
+    keep = [i for i, t in enumerate(ts) if start <= t <= end]
+    return array('d', (ts[i] for i in keep)), array('d', (values[i] for i in keep))
+
+
+class TelemetryStore:
+    """
+    In-memory columnar telemetry: one RingBuffer per device and numeric
+    payload field, so memory per device is bounded by
+    TELEMETRY_MAX_METRICS * TELEMETRY_RETENTION * 16 bytes.
+    """
+
+    def __init__(self, retention=TELEMETRY_RETENTION, stripes=REGISTRY_LOCK_STRIPES):
+        self.retention = retention
+        self._series = {}
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self.journal = None
+        self._applied = {}  # device_id -> LSN of the last logged append
+
+    def _lock(self, device_id):
+        return self._locks[zlib.crc32(device_id.encode()) % len(self._locks)]
+
+    def append(self, device_id, ts, payload):
+        fields = _numeric_fields(payload)
+        if fields:
+            self._append(device_id, ts, fields)
+
+    def _append(self, device_id, ts, fields):
+        with self._lock(device_id):
+            series = self._series.setdefault(device_id, {})
+            for metric, value in fields:
+                buf = series.get(metric)
+                if buf is None:
+                    if len(series) >= TELEMETRY_MAX_METRICS:
+                        continue
+                    buf = series[metric] = RingBuffer(self.retention)
+                buf.append(ts, value)
+            if self.journal is not None:
+                self._applied[device_id] = self.journal.log('telemetry', 'append', device_id, ts, fields)
+
+    def series(self, device_id, metric, start=None, end=None):
+        """(timestamps, values) for one metric, oldest first, optionally limited to [start, end]"""
+        with self._lock(device_id):
+            buf = self._series.get(device_id, {}).get(metric)
+            if buf is None:
+                return None
+            ts, values = buf.arrays()
+        return _select_range(ts, values, start, end)
+
+    def metrics(self, device_id):
+        with self._lock(device_id):
+            return sorted(self._series.get(device_id, {}))
+
+    def devices(self):
+        return list(self._series)
+
+    def memory_bytes(self):
+        return sum(16 * buf.capacity for series in list(self._series.values()) for buf in list(series.values()))
+
+    def snapshot(self):
+        for device_id in list(self._series):
+            with self._lock(device_id):
+                state = [device_id, self._applied.get(device_id, 0),
+                         {metric: [a.tolist() for a in buf.arrays()] for metric, buf in self._series[device_id].items()}]
+            yield state
+
+    def restore(self, state):
+        device_id, self._applied[device_id], metrics = state
+        series = self._series[device_id] = {}
+        for metric, (ts, values) in metrics.items():
+            buf = series[metric] = RingBuffer(self.retention)
+            for point in zip(ts, values):
+                buf.append(*point)
+
+    def replay(self, lsn, op, args):
+        device_id, ts, fields = args
+        if lsn > self._applied.get(device_id, 0):
+            self._append(device_id, ts, fields)
+            self._applied[device_id] = lsn
+
+
+class SQLiteTelemetryStore:
+    """TelemetryStore backed by a SQLiteStore; each series is a ring of TELEMETRY_RETENTION slots"""
+
+    def __init__(self, store, retention=TELEMETRY_RETENTION):
+        self.store = store
+        self.retention = retention
+
+    def append(self, device_id, ts, payload):
+        fields = _numeric_fields(payload)
+        if not fields:
+            return
+        with self.store.transaction() as db:
+            seqs = dict(db.execute('SELECT metric, seq FROM telemetry_seq WHERE device_id = ?', (device_id,)).fetchall())
+            for metric, value in fields:
+                if metric not in seqs and len(seqs) >= TELEMETRY_MAX_METRICS:
+                    continue
+                seq = seqs.get(metric, 0)
+                seqs[metric] = seq + 1
+                db.execute('INSERT OR REPLACE INTO telemetry_seq (device_id, metric, seq) VALUES (?, ?, ?)',
+                           (device_id, metric, seq + 1))
+                db.execute('INSERT OR REPLACE INTO telemetry (device_id, metric, slot, ts, value) VALUES (?, ?, ?, ?, ?)',
+                           (device_id, metric, seq % self.retention, ts, value))
+
+    def series(self, device_id, metric, start=None, end=None):
+        rows = self.store.connect().execute(
+            'SELECT ts, value FROM telemetry WHERE device_id = ? AND metric = ? AND slot < ? '
+            'AND ts >= ? AND ts <= ? ORDER BY ts',
+            (device_id, metric, self.retention,
+             float('-inf') if start is None else start, float('inf') if end is None else end)
+        ).fetchall()
+        if not rows and metric not in self.metrics(device_id):
+            return None
+        ts = array('d', (r[0] for r in rows))
+        values = array('d', (r[1] for r in rows))
+        if np is not None:
+            return np.frombuffer(ts, dtype=np.float64), np.frombuffer(values, dtype=np.float64)
+        return ts, values
+
+    def metrics(self, device_id):
+        rows = self.store.connect().execute(
+            'SELECT metric FROM telemetry_seq WHERE device_id = ? ORDER BY metric', (device_id,)
+        ).fetchall()
+        return [r[0] for r in rows]
+
+    def devices(self):
+        return [r[0] for r in self.store.connect().execute('SELECT DISTINCT device_id FROM telemetry_seq').fetchall()]
+
+    def memory_bytes(self):
+        return 0
+
+
+def _aggregate(ts, values, start, step):
+    """
+    Bucket samples into fixed step-second windows starting at `start` and
+    return [{'t', 'min', 'max', 'avg', 'last', 'count'}] for non-empty buckets.
+    """
+    if len(ts) == 0:
+        return []
+    if np is not None:
+        order = np.argsort(ts, kind='stable')
+        ts, values = ts[order], values[order]
+        idx = ((ts - start) // step).astype(np.int64)
+        starts = np.flatnonzero(np.diff(idx, prepend=idx[0] - 1))
+        ends = np.append(starts[1:], len(ts))
+        counts = ends - starts
+        sums = np.add.reduceat(values, starts)
+        mins = np.minimum.reduceat(values, starts)
+        maxs = np.maximum.reduceat(values, starts)
+        lasts = values[ends - 1]
+        times = start + idx[starts] * step
+        return [
+            {'t': float(t), 'min': float(lo), 'max': float(hi), 'avg': float(total / n), 'last': float(last), 'count': int(n)}
+            for t, lo, hi, total, last, n in zip(times, mins, maxs, sums, lasts, counts)
+        ]
+    buckets = {}
+    for t, v in sorted(zip(ts, values)):
+        b = buckets.setdefault(int((t - start) // step), [v, v, 0.0, v, 0])
+        b[0], b[1], b[2], b[3], b[4] = min(b[0], v), max(b[1], v), b[2] + v, v, b[4] + 1
+    return [
+        {'t': start + i * step, 'min': lo, 'max': hi, 'avg': total / n, 'last': last, 'count': n}
+        for i, (lo, hi, total, last, n) in sorted(buckets.items())
+    ]
+
+
+def _lttb(ts, values, threshold):
+    """Largest-Triangle-Three-Buckets downsampling to at most `threshold` points"""
+    n = len(ts)
+    if threshold >= n or threshold < 3:
+        return [{'t': float(t), 'value': float(v)} for t, v in sorted(zip(ts, values))]
+    if np is not None:
+        order = np.argsort(ts, kind='stable')
+        ts, values = ts[order], values[order]
+    else:
+        pairs = sorted(zip(ts, values))
+        ts, values = [p[0] for p in pairs], [p[1] for p in pairs]
+    every = (n - 2) / (threshold - 2)
+    picked = [0]
+    a = 0
+    for i in range(threshold - 2):
+        # average point of the next bucket
+        nxt_start, nxt_end = int((i + 1) * every) + 1, min(int((i + 2) * every) + 1, n)
+        if np is not None:
+            avg_t, avg_v = ts[nxt_start:nxt_end].mean(), values[nxt_start:nxt_end].mean()
+        else:
+            span = nxt_end - nxt_start
+            avg_t, avg_v = sum(ts[nxt_start:nxt_end]) / span, sum(values[nxt_start:nxt_end]) / span
+        # point in this bucket forming the largest triangle with a and the average
+        cur_start, cur_end = int(i * every) + 1, int((i + 1) * every) + 1
+        if np is not None:
+            areas = np.abs((ts[a] - avg_t) * (values[cur_start:cur_end] - values[a])
+                           - (ts[a] - ts[cur_start:cur_end]) * (avg_v - values[a]))
+            a = cur_start + int(areas.argmax())
+        else:
+            a = max(range(cur_start, cur_end), key=lambda j: abs(
+                (ts[a] - avg_t) * (values[j] - values[a]) - (ts[a] - ts[j]) * (avg_v - values[a])))
+        picked.append(a)
+    picked.append(n - 1)
+    return [{'t': float(ts[j]), 'value': float(values[j])} for j in picked]
+
+
+# Command result retention
+RESULT_MAX_AGE = float(os.environ.get('RESULT_MAX_AGE', str(7 * 86400)))
+RESULT_MAX_ENTRIES = int(os.environ.get('RESULT_MAX_ENTRIES', '100000'))
+# total size of the in-memory store; sqlite keeps results on disk and is bounded by count and age
+RESULT_MAX_BYTES = int(os.environ.get('RESULT_MAX_BYTES', str(64 * 1024 * 1024)))
+# larger result payloads are replaced by a truncation marker
+RESULT_MAX_SIZE = int(os.environ.get('RESULT_MAX_SIZE', str(64 * 1024)))
+
+
+def _result_body(result):
+    """Serialized result payload, at most RESULT_MAX_SIZE bytes"""
+    body = json.dumps(result, default=str)
+    if len(body) > RESULT_MAX_SIZE:
+        body = json.dumps({'truncated': True, 'size': len(body)})
+    return body
+
+
+class ResultStore:
+    """
+    In-memory command results keyed by command_id, indexed by device and
+    broadcast. Results older than RESULT_MAX_AGE are dropped, and the oldest
+    go first once RESULT_MAX_ENTRIES or RESULT_MAX_BYTES is exceeded.
+    """
+
+    def __init__(self):
+        self._results = {}  # command_id -> record, oldest first
+        self._by_device = {}
+        self._by_broadcast = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _remove(self, command_id):
+        record = self._results.pop(command_id)
+        self._bytes -= record['_size']
+        for index, key in ((self._by_device, record['device_id']), (self._by_broadcast, record['broadcast_id'])):
+            ids = index.get(key)
+            if ids is not None:
+                ids.pop(command_id, None)
+                if not ids:
+                    del index[key]
+
+    def put(self, command_id, device_id, broadcast_id, command, status, result, now=None):
+        now = now or time.time()
+        body = _result_body(result)
+        record = {'command_id': command_id, 'device_id': device_id, 'broadcast_id': broadcast_id,
+                  'command': command, 'status': status, 'received_at': now, '_size': len(body), '_body': body}
+        with self._lock:
+            if command_id in self._results:
+                self._remove(command_id)  # a redelivered command reported twice: keep the latest
+            self._results[command_id] = record
+            self._bytes += record['_size']
+            self._by_device.setdefault(device_id, {})[command_id] = None
+            if broadcast_id:
+                self._by_broadcast.setdefault(broadcast_id, {})[command_id] = None
+            while self._results:
+                oldest = self._results[next(iter(self._results))]
+                if (len(self._results) <= RESULT_MAX_ENTRIES and self._bytes <= RESULT_MAX_BYTES
+                        and oldest['received_at'] > now - RESULT_MAX_AGE):
+                    break
+                self._remove(oldest['command_id'])
+
+    def _public(self, record):
+        out = {k: v for k, v in record.items() if not k.startswith('_')}
+        out['received_at'] = _iso(out['received_at'])
+        out['result'] = json.loads(record['_body'])
+        return out
+
+    def get(self, command_id):
+        with self._lock:
+            record = self._results.get(command_id)
+            return self._public(record) if record and record['received_at'] > time.time() - RESULT_MAX_AGE else None
+
+    def for_device(self, device_id, limit=50):
+        """Newest results of a device first"""
+        cutoff = time.time() - RESULT_MAX_AGE
+        with self._lock:
+            ids = list(self._by_device.get(device_id, ()))
+            records = [self._results[command_id] for command_id in reversed(ids)]
+            return [self._public(r) for r in records if r['received_at'] > cutoff][:limit]
+
+    def broadcast_counts(self, broadcast_id):
+        """Number of retained results of a broadcast per reported status"""
+        counts = {}
+        with self._lock:
+            for command_id in self._by_broadcast.get(broadcast_id, ()):
+                status = self._results[command_id]['status']
+                counts[status] = counts.get(status, 0) + 1
+        return counts
+
+
+class SQLiteResultStore:
+    """ResultStore backed by a SQLiteStore"""
+
+    # count-based pruning needs a COUNT(*), so it only runs every this many writes
+    PRUNE_EVERY = 100
+
+    def __init__(self, store):
+        self.store = store
+        self._writes = 0
+
+    def put(self, command_id, device_id, broadcast_id, command, status, result, now=None):
+        now = now or time.time()
+        body = _result_body(result)
+        self._writes += 1
+        with self.store.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO command_results '
+                       '(command_id, device_id, broadcast_id, command, status, received_at, size, result) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (command_id, device_id, broadcast_id, command, status, now, len(body), body))
+            db.execute('DELETE FROM command_results WHERE received_at <= ?', (now - RESULT_MAX_AGE,))
+            if self._writes % self.PRUNE_EVERY == 0:
+                db.execute('DELETE FROM command_results WHERE command_id IN (SELECT command_id FROM command_results '
+                           'ORDER BY received_at LIMIT MAX(0, (SELECT COUNT(*) FROM command_results) - ?))',
+                           (RESULT_MAX_ENTRIES,))
+
+    def _public(self, row):
+        command_id, device_id, broadcast_id, command, status, received_at, body = row
+        return {'command_id': command_id, 'device_id': device_id, 'broadcast_id': broadcast_id, 'command': command,
+                'status': status, 'received_at': _iso(received_at), 'result': json.loads(body)}
+
+    _COLUMNS = 'command_id, device_id, broadcast_id, command, status, received_at, result'
+
+    def get(self, command_id):
+        row = self.store.connect().execute(
+            f'SELECT {self._COLUMNS} FROM command_results WHERE command_id = ? AND received_at > ?',
+            (command_id, time.time() - RESULT_MAX_AGE)
+        ).fetchone()
+        return self._public(row) if row else None
+
+    def for_device(self, device_id, limit=50):
+        rows = self.store.connect().execute(
+            f'SELECT {self._COLUMNS} FROM command_results WHERE device_id = ? AND received_at > ? '
+            'ORDER BY received_at DESC LIMIT ?',
+            (device_id, time.time() - RESULT_MAX_AGE, limit)
+        ).fetchall()
+        return [self._public(row) for row in rows]
+
+    def broadcast_counts(self, broadcast_id):
+        return dict(self.store.connect().execute(
+            'SELECT status, COUNT(*) FROM command_results WHERE broadcast_id = ? GROUP BY status', (broadcast_id,)
+        ).fetchall())
+
+
+# Durability for the in-memory backend: registrations, telemetry and command
+# queue changes go to an append-only write-ahead log in STATE_WAL_DIR (unset:
+# nothing is persisted). Batches are fsynced once every WAL_FLUSH_INTERVAL
+# seconds; a snapshot is written every WAL_SNAPSHOT_INTERVAL seconds or
+# WAL_SNAPSHOT_BYTES of log, after which older log segments are deleted.
+STATE_WAL_DIR = os.environ.get('STATE_WAL_DIR', '')
+WAL_FLUSH_INTERVAL = float(os.environ.get('WAL_FLUSH_INTERVAL', '0.05'))
+WAL_SNAPSHOT_INTERVAL = float(os.environ.get('WAL_SNAPSHOT_INTERVAL', '300'))
+WAL_SNAPSHOT_BYTES = int(os.environ.get('WAL_SNAPSHOT_BYTES', str(32 * 1024 * 1024)))
+# how long a new worker waits for the previous one (reload) to release the log
+WAL_LOCK_TIMEOUT = float(os.environ.get('WAL_LOCK_TIMEOUT', '60'))
+
+# every log and snapshot record is framed as <length><crc32><JSON body>
+_WAL_FRAME = struct.Struct('<II')
+
+
+def _wal_frame(record):
+    body = json.dumps(record, separators=(',', ':'), default=str).encode()
+    return _WAL_FRAME.pack(len(body), zlib.crc32(body)) + body
+
+
+def _wal_records(path):
+    """
+    Decode the frames of a log or snapshot file through mmap; returns
+    (records, offset after the last intact frame). A torn or corrupt tail
+    (crash mid-write) ends the file.
+    """
+    size = os.path.getsize(path)
+    records, offset = [], 0
+    if size == 0:
+        return records, offset
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        while offset + _WAL_FRAME.size <= size:
+            length, crc = _WAL_FRAME.unpack_from(m, offset)
+            start = offset + _WAL_FRAME.size
+            body = m[start:start + length]
+            if len(body) < length or zlib.crc32(body) != crc:
+                break
+            records.append(json.loads(body))
+            offset = start + length
+    return records, offset
+
+
+def _fsync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal:
+    """
+    Write-ahead log of the in-memory backend. log() only stamps a change with
+    the next LSN and appends it to a deque, so requests never touch the disk;
+    a writer thread writes everything that accumulated as one batch with a
+    single fsync (group commit). Snapshots are taken while requests continue:
+    each component remembers per key the LSN of the last change it applied,
+    and replay skips the changes a snapshot already contains. Components
+    (registry, telemetry) provide snapshot(), restore(state) and
+    replay(lsn, op, args).
+    """
+
+    def __init__(self, directory, components):
+        self.directory = directory
+        self.components = components
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = None
+        self._pending = deque()
+        self._lsn = itertools.count(1)
+        self._segment = 1
+        self._bytes = 0  # logged since the last snapshot
+        self.recovered = None
+        self.last_snapshot = None
+        self._reset()
+
+    def _reset(self):
+        # also called in a forked child: the writer thread and file are per process
+        self._thread = None
+        self._file = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._snapshotting = False
+
+    def _path(self, kind, number):
+        return os.path.join(self.directory, f"{kind}-{number:010d}.{'log' if kind == 'wal' else 'snap'}")
+
+    def _numbered(self, kind):
+        suffix = '.log' if kind == 'wal' else '.snap'
+        return sorted(int(name[len(kind) + 1:-len(suffix)]) for name in os.listdir(self.directory)
+                      if name.startswith(kind + '-') and name.endswith(suffix))
+
+    def log(self, component, op, *args):
+        lsn = next(self._lsn)
+        self._pending.append((lsn, component, op) + args)
+        return lsn
+
+    def recover(self):
+        """Load the newest complete snapshot and replay the log segments written after it"""
+        started = time.monotonic()
+        base, last_lsn, restored, replayed = 0, 0, 0, 0
+        for number in reversed(self._numbered('snapshot')):
+            records, _ = _wal_records(self._path('snapshot', number))
+            if len(records) < 2 or records[0][0] != 'header' or records[-1][0] != 'end':
+                logger.warning(f"Ignoring incomplete snapshot {number}")
+                continue
+            base, last_lsn = number, records[-1][1]
+            for component, state in records[1:-1]:
+                self.components[component].restore(state)
+            restored = len(records) - 2
+            break
+        segments = [n for n in self._numbered('wal') if n > base]
+        for number in segments:
+            path = self._path('wal', number)
+            records, end = _wal_records(path)
+            for lsn, component, op, *args in records:
+                self.components[component].replay(lsn, op, args)
+                last_lsn = max(last_lsn, lsn)
+            replayed += len(records)
+            self._bytes += end
+            if end < os.path.getsize(path):
+                logger.warning(f"Truncating torn tail of {path} at byte {end}")
+                os.truncate(path, end)
+        self._lsn = itertools.count(last_lsn + 1)
+        self._segment = max(segments + [base]) + 1
+        self.recovered = {'snapshot_records': restored, 'log_records': replayed,
+                          'seconds': round(time.monotonic() - started, 3)}
+        logger.info(f"Recovered state from {self.directory}: {self.recovered}")
+
+    def _acquire(self, timeout):
+        # one writer per directory: a second process would interleave entries with colliding
+        # LSNs. A worker replacing another (reload) waits until the old one has flushed and exited.
+        if self._lock_file is None:
+            self._lock_file = open(os.path.join(self.directory, 'LOCK'), 'a')
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except OSError:
+                if time.monotonic() >= deadline:
+                    raise RuntimeError(f"Write-ahead log {self.directory} is in use by another process "
+                                       "(the memory backend with STATE_WAL_DIR needs a single worker)")
+                time.sleep(0.1)
+
+    def start(self, lock_timeout=WAL_LOCK_TIMEOUT):
+        """
+        Take the directory lock, recover, attach the components and start the
+        writer; requests arriving meanwhile wait here for the recovered state
+        """
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._acquire(lock_timeout)
+                if self.recovered is None:
+                    self.recover()
+                for component in self.components.values():
+                    component.journal = self
+                self._file = open(self._path('wal', self._segment), 'ab')
+                self._last_snapshot_at = time.monotonic()
+                self._thread = threading.Thread(target=self._run, name='wal-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(WAL_FLUSH_INTERVAL):
+            try:
+                self.flush()
+                due = self._bytes >= WAL_SNAPSHOT_BYTES or (
+                    self._bytes and time.monotonic() - self._last_snapshot_at >= WAL_SNAPSHOT_INTERVAL)
+                if due and not self._snapshotting:
+                    self._rotate()
+            except Exception as e:
+                logger.error(f"Write-ahead log flush failed: {e}")
+
+    def flush(self):
+        """Write and fsync every pending change (one batch)"""
+        with self._lock:
+            if self._file is None:
+                return
+            batch = []
+            while self._pending:
+                batch.append(_wal_frame(self._pending.popleft()))
+            if not batch:
+                return
+            data = b''.join(batch)
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._bytes += len(data)
+
+    def _rotate(self):
+        # changes logged up to here are in segments <= covered and already applied
+        # in memory, so the snapshot taken next contains them all
+        with self._lock:
+            self._file.close()
+            covered = self._segment
+            self._segment += 1
+            self._file = open(self._path('wal', self._segment), 'ab')
+            self._bytes = 0
+            self._last_snapshot_at = time.monotonic()
+            self._snapshotting = True
+        threading.Thread(target=self._snapshot, args=(covered,), name='wal-snapshot', daemon=True).start()
+
+    def _snapshot(self, covered):
+        started = time.monotonic()
+        path = self._path('snapshot', covered)
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                f.write(_wal_frame(['header', {'created_at': time.time()}]))
+                count = 0
+                for name, component in self.components.items():
+                    for state in component.snapshot():
+                        f.write(_wal_frame([name, state]))
+                        count += 1
+                # no change contained in the snapshot has a higher LSN; new ones continue after it
+                f.write(_wal_frame(['end', next(self._lsn)]))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+            _fsync_dir(self.directory)
+            for number in self._numbered('wal'):
+                if number <= covered:
+                    os.remove(self._path('wal', number))
+            for number in self._numbered('snapshot'):
+                if number < covered:
+                    os.remove(self._path('snapshot', number))
+            self.last_snapshot = time.time()
+            logger.info(f"Snapshot {covered}: {count} records in {time.monotonic() - started:.2f}s")
+        except Exception as e:
+            logger.error(f"Snapshot {covered} failed: {e}")
+        finally:
+            self._snapshotting = False
+
+    def close(self):
+        """Stop the writer and flush what is left (process exit)"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def status(self):
+        return {
+            'segment': self._segment,
+            'pending': len(self._pending),
+            'log_bytes': self._bytes,
+            'last_snapshot': _iso(self.last_snapshot),
+            'recovered': self.recovered
+        }
 
 
+def _make_state_backend():
+    if STATE_BACKEND == 'sqlite':
+        store = SQLiteStore(STATE_SQLITE_PATH)
+        logger.info(f"Using shared SQLite state backend at {STATE_SQLITE_PATH}")
+        return (SQLiteDeviceRegistry(store), SQLiteStateTracker(store), SQLiteTelemetryStore(store),
+                SQLiteResultStore(store), None)
+    if STATE_BACKEND != 'memory':
+        raise ValueError(f"Unknown STATE_BACKEND: {STATE_BACKEND}")
+    registry, telemetry = DeviceRegistry(), TelemetryStore()
+    journal = None
+    if STATE_WAL_DIR:
+        # locked and recovered by journal.start() in the serving worker (first request)
+        journal = Journal(STATE_WAL_DIR, {'registry': registry, 'telemetry': telemetry})
+        os.register_at_fork(after_in_child=journal._reset)
+        atexit.register(journal.close)
+    return registry, StateTracker(), telemetry, ResultStore(), journal
 
-# Kubernetes client
-from kubernetes import client, config
-from kubernetes.client.rest import ApiException
 
-app = Flask(__name__)
+registry, state_tracker, telemetry, results, journal = _make_state_backend()
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Set once the server starts draining (SIGTERM during a rollout)
+shutting_down = threading.Event()
 
-# In-memory storage for custom edge devices and command queues (keeps backward compatibility)
-edge_devices = {}
-command_queue = {}
 
-# Try to load kubeconfig (first tries in-cluster, then fallback path)
-k8s = None
-try:
-    config.load_incluster_config()
-    logger.info("Loaded in-cluster Kubernetes config")
-except Exception:
-    try:
-        kubeconf = os.path.expanduser("~/.kube/config")
-        config.load_kube_config(kubeconf)
-        logger.info(f"Loaded kubeconfig from {kubeconf}")
-    except Exception as e:
-        logger.warning("Could not load any Kubernetes config: " + str(e))
+def begin_shutdown():
+    """
+    Let in-flight requests finish quickly: parked long-polls return what is
+    queued, push streams close (dashboards fall back to polling another
+    replica), and /health reports 503 so no new traffic is routed here.
+    """
+    if shutting_down.is_set():
+        return
+    shutting_down.set()
+    logger.info("Shutting down: draining long-polls and push streams")
+    registry.wake_all()
+    event_broker.close_all()
+    LogStream.close_all()
 
-if config and hasattr(config, "load_kube_config"):
-    try:
-        k8s = client.CoreV1Api()
-    except Exception as e:
-        logger.warning("Failed to create CoreV1Api client: " + str(e))
+
+class LivenessMonitor:
+    """
+    Background thread that expires silent devices every LIVENESS_TICK and
+    announces each transition: a device_status event for dashboards, a
+    state version bump for pollers and a log line (WARNING when a device
+    goes offline) for alerting.
+    """
+
+    def __init__(self, tick=LIVENESS_TICK):
+        self.tick = tick
+        self._reset()
+
+    def _reset(self):
+        # also called in a forked child, where the parent's thread does not exist
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='liveness', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not shutting_down.wait(self.tick):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Liveness sweep failed: {e}")
+
+    def sweep(self, now=None):
+        transitions = registry.expire_liveness(now)
+        for device_id, previous, status, last_seen in transitions:
+            state_tracker.bump(device_id)
+            event_broker.publish('device_status', {
+                'device_id': device_id,
+                'status': status,
+                'previous_status': previous,
+                'last_seen': _iso(last_seen)
+            })
+            log = logger.warning if status == 'offline' else logger.info
+            log(f"Edge device {device_id} is {status} (was {previous}, last seen {_iso(last_seen)})")
+        return transitions
+
+
+liveness_monitor = LivenessMonitor()
+os.register_at_fork(after_in_child=liveness_monitor._reset)
+
+
+@app.before_request
+def _start_background_threads():
+    # started by the first request, so they run in the serving worker rather than a preloading master;
+    # the journal first, so nothing changes state before it is recovered
+    if journal is not None:
+        journal.start()
+    liveness_monitor.start()
+    metrics.start()
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _count_request(response):
+    started = g.get('request_started')
+    if started is not None:
+        # the URL rule, not the path, so device and command IDs do not become label values
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.inc('http_requests_total', _metric_labels(route=route, method=request.method, status=response.status_code))
+        metrics.observe('http_request_duration_seconds', _metric_labels(route=route), time.perf_counter() - started)
+    return response
 
 # HTML Dashboard Template (your full UI — unchanged)
 DASHBOARD_HTML = """
@@ -336,7 +3191,7 @@ DASHBOARD_HTML = """
         </div>
 
         <div class="refresh-info">
-            Auto-refreshing every 3 seconds • Last updated: <span id="lastUpdate">-</span>
+            <span id="refreshMode">Connecting to live stream...</span> • Last updated: <span id="lastUpdate">-</span>
         </div>
     </div>
 
@@ -345,19 +3200,112 @@ DASHBOARD_HTML = """
         let commandCount = 0;
         let activityLog = [];
 
+        // Local copy of the device list, kept current by /api/stream events
+        let devicesById = new Map();
+        let totalMessages = 0;
+        let eventSource = null;
+        let pollTimer = null;
+        let renderPending = false;
+
+        function applySnapshot(data) {
+            devicesById = new Map(data.devices.map(d => [d.device_id, d]));
+            totalMessages = data.total_messages;
+            scheduleRender();
+        }
+
+        function scheduleRender() {
+            if (renderPending) return;
+            renderPending = true;
+            requestAnimationFrame(() => {
+                renderPending = false;
+                const devices = Array.from(devicesById.values());
+                updateDeviceList(devices);
+                updateStats({device_count: devices.length, total_messages: totalMessages});
+                updateLastUpdateTime();
+            });
+        }
+
         async function fetchDashboardData() {
             try {
                 const response = await fetch('/api/dashboard-data');
                 const data = await response.json();
-                
-                updateDeviceList(data.devices);
-                updateStats(data);
-                updateLastUpdateTime();
+                applySnapshot(data);
             } catch (error) {
                 console.error('Error fetching data:', error);
             }
         }
 
+        function startPolling() {
+            if (pollTimer) return;
+            document.getElementById('refreshMode').textContent = 'Live stream unavailable, polling every 3 seconds';
+            pollTimer = setInterval(fetchDashboardData, 3000);
+            fetchDashboardData();
+        }
+
+        function stopPolling() {
+            if (pollTimer) {
+                clearInterval(pollTimer);
+                pollTimer = null;
+            }
+            document.getElementById('refreshMode').textContent = 'Live updates';
+        }
+
+        function startStream() {
+            if (!window.EventSource) {
+                startPolling();
+                return;
+            }
+            eventSource = new EventSource('/api/stream');
+            eventSource.addEventListener('snapshot', e => {
+                applySnapshot(JSON.parse(e.data));
+                stopPolling();
+            });
+            // changes made by other workers (shared backend): authoritative device state
+            eventSource.addEventListener('delta', e => {
+                const data = JSON.parse(e.data);
+                data.devices.forEach(d => devicesById.set(d.device_id, d));
+                data.removed.forEach(id => devicesById.delete(id));
+                totalMessages = data.total_messages;
+                scheduleRender();
+            });
+            eventSource.addEventListener('device_added', e => {
+                const device = JSON.parse(e.data);
+                if (!devicesById.has(device.device_id)) totalMessages += (device.data_history || []).length;
+                devicesById.set(device.device_id, device);
+                addActivityLog(`Device connected: ${device.device_id}`, 'info');
+                scheduleRender();
+            });
+            eventSource.addEventListener('device_removed', e => {
+                const data = JSON.parse(e.data);
+                devicesById.delete(data.device_id);
+                addActivityLog(`Device removed: ${data.device_id}`, 'info');
+                scheduleRender();
+            });
+            eventSource.addEventListener('device_status', e => {
+                const data = JSON.parse(e.data);
+                const device = devicesById.get(data.device_id) || {device_id: data.device_id, data_history: []};
+                devicesById.set(data.device_id, Object.assign(device, data));
+                scheduleRender();
+            });
+            eventSource.addEventListener('telemetry', e => {
+                const point = JSON.parse(e.data);
+                const device = devicesById.get(point.device_id);
+                if (!device) return;
+                // the server counts retained samples (the last 20 per device), not every message
+                if ((device.data_history || []).length < 20) totalMessages++;
+                device.data_history = (device.data_history || []).concat([{timestamp: point.timestamp, payload: point.payload}]).slice(-20);
+                device.last_seen = point.timestamp;
+                device.status = 'online';
+                scheduleRender();
+            });
+            eventSource.addEventListener('command_queued', e => {
+                const cmd = JSON.parse(e.data);
+                addActivityLog(`Command queued for ${cmd.device_id}: ${cmd.command}`, 'command');
+            });
+            // EventSource reconnects by itself; poll until the next snapshot arrives
+            eventSource.onerror = () => startPolling();
+        }
+
         function updateDeviceList(devices) {
             const deviceList = document.getElementById('deviceList');
             const deviceSelect = document.getElementById('deviceSelect');
@@ -518,11 +3466,8 @@ DASHBOARD_HTML = """
             }
         }
 
-        // Auto-refresh every 3 seconds
-        setInterval(fetchDashboardData, 3000);
-        
-        // Initial load
-        fetchDashboardData();
+        // Live updates via Server-Sent Events, falling back to polling
+        startStream();
     </script>
 </body>
 </html>
@@ -556,171 +3501,951 @@ def _k8s_node_to_device(node):
         "data_history": []  # no telemetry from k8s nodes; keep field for UI compatibility
     }
 
-@app.route('/api/dashboard-data')
-def get_dashboard_data():
+# Helper: turn node informer changes into dashboard stream events
+def _on_node_event(etype, old, new):
+    if etype == 'DELETED':
+        state_tracker.bump(old.metadata.name, removed=True)
+        event_broker.publish('device_removed', {'device_id': old.metadata.name})
+        return
+    device = _k8s_node_to_device(new)
+    if etype == 'ADDED':
+        state_tracker.bump(device['device_id'])
+        event_broker.publish('device_added', device)
+        return
+    old_device = _k8s_node_to_device(old)
+    # heartbeat-only node updates do not change what we serve
+    if old_device != device:
+        state_tracker.bump(device['device_id'])
+    if old_device['status'] != device['status']:
+        event_broker.publish('device_status', {
+            'device_id': device['device_id'],
+            'status': device['status'],
+            'last_seen': device['last_seen']
+        })
+
+node_informer.add_handler(_on_node_event)
+
+def _lookup_device(device_id):
+    """Registered edge device or cached k8s node as a device dict, or None"""
+    device = registry.get(device_id)
+    if device is not None:
+        return device
+    n = node_informer.get(device_id)
+    if n is not None:
+        return _k8s_node_to_device(n)
+    return None
+
+# Serialized response bodies keyed by endpoint, reused while the state version is unchanged
+_response_cache = {}
+
+def _versioned_response(name, build_payload, build_delta):
+    """
+    Serve a JSON payload tied to the state version:
+      - If-None-Match with the current ETag -> 304
+      - ?since=<version> -> build_delta(changed_ids, removed_ids)
+      - otherwise the full payload, serialized once per version
+    """
+    version = state_tracker.version
+    etag = state_tracker.etag(version)
+    headers = {'ETag': f'"{etag}"', 'X-State-Version': str(version)}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    since = request.args.get('since', type=int)
+    if since is not None:
+        delta = state_tracker.changed_since(since)
+        if delta is not None:
+            payload = build_delta(*delta)
+            payload.update({'version': version, 'since': since, 'full': False})
+            return Response(app.json.dumps(payload), mimetype='application/json', headers=headers)
+
+    cached = _response_cache.get(name)
+    if cached is not None and cached[0] == version:
+        body = cached[1]
+    else:
+        payload = build_payload()
+        payload.update({'version': version, 'full': True})
+        body = app.json.dumps(payload)
+        _response_cache[name] = (version, body)
+    return Response(body, mimetype='application/json', headers=headers)
+
+def _dashboard_payload():
     """
     Dashboard returns a combined list:
-    - Registered custom edge devices (edge_devices dict)
+    - Registered custom edge devices (device registry)
     - Kubernetes nodes (k8s)
     This lets your UI show both the IoT devices and cluster nodes.
     """
     devices = []
 
     # 1) add registered custom devices (first, so they appear)
-    for d in edge_devices.values():
+    for d in registry.list():
         devices.append(d)
 
-    # 2) add Kubernetes nodes (if k8s client available)
-    if k8s:
-        try:
-            nodes = k8s.list_node().items
-            for n in nodes:
-                devices.append(_k8s_node_to_device(n))
-        except Exception as e:
-            logger.warning("Cannot list K8s nodes: " + str(e))
-
-    total_messages = sum(len(d.get("data_history", [])) for d in devices)
+    # 2) add Kubernetes nodes from the informer cache (empty if no k8s client)
+    for n in node_informer.list():
+        devices.append(_k8s_node_to_device(n))
 
-    return jsonify({
+    return {
         "devices": devices,
         "device_count": len(devices),
-        "total_messages": total_messages,
+        "total_messages": registry.total_messages(),
+        "node_cache": node_informer.status(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+def _dashboard_delta(changed, removed):
+    devices = [d for d in (_lookup_device(device_id) for device_id in changed) if d is not None]
+    node_count = len(node_informer.list())
+    return {
+        "devices": devices,
+        "removed": removed,
+        "device_count": len(registry) + node_count,
+        "total_messages": registry.total_messages(),
+        "node_cache": node_informer.status(),
         "timestamp": datetime.now().isoformat()
+    }
+
+@app.route('/api/dashboard-data')
+def get_dashboard_data():
+    """Dashboard payload with ETag revalidation and ?since=<version> deltas"""
+    return _versioned_response('dashboard', _dashboard_payload, _dashboard_delta)
+
+def _stream_update(since):
+    """(version, SSE event) bringing a stream from `since` to the current state: a delta, or a snapshot if too far behind"""
+    version = state_tracker.version
+    delta = state_tracker.changed_since(since)
+    if delta is None:
+        event, payload = 'snapshot', _dashboard_payload()
+    else:
+        event, payload = 'delta', _dashboard_delta(*delta)
+    payload.update({'version': version, 'since': since})
+    return version, f"event: {event}\ndata: {json.dumps(payload, default=str)}\n\n"
+
+@app.route('/api/stream')
+def api_stream():
+    """
+    Server-Sent Events push stream for the dashboard.
+    Sends one 'snapshot' event (same shape as /api/dashboard-data), then
+    incremental events: device_added, device_removed, device_status,
+    telemetry and command_queued.
+    Events are published by the worker that made the change, so with the
+    shared SQLite backend the stream also checks the state version every
+    SQLITE_POLL_INTERVAL and sends a 'delta' event (the ?since= payload of
+    /api/dashboard-data) for changes made by other workers.
+    """
+    q = event_broker.subscribe()
+    if q is None:
+        return jsonify({'error': 'Too many open streams, poll /api/dashboard-data instead'}), 503
+    shared = STATE_BACKEND == 'sqlite'
+    version = state_tracker.version
+    snapshot = json.dumps(_dashboard_payload(), default=str)
+
+    def generate():
+        seen = version
+        last_sent = time.monotonic()
+        try:
+            yield f"retry: 3000\nevent: snapshot\ndata: {snapshot}\n\n"
+            while True:
+                try:
+                    message = q.get(timeout=SQLITE_POLL_INTERVAL if shared else STREAM_HEARTBEAT)
+                except queue.Empty:
+                    message = ''
+                if message is None:
+                    return
+                if shared and state_tracker.version != seen:
+                    seen, update = _stream_update(seen)
+                    message += update
+                if not message and (not shared or time.monotonic() - last_sent >= STREAM_HEARTBEAT):
+                    message = ": keepalive\n\n"
+                if message:
+                    last_sent = time.monotonic()
+                    yield message
+        finally:
+            event_broker.unsubscribe(q)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
     })
 
 @app.route('/health', methods=['GET'])
 def health():
-    """Health check endpoint"""
+    """Health check endpoint (503 while draining so readiness probes take the pod out)"""
+    if shutting_down.is_set():
+        return jsonify({'status': 'draining', 'service': 'master-app', 'timestamp': datetime.now().isoformat()}), 503
     return jsonify({
         'status': 'healthy',
         'service': 'master-app',
+        'node_cache': node_informer.status(),
+        'pod_cache': pod_informer.status(),
+        'k8s_api': k8s_gateway.status(),
+        'wal': journal.status() if journal is not None else None,
         'timestamp': datetime.now().isoformat()
     }), 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text format: counters and histograms summed over workers, gauges read from live state"""
+    counters, histograms = metrics.collect()
+    series = {name: [] for name in METRIC_FAMILIES}
+
+    def sample(name, labels, value, family=None):
+        series[family or name].append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+    for (name, labels), value in sorted(counters.items()):
+        sample(name, labels, value)
+    for (name, labels), h in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), h):
+            cumulative += count
+            series[name].append(f'{name}_bucket{{{labels + "," if labels else ""}le="{bound}"}} {cumulative}')
+        sample(name + '_sum', labels, h[-1], family=name)
+        sample(name + '_count', labels, cumulative, family=name)
+
+    sample('edge_devices', '', len(registry))
+    sample('edge_messages_retained', '', registry.total_messages())
+    depths = registry.queue_depths()
+    for device_id, depth in sorted(depths.items()):
+        sample('command_queue_depth', _metric_labels(device_id=device_id), depth)
+    sample('command_queue_depth_total', '', sum(depths.values()))
+    for cache, informer in (('nodes', node_informer), ('pods', pod_informer)):
+        status = informer.status()
+        if status['age_seconds'] is not None:
+            sample('k8s_cache_age_seconds', _metric_labels(cache=cache), status['age_seconds'])
+        sample('k8s_cache_objects', _metric_labels(cache=cache), status['count'])
+    # per process: the worker that answered this scrape
+    sample('stream_subscribers', '', event_broker.subscriber_count)
+    sample('longpoll_parked', '', registry.parked)
+    if journal is not None:
+        sample('wal_pending_records', '', journal.status()['pending'])
+
+    lines = []
+    for name, (kind, help_text) in METRIC_FAMILIES.items():
+        if series[name]:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"] + series[name]
+    return Response('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Edge wire formats: JSON (default), msgpack or CBOR, optionally gzip-compressed
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+CBOR_MIMETYPES = ('application/cbor',)
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonl', 'application/x-jsonlines')
+# decompressed request bodies larger than this are rejected (gzip bomb guard)
+MAX_DECODED_BODY = int(os.environ.get('MAX_DECODED_BODY', str(16 * 1024 * 1024)))
+# longest single record accepted in a newline-delimited batch body
+NDJSON_MAX_LINE = int(os.environ.get('NDJSON_MAX_LINE', str(1024 * 1024)))
+# responses smaller than this are not worth compressing
+GZIP_MIN_SIZE = int(os.environ.get('GZIP_MIN_SIZE', '512'))
+
+
+class PayloadError(ValueError):
+    """Request body that cannot be decoded; carries the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+@app.errorhandler(PayloadError)
+def _payload_error(e):
+    return jsonify({'error': str(e)}), e.status
+
+def _request_gzipped():
+    encoding = request.headers.get('Content-Encoding', '').strip().lower()
+    if encoding in ('', 'identity'):
+        return False
+    if encoding in ('gzip', 'x-gzip'):
+        return True
+    raise PayloadError(f'Unsupported Content-Encoding: {encoding}', 415)
+
+def _request_body():
+    """Raw request bytes with any Content-Encoding removed"""
+    raw = request.get_data(cache=True)
+    if not _request_gzipped():
+        return raw
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        body = d.decompress(raw, MAX_DECODED_BODY)
+    except zlib.error as e:
+        raise PayloadError(f'Invalid gzip body: {e}')
+    if d.unconsumed_tail:
+        raise PayloadError('Decompressed body too large', 413)
+    return body
+
+def _json_compatible(value):
+    """
+    A decoded msgpack/CBOR value as JSON types, so it can be stored and served
+    like a JSON body: binary as base64 text, sets and tuples as lists, dates
+    as ISO-8601. Anything else (extension types, CBOR tags) -> PayloadError.
+    """
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, dict):
+        out = {}
+        for key, item in value.items():
+            # JSON object keys are text (and Flask sorts them, so they must not mix types)
+            if isinstance(key, (bytes, bytearray)):
+                key = base64.b64encode(key).decode('ascii')
+            elif key is None or isinstance(key, (bool, int, float)):
+                key = json.dumps(key)
+            elif not isinstance(key, str):
+                raise PayloadError(f'Unsupported map key in body: {type(key).__name__}')
+            out[key] = _json_compatible(item)
+        return out
+    if msgpack is not None and isinstance(value, msgpack.ExtType):
+        raise PayloadError(f'Unsupported msgpack extension type {value.code} in body')
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [_json_compatible(v) for v in value]
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode('ascii')
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise PayloadError(f'Unsupported value in body: {type(value).__name__}')
+
+def _decoded(value):
+    try:
+        return _json_compatible(value)
+    except RecursionError:
+        raise PayloadError('Body nested too deeply')
+
+def _request_payload():
+    """
+    Decode the request body according to Content-Type/Content-Encoding:
+    application/json (default), application/msgpack or application/cbor.
+    Returns None for an empty body.
+    """
+    mimetype = request.mimetype
+    if mimetype in MSGPACK_MIMETYPES:
+        if msgpack is None:
+            raise PayloadError('msgpack support not installed', 415)
+        body = _request_body()
+        try:
+            value = msgpack.unpackb(body, raw=False) if body else None
+        except Exception as e:
+            raise PayloadError(f'Invalid msgpack body: {e}')
+        return _decoded(value)
+    if mimetype in CBOR_MIMETYPES:
+        if cbor2 is None:
+            raise PayloadError('CBOR support not installed', 415)
+        body = _request_body()
+        try:
+            value = cbor2.loads(body) if body else None
+        except Exception as e:
+            raise PayloadError(f'Invalid CBOR body: {e}')
+        return _decoded(value)
+    if not _request_gzipped():
+        # plain JSON keeps Flask's own parsing and error handling
+        return request.json
+    body = _request_body()
+    try:
+        return json.loads(body) if body else None
+    except ValueError as e:
+        raise PayloadError(f'Invalid JSON body: {e}')
+
+def _request_object():
+    data = _request_payload() or {}
+    if not isinstance(data, dict):
+        raise PayloadError('Request body must be an object')
+    return data
+
+def _negotiated_response(payload, status=200):
+    """Serialize payload as JSON, msgpack or CBOR per Accept, gzip it per Accept-Encoding"""
+    offered = ['application/json']
+    if msgpack is not None:
+        offered.append('application/msgpack')
+    if cbor2 is not None:
+        offered.append('application/cbor')
+    mimetype = request.accept_mimetypes.best_match(offered, default='application/json')
+    if mimetype == 'application/msgpack':
+        body = msgpack.packb(payload, use_bin_type=True, default=str)
+    elif mimetype == 'application/cbor':
+        body = cbor2.dumps(payload, default=lambda encoder, value: encoder.encode(str(value)))
+    else:
+        body = app.json.dumps(payload).encode()
+    headers = {'Vary': 'Accept, Accept-Encoding'}
+    if len(body) >= GZIP_MIN_SIZE and 'gzip' in request.accept_encodings:
+        body = gzip.compress(body, compresslevel=5)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(body, status=status, mimetype=mimetype, headers=headers)
+
 @app.route('/edge/register', methods=['POST'])
 def register_edge():
     """Register an edge device (legacy / optional)"""
-    data = request.json or {}
-    device_id = data.get('device_id')
-    if not device_id:
+    data = _request_object()
+    if not data.get('device_id'):
         return jsonify({'error': 'device_id required'}), 400
+    device_id = str(data['device_id'])
 
-    edge_devices[device_id] = {
-        'device_id': device_id,
-        'registered_at': datetime.now().isoformat(),
-        'last_seen': datetime.now().isoformat(),
-        'status': 'online',
-        'metadata': data.get('metadata', {}),
-        'data_history': edge_devices.get(device_id, {}).get('data_history', [])
-    }
-    command_queue[device_id] = command_queue.get(device_id, [])
-    logger.info(f"Edge device registered: {device_id}")
+    device, created = registry.register(device_id, data.get('metadata', {}))
+    state_tracker.bump(device_id)
+    event_broker.publish('device_added' if created else 'device_status', device)
+    logger.info("Edge device registered: %s", device_id, extra={'device_id': device_id})
     return jsonify({'message': 'Device registered successfully', 'device_id': device_id}), 201
 
+# Upper bound on records accepted by one /edge/data/batch request
+BATCH_MAX_RECORDS = int(os.environ.get('BATCH_MAX_RECORDS', '10000'))
+# Device timestamps are accepted from EDGE_MAX_RECORD_AGE seconds in the past
+# (data buffered while offline) up to EDGE_MAX_CLOCK_SKEW seconds in the future
+EDGE_MAX_RECORD_AGE = float(os.environ.get('EDGE_MAX_RECORD_AGE', str(365 * 24 * 3600)))
+EDGE_MAX_CLOCK_SKEW = float(os.environ.get('EDGE_MAX_CLOCK_SKEW', str(24 * 3600)))
+
+def _record_time(value, now=None):
+    """Device timestamp (epoch or ISO-8601) -> epoch seconds near now; None passes through, raises ValueError"""
+    try:
+        ts = _parse_time(value)
+    except (ValueError, OverflowError, OSError):
+        raise ValueError('timestamp must be epoch seconds or ISO-8601')
+    if ts is None:
+        return None
+    now = now or time.time()
+    if not (now - EDGE_MAX_RECORD_AGE <= ts <= now + EDGE_MAX_CLOCK_SKEW):
+        raise ValueError('timestamp out of range')
+    try:
+        # everything stored is rendered with _iso() later
+        datetime.fromtimestamp(ts)
+    except (ValueError, OverflowError, OSError):
+        raise ValueError('timestamp out of range')
+    return ts
+
+def _parse_record(record, now=None):
+    """Validate one telemetry record; returns (device_id, payload, ts) or raises ValueError"""
+    if not isinstance(record, dict):
+        raise ValueError('record must be an object')
+    device_id = record.get('device_id')
+    if not device_id or not isinstance(device_id, str):
+        raise ValueError('device_id required')
+    payload = record.get('payload', {})
+    if not isinstance(payload, dict):
+        raise ValueError('payload must be an object')
+    return device_id, payload, _record_time(record.get('timestamp'), now)
+
+def _ingest(device_id, payload, ts=None, now=None):
+    """
+    Store one sample (device-side timestamp preserved) and notify dashboards;
+    returns the record ID
+    """
+    now = now or time.time()
+    ts = ts or now
+    record_id = id_generator.new('rec_')
+    device, created, was_online = registry.record_data(device_id, payload, ts, now)
+    metrics.inc('edge_ingest_records_total')
+    telemetry.append(device_id, ts, payload)
+    state_tracker.bump(device_id)
+
+    if created:
+        event_broker.publish('device_added', device)
+    else:
+        if not was_online:
+            event_broker.publish('device_status', {
+                'device_id': device_id,
+                'status': 'online',
+                'last_seen': _iso(now)
+            })
+        event_broker.publish('telemetry', {
+            'device_id': device_id,
+            'record_id': record_id,
+            'timestamp': _iso(ts),
+            'payload': payload
+        })
+    return record_id
+
 @app.route('/edge/data', methods=['POST'])
 def receive_edge_data():
-    """Receive telemetry from a custom edge device (legacy)"""
-    data = request.json or {}
-    device_id = data.get('device_id')
-    if not device_id:
+    """
+    Receive telemetry from a custom edge device (legacy). Kept as lenient as
+    it always was: any payload is stored, device_id is coerced to a string,
+    and a timestamp that cannot be used falls back to the arrival time.
+    """
+    data = _request_object()
+    if not data.get('device_id'):
         return jsonify({'error': 'device_id required'}), 400
+    device_id = str(data['device_id'])
+    payload = data.get('payload', {})
+    try:
+        ts = _record_time(data.get('timestamp'))
+    except ValueError:
+        ts = None
 
-    if device_id not in edge_devices:
-        edge_devices[device_id] = {
-            'device_id': device_id,
-            'registered_at': datetime.now().isoformat(),
-            'data_history': []
-        }
+    record_id = _ingest(device_id, payload, ts)
 
-    edge_devices[device_id]['last_seen'] = datetime.now().isoformat()
-    edge_devices[device_id]['status'] = 'online'
+    logger.info("Received data from %s: %s", device_id, payload,
+                extra={'endpoint': 'edge_data', 'device_id': device_id, 'record_id': record_id})
+    return jsonify({'message': 'Data received successfully', 'record_id': record_id,
+                    'timestamp': datetime.now().isoformat()}), 200
 
-    edge_devices[device_id].setdefault('data_history', [])
-    edge_devices[device_id]['data_history'].append({
-        'timestamp': datetime.now().isoformat(),
-        'payload': data.get('payload', {})
-    })
-    edge_devices[device_id]['data_history'] = edge_devices[device_id]['data_history'][-20:]
+def _batch_records():
+    """
+    Yield raw records from a batch body: newline-delimited JSON (read from the
+    request stream line by line, gunzipped on the fly), or an array /
+    {"records": [...]} in any format _request_payload() accepts.
+    Lines that are not valid JSON are yielded as ValueError instances.
+    """
+    if request.mimetype in NDJSON_MIMETYPES:
+        gzipped = _request_gzipped()
+        stream = gzip.GzipFile(fileobj=request.stream) if gzipped else request.stream
+        decoded = 0
+        try:
+            while True:
+                # bounded reads: a line without a newline must not be buffered whole
+                line = stream.readline(NDJSON_MAX_LINE + 1)
+                if not line:
+                    break
+                decoded += len(line)
+                if len(line) > NDJSON_MAX_LINE:
+                    raise PayloadError(f'Line longer than {NDJSON_MAX_LINE} bytes', 413)
+                if gzipped and decoded > MAX_DECODED_BODY:
+                    raise PayloadError('Decompressed body too large', 413)
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError as e:
+                        yield ValueError(f'invalid JSON: {e}')
+        except (OSError, EOFError) as e:
+            raise PayloadError(f'Invalid gzip body: {e}')
+        return
+    try:
+        body = _request_payload()
+    except PayloadError:
+        raise
+    except Exception:
+        # Flask's own JSON parsing rejected the body
+        body = None
+    if isinstance(body, dict):
+        body = body.get('records')
+    if not isinstance(body, list):
+        raise PayloadError('expected an array, {"records": [...]} or newline-delimited JSON')
+    yield from body
+
+@app.route('/edge/data/batch', methods=['POST'])
+def receive_edge_data_batch():
+    """
+    Ingest many telemetry records in one request, e.g. from a gateway.
+    Each record is {device_id, timestamp (optional, epoch or ISO-8601), payload}.
+    Valid records are applied even if others fail; the response lists
+    rejected records by index.
+    """
+    now = time.time()
+    accepted = 0
+    errors = []
+    devices = set()
+    # IDs are monotonic, so every record accepted here sorts between first and last
+    first_id = last_id = None
+    try:
+        for index, record in enumerate(_batch_records()):
+            if index >= BATCH_MAX_RECORDS:
+                errors.append({'index': index, 'error': f'batch limit of {BATCH_MAX_RECORDS} records exceeded'})
+                break
+            try:
+                if isinstance(record, ValueError):
+                    raise record
+                device_id, payload, ts = _parse_record(record, now)
+            except ValueError as e:
+                errors.append({'index': index, 'error': str(e)})
+                continue
+            last_id = _ingest(device_id, payload, ts, now)
+            first_id = first_id or last_id
+            devices.add(device_id)
+            accepted += 1
+    except PayloadError as e:
+        return jsonify({'error': str(e), 'accepted': accepted}), e.status
 
-    logger.info(f"Received data from {device_id}: {data.get('payload', {})}")
-    return jsonify({'message': 'Data received successfully', 'timestamp': datetime.now().isoformat()}), 200
+    logger.info("Batch ingest: %d records from %d devices, %d rejected", accepted, len(devices), len(errors),
+                extra={'endpoint': 'edge_data_batch', 'accepted': accepted, 'rejected': len(errors)})
+    return jsonify({
+        'message': 'Batch processed',
+        'accepted': accepted,
+        'rejected': len(errors),
+        'errors': errors,
+        'record_ids': {'first': first_id, 'last': last_id},
+        'timestamp': datetime.now().isoformat()
+    }), 200
 
 @app.route('/edge/commands/<device_id>', methods=['GET'])
 def get_commands(device_id):
-    """Edge device polls for pending commands (Cloud -> Edge)"""
-    if device_id not in command_queue:
-        command_queue[device_id] = []
-    cmds = command_queue[device_id].copy()
-    command_queue[device_id] = []
-    logger.info(f"Device {device_id} polled for commands. Sending {len(cmds)} commands")
-    return jsonify({'device_id': device_id, 'commands': cmds, 'timestamp': datetime.now().isoformat()}), 200
+    """
+    Edge device polls for pending commands (Cloud -> Edge)
+    Commands are leased, not removed: each one is delivered again after
+    lease_seconds until its result is posted to /edge/command/result.
+    Query params:
+      - wait (optional): long-poll up to this many seconds (capped by
+        LONGPOLL_MAX_WAIT) and return as soon as a command is queued
+      - limit (optional): at most this many commands, most urgent first
+    """
+    wait = min(request.args.get('wait', 0, type=float), LONGPOLL_MAX_WAIT)
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        return jsonify({'error': 'limit must be at least 1'}), 400
+    if wait > 0 and not registry.queue_depth(device_id):
+        registry.wait_for_commands(device_id, wait)
+    cmds = registry.lease(device_id, limit)
+    if cmds:
+        state_tracker.bump(device_id)
+    logger.info("Device %s polled for commands. Sending %d commands", device_id, len(cmds),
+                extra={'endpoint': 'edge_commands', 'device_id': device_id, 'commands': len(cmds)})
+    return _negotiated_response({'device_id': device_id, 'commands': cmds, 'lease_seconds': COMMAND_LEASE_SECONDS,
+                                 'timestamp': datetime.now().isoformat()})
+
+def _command_options(data, command, params):
+    """(priority, ttl, dedup_key) from a send/broadcast body; raises ValueError"""
+    try:
+        priority = int(data.get('priority', 0))
+        ttl = float(COMMAND_DEFAULT_TTL if data.get('ttl') is None else data['ttl'])
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError('priority must be an integer and ttl a number of seconds')
+    if not math.isfinite(ttl) or ttl <= 0:
+        raise ValueError('ttl must be a positive number of seconds')
+    if abs(priority) >= 2 ** 63:
+        raise ValueError('priority out of range')
+    ttl = min(ttl, COMMAND_MAX_TTL)
+    dedup_key = None
+    if data.get('coalesce', True):
+        dedup_key = str(data['dedup_key']) if data.get('dedup_key') else _dedup_key(command, params)
+    return priority, ttl, dedup_key
 
 @app.route('/command/send', methods=['POST'])
 def send_command():
-    """Queue a command to an edge device"""
+    """
+    Queue a command to an edge device
+    Body: device_id, command, params (optional) and
+      - priority (optional int, higher is delivered first; default 0)
+      - ttl (optional seconds; dropped if not delivered and completed in time)
+      - dedup_key (optional; default: command + params). A command with the
+        same key still waiting for delivery is coalesced instead of queued
+        twice; pass coalesce=false to always queue.
+    """
     data = request.json or {}
     device_id = data.get('device_id')
     command = data.get('command')
     if not device_id or not command:
         return jsonify({'error': 'device_id and command required'}), 400
+    device_id = str(device_id)
+    params = data.get('params', {})
+    try:
+        priority, ttl, dedup_key = _command_options(data, command, params)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
     command_entry = {
         'command': command,
-        'params': data.get('params', {}),
+        'params': params,
+        'timestamp': datetime.now().isoformat(),
+        'command_id': id_generator.new('cmd_')
+    }
+    command_id, outcome = registry.enqueue(device_id, command_entry, priority, ttl, dedup_key)
+    if outcome == 'rejected':
+        return jsonify({'error': f'Command queue for {device_id} is full ({COMMAND_QUEUE_MAX})'}), 429
+    if outcome == 'coalesced':
+        logger.info("Coalesced command for %s: %s -> %s", device_id, command, command_id,
+                    extra={'device_id': device_id, 'command_id': command_id})
+        return jsonify({'message': 'Coalesced with a pending command', 'command_id': command_id, 'coalesced': True}), 200
+
+    state_tracker.bump(device_id)
+    event_broker.publish('command_queued', dict(command_entry, device_id=device_id, priority=priority))
+    logger.info("Queued command for %s: %s", device_id, command,
+                extra={'device_id': device_id, 'command_id': command_id})
+    return jsonify({'message': 'Command queued successfully', 'command_id': command_id, 'coalesced': False}), 200
+
+def _select_devices(selector):
+    """Device IDs matching a broadcast selector (see broadcast_command); raises ValueError"""
+    if not isinstance(selector, dict):
+        raise ValueError('selector must be an object')
+    if not selector.get('all') and not any(selector.get(k) for k in ('device_ids', 'status', 'metadata', 'labels')):
+        raise ValueError('selector needs device_ids, status, metadata or labels (or all: true)')
+    device_ids = selector.get('device_ids')
+    if device_ids and not isinstance(device_ids, list):
+        raise ValueError('selector.device_ids must be a list')
+    ids = set(map(str, device_ids)) if device_ids else None
+    status = selector.get('status') or ()
+    if isinstance(status, str):
+        status = [status]
+    if not isinstance(status, (list, tuple)) or not all(isinstance(s, str) for s in status):
+        raise ValueError('selector.status must be a string or a list of strings')
+    statuses = set(status)
+    metadata = selector.get('metadata') or {}
+    if not isinstance(metadata, dict):
+        raise ValueError('selector.metadata must be an object')
+    labels = selector.get('labels') or ''
+    if isinstance(labels, dict):
+        requirements = [(key, 'in', {str(value)}) for key, value in labels.items()]
+    else:
+        requirements = _parse_label_selector(str(labels))
+
+    candidates = registry.profiles()
+    if selector.get('include_nodes', True):
+        candidates += [(d['device_id'], d['status'], d['metadata']) for d in map(_k8s_node_to_device, node_informer.list())]
+    selected = {}
+    for device_id, status, meta in candidates:
+        # registration accepts any JSON as metadata; only objects can match
+        meta = meta if isinstance(meta, dict) else {}
+        if device_id in selected or (ids is not None and device_id not in ids):
+            continue
+        if statuses and status not in statuses:
+            continue
+        if any(meta.get(key) != value for key, value in metadata.items()):
+            continue
+        if requirements and not _labels_match(meta.get('labels') if isinstance(meta.get('labels'), dict) else {}, requirements):
+            continue
+        selected[device_id] = True
+    return list(selected)
+
+@app.route('/command/broadcast', methods=['POST'])
+def broadcast_command():
+    """
+    Queue one command for every device matching a selector in a single call.
+    The payload is stored once and shared; each device gets its own command_id.
+    Body: command, params, priority, ttl, dedup_key/coalesce (as /command/send) and
+      selector (criteria combined with AND):
+        - device_ids: [...]
+        - status: 'online' | 'offline' | [...]
+        - metadata: {key: value} (registered device metadata)
+        - labels: 'zone=eu,tier in (edge,gw)' or {key: value}
+          (metadata.labels; k8s node labels for nodes)
+        - include_nodes: false to skip k8s nodes (default true)
+        - all: true to target every device
+    Returns a broadcast_id; GET /command/broadcast/<broadcast_id> has the counts.
+    """
+    data = request.json or {}
+    command = data.get('command')
+    if not command:
+        return jsonify({'error': 'command required'}), 400
+    params = data.get('params', {})
+    try:
+        priority, ttl, dedup_key = _command_options(data, command, params)
+        device_ids = _select_devices(data.get('selector'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not device_ids:
+        return jsonify({'error': 'selector matched no devices'}), 404
+
+    entry = {
+        'command': command,
+        'params': params,
         'timestamp': datetime.now().isoformat(),
-        'command_id': f"cmd_{int(time.time() * 1000)}"
+        'broadcast_id': id_generator.new('bc_')
     }
-    command_queue.setdefault(device_id, []).append(command_entry)
-    logger.info(f"Queued command for {device_id}: {command}")
-    return jsonify({'message': 'Command queued successfully', 'command_id': command_entry['command_id']}), 200
+    result = registry.broadcast(device_ids, entry, priority, ttl, dedup_key)
+    event_broker.publish('command_broadcast', result)
+    logger.info("Broadcast %s (%s) to %d devices: %d queued, %d coalesced, %d rejected",
+                entry['broadcast_id'], command, len(device_ids), result['queued'], result['coalesced'],
+                result['rejected'], extra={'broadcast_id': entry['broadcast_id']})
+    return jsonify(dict(result, message='Broadcast queued')), 200
+
+@app.route('/command/broadcast/<broadcast_id>', methods=['GET'])
+def get_broadcast(broadcast_id):
+    """Delivery counts of a broadcast, plus its retained results per reported status"""
+    result = registry.broadcast_status(broadcast_id)
+    if result is None:
+        return jsonify({'error': 'Broadcast not found'}), 404
+    result['results'] = results.broadcast_counts(broadcast_id)
+    return jsonify(result), 200
 
 @app.route('/edge/command/result', methods=['POST'])
 def receive_command_result():
-    data = request.json or {}
-    logger.info(f"Command result: {data}")
-    return jsonify({'message': 'Result received', 'timestamp': datetime.now().isoformat()}), 200
+    """
+    Result of an executed command (Edge -> Cloud). Posting it with its
+    command_id (device_id optional) completes the command so it is not
+    delivered again.
+    """
+    data = _request_payload() or {}
+    acknowledged = False
+    if isinstance(data, dict) and data.get('command_id'):
+        command_id = str(data['command_id'])
+        device_id = str(data['device_id']) if data.get('device_id') else registry.locate_command(command_id)
+        if device_id:
+            state = registry.complete(device_id, command_id) or {}
+            acknowledged = bool(state)
+            results.put(command_id, device_id, state.get('broadcast_id'), state.get('command') or data.get('command'),
+                        _result_status(data), {k: v for k, v in data.items() if k not in ('device_id', 'command_id')})
+    logger.info("Command result: %s", data, extra={'endpoint': 'command_result'})
+    return jsonify({'message': 'Result received', 'acknowledged': acknowledged,
+                    'timestamp': datetime.now().isoformat()}), 200
 
-@app.route('/devices', methods=['GET'])
-def list_devices():
-    """Return registered devices + K8s nodes summary"""
+def _result_status(data):
+    """Outcome reported by a device: its 'status' string, else derived from 'success'"""
+    if isinstance(data.get('status'), str) and data['status']:
+        return data['status']
+    if 'success' in data:
+        return 'success' if data['success'] else 'failed'
+    return 'completed'
+
+@app.route('/command/<command_id>', methods=['GET'])
+def get_command_status(command_id):
+    """Where a command is: queued, delivered (awaiting its result) or completed (with the result)"""
+    result = results.get(command_id)
+    if result is not None:
+        return jsonify(dict(result, state='completed')), 200
+    state = registry.command_state(command_id)
+    if state is None:
+        return jsonify({'error': 'Command not found (unknown, expired or result no longer retained)'}), 404
+    return jsonify(state), 200
+
+@app.route('/device/<device_id>/commands', methods=['GET'])
+def get_device_commands(device_id):
+    """
+    Pending commands and recent results of one device
+    Query params:
+      - limit (optional): most recent results to return (default 50)
+    """
+    limit = max(1, min(request.args.get('limit', 50, type=int), 1000))
+    return jsonify({
+        'device_id': device_id,
+        'pending': registry.device_commands(device_id),
+        'results': results.for_device(device_id, limit),
+        'timestamp': datetime.now().isoformat()
+    }), 200
+
+def _devices_payload():
     devices = []
-    for d in edge_devices.values():
+    for d in registry.list():
         devices.append(d)
-    if k8s:
-        try:
-            for n in k8s.list_node().items:
-                devices.append(_k8s_node_to_device(n))
-        except Exception as e:
-            logger.warning("Cannot list nodes: " + str(e))
-    return jsonify({'devices': devices, 'count': len(devices)}), 200
+    for n in node_informer.list():
+        devices.append(_k8s_node_to_device(n))
+    return {'devices': devices, 'count': len(devices), 'node_cache': node_informer.status()}
+
+def _devices_delta(changed, removed):
+    devices = [d for d in (_lookup_device(device_id) for device_id in changed) if d is not None]
+    return {'devices': devices, 'removed': removed, 'count': len(devices), 'node_cache': node_informer.status()}
+
+@app.route('/devices', methods=['GET'])
+def list_devices():
+    """Return registered devices + K8s nodes summary (supports ETag and ?since=<version>)"""
+    return _versioned_response('devices', _devices_payload, _devices_delta)
 
 @app.route('/device/<device_id>', methods=['GET'])
 def get_device_info(device_id):
     """Get a registered edge device or k8s node info"""
-    # check registered devices first
-    if device_id in edge_devices:
-        return jsonify(edge_devices[device_id]), 200
-
-    # check k8s nodes
-    if k8s:
-        try:
-            n = k8s.read_node(device_id)
-            return jsonify(_k8s_node_to_device(n)), 200
-        except ApiException as e:
-            if e.status == 404:
-                return jsonify({'error': 'Device not found'}), 404
-            return jsonify({'error': str(e)}), 500
+    # registered devices first, then k8s nodes (served from the informer cache)
+    device = _lookup_device(device_id)
+    if device is not None:
+        return jsonify(device), 200
+    if node_informer.available and not node_informer.synced:
+        return jsonify({'error': 'Kubernetes node cache not synced yet'}), 503
 
     return jsonify({'error': 'Device not found'}), 404
 
+# Telemetry query APIs
+TELEMETRY_DEFAULT_POINTS = int(os.environ.get('TELEMETRY_DEFAULT_POINTS', '300'))
+TELEMETRY_MAX_POINTS = int(os.environ.get('TELEMETRY_MAX_POINTS', '5000'))
+
+def _parse_time(value):
+    """Epoch seconds or ISO-8601 string -> epoch seconds (None passes through)"""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+
+def _telemetry_params():
+    """Validated from/to/step/points query params (from/to/step None when not given); raises ValueError"""
+    try:
+        start = _parse_time(request.args.get('from'))
+        end = _parse_time(request.args.get('to'))
+    except (ValueError, OverflowError, OSError):
+        raise ValueError('from/to must be epoch seconds or ISO-8601')
+    if any(t is not None and not math.isfinite(t) for t in (start, end)):
+        raise ValueError('from/to must be finite')
+    step = request.args.get('step', type=float)
+    if step is not None and not (math.isfinite(step) and step > 0):
+        raise ValueError('step must be a positive number of seconds')
+    points = request.args.get('points', TELEMETRY_DEFAULT_POINTS, type=int)
+    if points < 3:
+        raise ValueError('points must be at least 3')
+    return start, end, step, min(points, TELEMETRY_MAX_POINTS)
+
+def _telemetry_window(series_list, start, end, step, points):
+    """Fill in the from/to/step not given against the data actually present"""
+    present = [ts for ts, _ in series_list if len(ts)]
+    if start is None:
+        start = min(float(ts.min() if np is not None else min(ts)) for ts in present) if present else time.time()
+    if end is None:
+        end = time.time()
+    if step is None:
+        step = max((end - start) / points, 1.0)
+    return start, end, step, points
+
+@app.route('/api/telemetry/<device_id>', methods=['GET'])
+def api_telemetry(device_id):
+    """
+    Downsampled telemetry for one device.
+    Query params:
+      - metric (required; without it the available metrics are listed)
+      - from, to (optional): epoch seconds or ISO-8601
+      - step (optional): bucket width in seconds (default: fits `points` buckets)
+      - points (optional): target number of points (default TELEMETRY_DEFAULT_POINTS)
+      - mode (optional): 'aggregate' (min/max/avg/last/count per step, default) or 'lttb'
+    """
+    metric = request.args.get('metric')
+    if not metric:
+        if device_id not in registry:
+            return jsonify({'error': 'Device not found'}), 404
+        return jsonify({'device_id': device_id, 'metrics': telemetry.metrics(device_id)}), 200
+    try:
+        start, end, step, points = _telemetry_params()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    series = telemetry.series(device_id, metric, start, end)
+    if series is None:
+        return jsonify({'error': f'No {metric} telemetry for {device_id}'}), 404
+    start, end, step, points = _telemetry_window([series], start, end, step, points)
+    mode = request.args.get('mode', 'aggregate')
+    if mode == 'lttb':
+        out = _lttb(series[0], series[1], points)
+    elif mode == 'aggregate':
+        out = _aggregate(series[0], series[1], start, step)
+    else:
+        return jsonify({'error': "mode must be 'aggregate' or 'lttb'"}), 400
+    return jsonify({
+        'device_id': device_id, 'metric': metric, 'mode': mode,
+        'from': start, 'to': end, 'step': step if mode == 'aggregate' else None,
+        'samples': len(series[0]), 'points': out
+    }), 200
+
+@app.route('/api/telemetry/fleet', methods=['GET'])
+def api_telemetry_fleet():
+    """
+    Fleet-wide aggregates of one metric, e.g. avg cpu_usage of online devices per minute.
+    Query params:
+      - metric (required)
+      - status (optional): only devices with this status, e.g. online
+      - from, to, step, points (optional): as for /api/telemetry/<device_id>
+    """
+    metric = request.args.get('metric')
+    if not metric:
+        return jsonify({'error': 'metric parameter required'}), 400
+    try:
+        start, end, step, points = _telemetry_params()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    series_list = []
+    for device_id in registry.device_ids(status=request.args.get('status')):
+        series = telemetry.series(device_id, metric, start, end)
+        if series is not None and len(series[0]):
+            series_list.append(series)
+    start, end, step, _ = _telemetry_window(series_list, start, end, step, points)
+    if not series_list:
+        ts, values = [], []
+    elif np is not None:
+        ts = np.concatenate([s[0] for s in series_list])
+        values = np.concatenate([s[1] for s in series_list])
+    else:
+        ts = [t for s in series_list for t in s[0]]
+        values = [v for s in series_list for v in s[1]]
+    return jsonify({
+        'metric': metric, 'status': request.args.get('status'),
+        'from': start, 'to': end, 'step': step,
+        'devices': len(series_list), 'samples': len(ts),
+        'points': _aggregate(ts, values, start, step)
+    }), 200
+
 # Kubernetes APIs
 @app.route('/api/k8s/nodes', methods=['GET'])
 def api_k8s_nodes():
     """List Kubernetes nodes"""
-    if not k8s:
+    if not get_k8s():
         return jsonify({'error': 'Kubernetes client not available'}), 500
     try:
-        nodes = k8s.list_node().items
+        nodes = node_informer.list()
         out = []
         for n in nodes:
             out.append({
@@ -730,17 +4455,24 @@ def api_k8s_nodes():
                 'status': 'online' if any((c.type == 'Ready' and c.status == 'True') for c in (n.status.conditions or [])) else 'offline',
                 'capacity': n.status.capacity
             })
-        return jsonify({'nodes': out})
+        return jsonify({'nodes': out, 'cache': node_informer.status()})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/k8s/pods', methods=['GET'])
 def api_k8s_pods():
-    """List pods grouped by node"""
-    if not k8s:
+    """
+    List pods grouped by node, served from the pod informer.
+    Query params (all optional, combined with AND):
+      - node
+      - namespace
+      - phase
+    """
+    if not get_k8s():
         return jsonify({'error': 'Kubernetes client not available'}), 500
+    criteria = {k: request.args[k] for k in ('node', 'namespace', 'phase') if request.args.get(k)}
     try:
-        pods = k8s.list_pod_for_all_namespaces().items
+        pods = pod_informer.by_index(**criteria)
         result = {}
         for p in pods:
             node = p.spec.node_name or 'unknown'
@@ -765,7 +4497,7 @@ def api_k8s_pod_logs():
       - container (optional)
       - tail_lines (optional)
     """
-    if not k8s:
+    if not get_k8s():
         return jsonify({'error': 'Kubernetes client not available'}), 500
 
     namespace = request.args.get('namespace', 'default')
@@ -777,12 +4509,285 @@ def api_k8s_pod_logs():
         return jsonify({'error': 'pod parameter required'}), 400
 
     try:
-        logs = k8s.read_namespaced_pod_log(name=pod, namespace=namespace, container=container, tail_lines=tail_lines)
+        logs = k8s_gateway.call('read_namespaced_pod_log', name=pod, namespace=namespace,
+                                container=container, tail_lines=tail_lines)
         return jsonify({'pod': pod, 'namespace': namespace, 'logs': logs})
-    except ApiException as e:
-        return jsonify({'error': f"K8s API error: {e}"}), 500
+    except K8sUnavailable:
+        raise
+    except Exception as e:
+        if _api_status(e) is not None:
+            return jsonify({'error': f"K8s API error: {e}"}), 500
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/k8s/pod/logs/stream', methods=['GET'])
+def api_k8s_pod_logs_stream():
+    """
+    Stream pod logs as they are read, never holding the whole log in memory.
+    Plain chunked text by default; Server-Sent Events ('log' and 'end' events)
+    with format=sse or Accept: text/event-stream.
+    Query params:
+      - namespace (default: default)
+      - pod (required)
+      - container (optional, repeatable or comma-separated; default: all containers)
+      - follow (default: true)
+      - since_seconds, tail_lines, limit_bytes (optional, per container)
+    """
+    if not get_k8s():
+        return jsonify({'error': 'Kubernetes client not available'}), 500
+
+    namespace = request.args.get('namespace', 'default')
+    pod = request.args.get('pod')
+    if not pod:
+        return jsonify({'error': 'pod parameter required'}), 400
+    try:
+        options = {k: int(request.args[k]) for k in ('since_seconds', 'tail_lines', 'limit_bytes') if request.args.get(k)}
+    except ValueError:
+        return jsonify({'error': 'since_seconds, tail_lines and limit_bytes must be integers'}), 400
+    follow = request.args.get('follow', 'true').lower() not in ('0', 'false', 'no')
+    fmt = request.args.get('format') or ('sse' if request.accept_mimetypes.best == 'text/event-stream' else 'text')
+    containers = [c for value in request.args.getlist('container') for c in value.split(',') if c]
+
+    stream = LogStream.reserve()
+    if stream is None:
+        return jsonify({'error': 'Too many open log streams'}), 503
+    try:
+        if not containers:
+            p = pod_informer.get(f"{namespace}/{pod}") or k8s_gateway.call('read_namespaced_pod', name=pod, namespace=namespace)
+            containers = [c.name for c in (p.spec.containers or [])] or [None]
+        for container in containers:
+            stream.responses[container] = k8s_gateway.call(
+                'read_namespaced_pod_log', name=pod, namespace=namespace, container=container,
+                follow=follow, _preload_content=False,
+                _request_timeout=(K8S_CONNECT_TIMEOUT, LOG_STREAM_IDLE_TIMEOUT), **options)
+    except K8sUnavailable:
+        stream.close()
+        raise
     except Exception as e:
+        stream.close()
+        if _api_status(e) is not None:
+            return jsonify({'error': f"K8s API error: {e}"}), 500
         return jsonify({'error': str(e)}), 500
+    stream.start()
+
+    def generate_text():
+        prefixed = len(stream.responses) > 1
+        try:
+            for item in stream.items(STREAM_HEARTBEAT):
+                if item is None or item[1] is None:
+                    continue
+                container, lines, _ = item
+                prefix = f"[{container}] ".encode() if prefixed else b''
+                yield b''.join(prefix + line + b'\n' for line in lines)
+        finally:
+            stream.close()
+
+    def generate_sse():
+        try:
+            for item in stream.items(STREAM_HEARTBEAT):
+                if item is None:
+                    yield ": keepalive\n\n"
+                elif item[1] is None:
+                    yield f"event: end\ndata: {json.dumps({'container': item[0], 'reason': item[2]})}\n\n"
+                else:
+                    lines = [line.decode('utf-8', 'replace') for line in item[1]]
+                    yield f"event: log\ndata: {json.dumps({'container': item[0], 'lines': lines})}\n\n"
+        finally:
+            stream.close()
+
+    if fmt == 'sse':
+        resp = Response(generate_sse(), mimetype='text/event-stream')
+    else:
+        resp = Response(generate_text(), mimetype='text/plain')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    # runs even if the client goes away before the first chunk
+    resp.call_on_close(stream.close)
+    return resp
+
+# Bulk log collection (/api/k8s/pods/logs)
+BULK_LOGS_MAX_PODS = int(os.environ.get('BULK_LOGS_MAX_PODS', '500'))
+# log requests kept in flight at once (never more than half the gateway's slots)
+BULK_LOGS_PARALLEL = int(os.environ.get('BULK_LOGS_PARALLEL', '8'))
+BULK_LOGS_LIMIT_BYTES = int(os.environ.get('BULK_LOGS_LIMIT_BYTES', str(1024 * 1024)))
+BULK_LOGS_TIMEOUT = float(os.environ.get('BULK_LOGS_TIMEOUT', '60'))
+# archives larger than this are spooled to disk instead of memory
+BULK_LOGS_SPOOL_SIZE = int(os.environ.get('BULK_LOGS_SPOOL_SIZE', str(8 * 1024 * 1024)))
+
+_SELECTOR_SET = re.compile(r'^(\S+)\s+(in|notin)\s+\(([^)]*)\)$')
+_SELECTOR_EQ = re.compile(r'^([^!=\s]+)\s*(==|=|!=)\s*(\S*)$')
+
+
+def _parse_label_selector(selector):
+    """
+    Kubernetes label selector string -> list of (key, op, values), e.g.
+    'app=edge,tier!=db,env in (a,b),!legacy'. Raises ValueError if malformed.
+    """
+    terms, depth, current = [], 0, ''
+    for ch in selector:
+        depth += {'(': 1, ')': -1}.get(ch, 0)
+        if ch == ',' and depth == 0:
+            terms.append(current)
+            current = ''
+        else:
+            current += ch
+    terms.append(current)
+
+    requirements = []
+    for term in (t.strip() for t in terms):
+        if not term:
+            continue
+        m = _SELECTOR_SET.match(term)
+        if m:
+            requirements.append((m.group(1), m.group(2), {v.strip() for v in m.group(3).split(',') if v.strip()}))
+            continue
+        m = _SELECTOR_EQ.match(term)
+        if m:
+            requirements.append((m.group(1), 'notin' if m.group(2) == '!=' else 'in', {m.group(3)}))
+        elif term.startswith('!') and re.match(r'^!\S+$', term):
+            requirements.append((term[1:], '!', None))
+        elif re.match(r'^\S+$', term):
+            requirements.append((term, 'exists', None))
+        else:
+            raise ValueError(f'Invalid label selector term: {term}')
+    return requirements
+
+
+def _labels_match(labels, requirements):
+    labels = labels or {}
+    for key, op, values in requirements:
+        if op == 'exists' and key not in labels:
+            return False
+        if op == '!' and key in labels:
+            return False
+        if op == 'in' and labels.get(key) not in values:
+            return False
+        if op == 'notin' and key in labels and labels[key] in values:
+            return False
+    return True
+
+
+def _collect_pod_logs(targets, options):
+    """
+    Fetch the logs of (pod, container) targets in parallel through the
+    Kubernetes gateway, keeping at most BULK_LOGS_PARALLEL requests in flight.
+    Yields (pod, container, logs, error) in completion order.
+    """
+    parallel = max(1, min(BULK_LOGS_PARALLEL, k8s_gateway.max_pending // 2))
+    deadline = time.monotonic() + BULK_LOGS_TIMEOUT
+    waiting = deque(targets)
+    running = {}
+    while waiting or running:
+        while waiting and len(running) < parallel:
+            p, container = waiting[0]
+            try:
+                future = k8s_gateway.submit('read_namespaced_pod_log', name=p.metadata.name,
+                                            namespace=p.metadata.namespace, container=container, **options)
+            except K8sUnavailable as e:
+                # a full pool frees up as calls finish; an open circuit fails everything left
+                if k8s_gateway.breaker.state() == 'closed' and time.monotonic() < deadline:
+                    if not running:
+                        time.sleep(0.05)
+                    break
+                waiting.popleft()
+                yield p, container, None, str(e)
+                continue
+            running[future] = waiting.popleft()
+        if not running:
+            continue
+
+        done, _ = wait(running, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            # out of time: give up on everything still outstanding
+            for future, (p, container) in running.items():
+                future.cancel()
+                yield p, container, None, 'timed out'
+            for p, container in waiting:
+                yield p, container, None, 'timed out'
+            return
+        for future in done:
+            p, container = running.pop(future)
+            try:
+                yield p, container, future.result(), None
+            except Exception as e:
+                yield p, container, None, str(e)
+
+
+@app.route('/api/k8s/pods/logs', methods=['GET'])
+def api_k8s_bulk_pod_logs():
+    """
+    Logs of every pod matching the filters, fetched in parallel.
+    Query params (at least one of namespace, node, label_selector):
+      - namespace
+      - node
+      - label_selector (e.g. app=edge-agent,tier!=db)
+      - container (optional; default: all containers of each pod)
+      - tail_lines (default: 200), since_seconds, limit_bytes (per container)
+      - format: ndjson (default, streamed one line per container) or tar (logs.tar.gz)
+    """
+    if not get_k8s():
+        return jsonify({'error': 'Kubernetes client not available'}), 500
+
+    criteria = {k: request.args[k] for k in ('node', 'namespace') if request.args.get(k)}
+    selector = request.args.get('label_selector', '')
+    if not criteria and not selector:
+        return jsonify({'error': 'namespace, node or label_selector parameter required'}), 400
+    try:
+        requirements = _parse_label_selector(selector)
+        options = {'tail_lines': int(request.args.get('tail_lines', '200')),
+                   'limit_bytes': int(request.args.get('limit_bytes', str(BULK_LOGS_LIMIT_BYTES)))}
+        if request.args.get('since_seconds'):
+            options['since_seconds'] = int(request.args['since_seconds'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'tar'):
+        return jsonify({'error': 'format must be ndjson or tar'}), 400
+
+    if pod_informer.available and not pod_informer.synced:
+        return jsonify({'error': 'Kubernetes pod cache not synced yet'}), 503
+    pods = [p for p in pod_informer.by_index(**criteria) if _labels_match(p.metadata.labels, requirements)]
+    if len(pods) > BULK_LOGS_MAX_PODS:
+        return jsonify({'error': f'{len(pods)} pods match; narrow the filters (limit {BULK_LOGS_MAX_PODS})'}), 400
+    container = request.args.get('container')
+    targets = []
+    for p in pods:
+        names = [container] if container else [c.name for c in (p.spec.containers or [])]
+        targets.extend((p, name) for name in (names or [None]))
+
+    if fmt == 'ndjson':
+        def generate():
+            for p, c, logs, error in _collect_pod_logs(targets, options):
+                record = {'pod': p.metadata.name, 'namespace': p.metadata.namespace,
+                          'node': p.spec.node_name, 'container': c}
+                record.update({'error': error} if error else {'logs': logs})
+                yield json.dumps(record) + '\n'
+
+        return Response(generate(), mimetype=NDJSON_MIMETYPES[0], headers={'X-Pod-Count': str(len(pods))})
+
+    # tar.gz: one <namespace>/<pod>/<container>.log member per target plus manifest.json
+    archive = tempfile.SpooledTemporaryFile(max_size=BULK_LOGS_SPOOL_SIZE)
+    manifest = []
+    with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+        for p, c, logs, error in _collect_pod_logs(targets, options):
+            entry = {'pod': p.metadata.name, 'namespace': p.metadata.namespace, 'node': p.spec.node_name, 'container': c}
+            if error:
+                entry['error'] = error
+            else:
+                data = (logs or '').encode('utf-8', 'replace')
+                info = tarfile.TarInfo(f"{p.metadata.namespace}/{p.metadata.name}/{c or p.metadata.name}.log")
+                info.size = len(data)
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(data))
+                entry['bytes'] = len(data)
+            manifest.append(entry)
+        data = json.dumps({'pods': len(pods), 'logs': manifest}, indent=2).encode()
+        info = tarfile.TarInfo('manifest.json')
+        info.size = len(data)
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(data))
+    archive.seek(0)
+    return send_file(archive, mimetype='application/gzip', as_attachment=True,
+                     download_name=f"logs-{datetime.now().strftime('%Y%m%d-%H%M%S')}.tar.gz")
 
 @app.route('/api/edge/token', methods=['GET'])
 def api_get_token():
@@ -800,14 +4805,17 @@ def api_get_token():
 # small util endpoint to run a simple kubectl-like exec (NOT shell) - optional for troubleshooting
 @app.route('/api/k8s/describe/pod', methods=['GET'])
 def api_k8s_describe_pod():
-    if not k8s:
+    if not get_k8s():
         return jsonify({'error': 'Kubernetes client not available'}), 500
     namespace = request.args.get('namespace', 'default')
     pod = request.args.get('pod')
     if not pod:
         return jsonify({'error': 'pod parameter required'}), 400
     try:
-        p = k8s.read_namespaced_pod(name=pod, namespace=namespace)
+        p = pod_informer.get(f"{namespace}/{pod}")
+        if p is None:
+            # cache miss (not synced yet or pod just created): ask the API server
+            p = k8s_gateway.call('read_namespaced_pod', name=pod, namespace=namespace)
         # return selective describe-like info
         info = {
             'name': p.metadata.name,
@@ -819,11 +4827,14 @@ def api_k8s_describe_pod():
             'startTime': p.status.start_time.isoformat() if p.status.start_time else None
         }
         return jsonify(info)
-    except ApiException as e:
+    except K8sUnavailable:
+        raise
+    except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 # Start app
 if __name__ == '__main__':
     logger.info("Starting Master App (Cloud) with Kubernetes support")
-    # in production you will run this inside a WSGI; debug True is okay for local testing
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # development server only; production runs gunicorn with gunicorn.conf.py (see Dockerfile)
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', '5000')),
+            debug=os.environ.get('FLASK_DEBUG') == '1', threaded=True)
@@ -0,0 +1,383 @@
+"""
+Load test / benchmark for the Master App, run in-process against app.py.
+
+Simulates N edge devices registering, posting telemetry and polling for
+commands alongside M dashboard viewers, with a fake CoreV1Api serving a
+configurable number of nodes and pods (no cluster needed). Each scenario
+reports req/s, p50/p90/p99 latency and RSS; results are written as JSON so
+runs can be compared:
+
+    python benchmark.py --devices 1000 --viewers 5 --output before.json
+    python benchmark.py --devices 1000 --viewers 5 --compare before.json
+
+Requests go through Flask's test client from a pool of threads, so the
+numbers are one worker process's handler cost without network overhead.
+"""
+import argparse
+import atexit
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+SCENARIOS = ('register', 'ingest', 'poll', 'dashboard', 'mixed')
+
+
+class _IdleWatch:
+    """Watch response with no events that ends at the watch timeout (what an idle API server does)"""
+    status = 200
+
+    def __init__(self, timeout, stop):
+        self.timeout = timeout
+        self.stop = stop
+
+    def stream(self, amt=None, decode_content=False):
+        self.stop.wait(self.timeout)
+        return iter(())
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+class FakeCoreV1Api:
+    """The CoreV1Api calls made by app.py, answered from memory with `nodes` nodes and `pods` pods"""
+
+    def __init__(self, nodes, pods, latency=0.0):
+        from kubernetes import client
+        self.latency = latency
+        self.stop = threading.Event()
+        created = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.nodes = [client.V1Node(
+            metadata=client.V1ObjectMeta(name=f"node-{i}", resource_version=str(i + 1), creation_timestamp=created,
+                                         labels={'node-role.kubernetes.io/edge': '', 'zone': f"z{i % 4}"}),
+            status=client.V1NodeStatus(conditions=[client.V1NodeCondition(type='Ready', status='True')],
+                                       capacity={'cpu': '4', 'memory': '8Gi'})
+        ) for i in range(nodes)]
+        self.pods = [client.V1Pod(
+            metadata=client.V1ObjectMeta(name=f"pod-{i}", namespace=f"ns-{i % 5}", resource_version=str(i + 1),
+                                         labels={'app': f"app-{i % 10}"}, creation_timestamp=created),
+            spec=client.V1PodSpec(node_name=f"node-{i % max(nodes, 1)}",
+                                  containers=[client.V1Container(name='main', image='busybox')]),
+            status=client.V1PodStatus(phase='Running', pod_ip='10.0.0.1', host_ip='192.168.0.1', start_time=created)
+        ) for i in range(pods)]
+        self._node_list = client.V1NodeList(metadata=client.V1ListMeta(resource_version=str(nodes)), items=self.nodes)
+        self._pod_list = client.V1PodList(metadata=client.V1ListMeta(resource_version=str(pods)), items=self.pods)
+
+    def _answer(self, result, kwargs):
+        if kwargs.get('watch'):
+            return _IdleWatch(kwargs.get('timeout_seconds', 60), self.stop)
+        if self.latency:
+            time.sleep(self.latency)
+        return result
+
+    def list_node(self, **kwargs):
+        """:rtype: V1NodeList"""
+        return self._answer(self._node_list, kwargs)
+
+    def list_pod_for_all_namespaces(self, **kwargs):
+        """:rtype: V1PodList"""
+        return self._answer(self._pod_list, kwargs)
+
+    def read_namespaced_pod(self, name, namespace, **kwargs):
+        """:rtype: V1Pod"""
+        return self._answer(self.pods[int(name.rsplit('-', 1)[1]) % len(self.pods)], kwargs)
+
+    def read_namespaced_pod_log(self, name, namespace, **kwargs):
+        return self._answer(''.join(f"{name} line {i}\n" for i in range(kwargs.get('tail_lines') or 100)), kwargs)
+
+
+def _rss_mb():
+    """Current resident set size (Linux /proc), else the peak"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return _peak_rss_mb()
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+
+
+def _percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _summary(latencies, errors, elapsed):
+    ordered = sorted(latencies)
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'req_per_s': round(len(ordered) / elapsed, 1) if elapsed else 0,
+        'p50_ms': ms(_percentile(ordered, 0.50)),
+        'p90_ms': ms(_percentile(ordered, 0.90)),
+        'p99_ms': ms(_percentile(ordered, 0.99)),
+        'max_ms': ms(ordered[-1] if ordered else None)
+    }
+
+
+class Recorder:
+    """Per-endpoint latencies and error counts, collected from many threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def request(self, client, endpoint, method, url, **kwargs):
+        started = time.perf_counter()
+        resp = client.open(url, method=method, **kwargs)
+        elapsed = time.perf_counter() - started
+        ok = resp.status_code < 400
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        return resp if ok else None
+
+
+def _device_ids(args):
+    return [f"bench-{i:06d}" for i in range(args.devices)]
+
+
+def _telemetry(rng, i):
+    return {'temperature': round(rng.uniform(15, 35), 2), 'humidity': round(rng.uniform(20, 80), 1),
+            'battery': round(rng.uniform(3.3, 4.2), 3), 'seq': i, 'status': 'ok'}
+
+
+def _device_loop(app, args, rec, worker, ingest, poll, stop):
+    """One thread acting for a slice of the devices: post telemetry and/or poll commands, post results"""
+    client = app.test_client()
+    rng = random.Random(args.seed * 1000 + worker)
+    devices = _device_ids(args)[worker::args.concurrency] or _device_ids(args)
+    i = 0
+    while not stop.is_set():
+        device_id = devices[i % len(devices)]
+        i += 1
+        if ingest:
+            rec.request(client, '/edge/data', 'POST', '/edge/data',
+                        json={'device_id': device_id, 'payload': _telemetry(rng, i)})
+        if poll and (not ingest or i % args.poll_every == 0):
+            resp = rec.request(client, '/edge/commands/<device_id>', 'GET', f"/edge/commands/{device_id}")
+            for cmd in (resp.get_json() or {}).get('commands', []) if resp is not None else []:
+                rec.request(client, '/edge/command/result', 'POST', '/edge/command/result',
+                            json={'device_id': device_id, 'command_id': cmd['command_id'], 'status': 'success'})
+
+
+def _operator_loop(app, args, rec, stop):
+    """Queue commands for random devices at --command-rate per second"""
+    client = app.test_client()
+    rng = random.Random(args.seed)
+    devices = _device_ids(args)
+    interval = 1.0 / args.command_rate
+    while not stop.wait(interval):
+        rec.request(client, '/command/send', 'POST', '/command/send',
+                    json={'device_id': rng.choice(devices), 'command': 'get_status', 'params': {}})
+
+
+def _viewer_loop(app, args, rec, worker, stop):
+    """A dashboard tab: full snapshot, then ETag revalidation, plus the k8s panels"""
+    client = app.test_client()
+    etag = None
+    while not stop.is_set():
+        headers = {'If-None-Match': etag} if etag and args.revalidate else {}
+        resp = rec.request(client, '/api/dashboard-data', 'GET', '/api/dashboard-data', headers=headers)
+        if resp is not None:
+            etag = resp.headers.get('ETag') or etag
+        rec.request(client, '/api/k8s/nodes', 'GET', '/api/k8s/nodes')
+        rec.request(client, '/api/k8s/pods', 'GET', '/api/k8s/pods')
+        if args.viewer_interval:
+            stop.wait(args.viewer_interval)
+
+
+def _run_threads(targets, duration):
+    stop = threading.Event()
+    threads = [threading.Thread(target=fn, args=fn_args + (stop,), daemon=True) for fn, fn_args in targets]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - started
+
+
+def run_register(app, args):
+    """Every device registers once, spread over the thread pool"""
+    rec = Recorder()
+    devices = _device_ids(args)
+
+    def work(worker):
+        client = app.test_client()
+        for device_id in devices[worker::args.concurrency]:
+            rec.request(client, '/edge/register', 'POST', '/edge/register',
+                        json={'device_id': device_id, 'metadata': {'type': 'sensor', 'zone': f"z{int(device_id[-6:]) % 4}"}})
+
+    threads = [threading.Thread(target=work, args=(w,), daemon=True) for w in range(args.concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return rec, time.perf_counter() - started
+
+
+def run_ingest(app, args):
+    rec = Recorder()
+    elapsed = _run_threads([(_device_loop, (app, args, rec, w, True, False)) for w in range(args.concurrency)],
+                           args.duration)
+    return rec, elapsed
+
+
+def run_poll(app, args):
+    rec = Recorder()
+    targets = [(_device_loop, (app, args, rec, w, False, True)) for w in range(args.concurrency)]
+    targets.append((_operator_loop, (app, args, rec)))
+    return rec, _run_threads(targets, args.duration)
+
+
+def run_dashboard(app, args):
+    rec = Recorder()
+    return rec, _run_threads([(_viewer_loop, (app, args, rec, w)) for w in range(args.viewers)], args.duration)
+
+
+def run_mixed(app, args):
+    """Devices ingesting and polling, an operator queueing commands and viewers watching, all at once"""
+    rec = Recorder()
+    targets = [(_device_loop, (app, args, rec, w, True, True)) for w in range(args.concurrency)]
+    targets.append((_operator_loop, (app, args, rec)))
+    targets += [(_viewer_loop, (app, args, rec, w)) for w in range(args.viewers)]
+    return rec, _run_threads(targets, args.duration)
+
+
+RUNNERS = {'register': run_register, 'ingest': run_ingest, 'poll': run_poll,
+           'dashboard': run_dashboard, 'mixed': run_mixed}
+
+
+def _load_app(args):
+    """Import app.py configured for benchmarking (quiet logs, throwaway state, fake Kubernetes)"""
+    workdir = tempfile.mkdtemp(prefix='master-app-bench-')
+    atexit.register(shutil.rmtree, workdir, True)  # registered first so it runs after app.py's own exit hooks
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ['STATE_BACKEND'] = args.backend
+    os.environ['STATE_SQLITE_PATH'] = os.path.join(workdir, 'state.db')
+    os.environ['METRICS_DIR'] = ''
+    if args.wal:
+        os.environ['STATE_WAL_DIR'] = os.path.join(workdir, 'wal')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as master
+    master._k8s_api = FakeCoreV1Api(args.nodes, args.pods, args.k8s_latency)
+    return master
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(args):
+    master = _load_app(args)
+    app = master.app
+    results = {
+        'revision': _git_revision(),
+        'started_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        'scenarios': {}
+    }
+    ran_register = False
+    for name in args.scenarios:
+        if name != 'register' and not ran_register:
+            run_register(app, args)  # untimed setup: later scenarios expect registered devices
+            ran_register = True
+        rss_before = _rss_mb()
+        rec, elapsed = RUNNERS[name](app, args)
+        ran_register = ran_register or name == 'register'
+        latencies = [v for values in rec.latencies.values() for v in values]
+        scenario = _summary(latencies, sum(rec.errors.values()), elapsed)
+        scenario.update({
+            'seconds': round(elapsed, 2),
+            'rss_mb': round(_rss_mb(), 1),
+            'rss_growth_mb': round(_rss_mb() - rss_before, 1),
+            'peak_rss_mb': round(_peak_rss_mb(), 1),
+            'endpoints': {endpoint: _summary(values, rec.errors.get(endpoint, 0), elapsed)
+                          for endpoint, values in sorted(rec.latencies.items())}
+        })
+        results['scenarios'][name] = scenario
+        print(f"{name:10s} {scenario['req_per_s']:>10.1f} req/s  p50 {scenario['p50_ms']} ms  "
+              f"p99 {scenario['p99_ms']} ms  errors {scenario['errors']}  rss {scenario['rss_mb']} MB", file=sys.stderr)
+    master._k8s_api.stop.set()
+    master.begin_shutdown()
+    return results
+
+
+def compare(baseline, results):
+    """Print throughput, latency and RSS changes per scenario against an earlier results file"""
+    for name, current in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        parts = []
+        for key, better in (('req_per_s', 1), ('p50_ms', -1), ('p99_ms', -1), ('rss_mb', -1)):
+            if before.get(key) and current.get(key) is not None:
+                change = (current[key] - before[key]) / before[key] * 100
+                flag = ' (worse)' if change * better < -5 else ''
+                parts.append(f"{key} {before[key]} -> {current[key]} ({change:+.1f}%){flag}")
+        print(f"{name:10s} " + ', '.join(parts), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--devices', type=int, default=500, help='simulated edge devices (N)')
+    parser.add_argument('--viewers', type=int, default=4, help='simulated dashboard viewers (M)')
+    parser.add_argument('--concurrency', type=int, default=16, help='threads acting for the devices')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per timed scenario')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--nodes', type=int, default=20, help='nodes returned by the fake CoreV1Api')
+    parser.add_argument('--pods', type=int, default=200, help='pods returned by the fake CoreV1Api')
+    parser.add_argument('--k8s-latency', type=float, default=0.0, help='seconds the fake CoreV1Api takes per call')
+    parser.add_argument('--poll-every', type=int, default=5, help='in mixed mode, poll after every Nth upload')
+    parser.add_argument('--command-rate', type=float, default=50, help='commands queued per second by the operator')
+    parser.add_argument('--viewer-interval', type=float, default=0, help='pause between dashboard refreshes')
+    parser.add_argument('--no-revalidate', dest='revalidate', action='store_false',
+                        help='viewers always fetch the full dashboard (no If-None-Match)')
+    parser.add_argument('--backend', choices=('memory', 'sqlite'), default='memory')
+    parser.add_argument('--wal', action='store_true', help='enable the write-ahead log (memory backend)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write JSON results here (default: stdout)')
+    parser.add_argument('--compare', help='earlier JSON results to compare against')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# gunicorn settings for the Master App (used by the Dockerfile CMD).
+# Every value can be overridden through environment variables.
+import os
+import signal
+import tempfile
+import threading
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# gthread: each worker process serves requests from a thread pool, so
+# long-polls and push streams can block a thread without blocking the worker
+worker_class = 'gthread'
+
+# The default in-memory state backend lives inside one process; only run
+# several workers when state is shared (STATE_BACKEND=sqlite)
+_default_workers = '1' if os.environ.get('STATE_BACKEND', 'memory') == 'memory' else str(os.cpu_count() or 1)
+workers = int(os.environ.get('WEB_CONCURRENCY', _default_workers))
+# the write-ahead log of the in-memory backend has exactly one writer (on a
+# reload the new worker waits, up to WAL_LOCK_TIMEOUT, for the old one to exit)
+if os.environ.get('STATE_WAL_DIR') and os.environ.get('STATE_BACKEND', 'memory') == 'memory' and workers != 1:
+    raise RuntimeError('STATE_WAL_DIR with STATE_BACKEND=memory requires WEB_CONCURRENCY=1')
+threads = int(os.environ.get('GUNICORN_THREADS', '64'))
+backlog = int(os.environ.get('GUNICORN_BACKLOG', '2048'))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', '5'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '60'))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', '0'))
+
+# Import the app in each worker after fork (no shared sockets, threads or
+# k8s connection pools between workers)
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0') == '1'
+
+accesslog = os.environ.get('GUNICORN_ACCESSLOG') or None
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOGLEVEL', 'info')
+
+# Parked long-polls, push streams, pod log streams and requests waiting on the
+# Kubernetes API each hold a thread; together they get at most 11/16 of every
+# worker's threads, so over a quarter stays free for ingest and dashboard requests
+os.environ.setdefault('LONGPOLL_MAX_PARKED', str(max(1, threads * 3 // 8)))
+os.environ.setdefault('STREAM_MAX_SUBSCRIBERS', str(max(1, threads // 8)))
+os.environ.setdefault('K8S_MAX_PENDING', str(max(1, threads // 8)))
+os.environ.setdefault('LOG_STREAM_MAX', str(max(1, threads // 16)))
+
+# Workers write their counters here so /metrics on any worker reports the sum
+# over all of them (a fresh directory per server start)
+os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix='master-app-metrics-'))
+
+
+def post_worker_init(worker):
+    """On SIGTERM, release parked polls and streams before gunicorn waits for in-flight requests"""
+    from app import begin_shutdown
+
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle_term(sig, frame):
+        # never take app locks inside a signal handler
+        threading.Thread(target=begin_shutdown, name='shutdown', daemon=True).start()
+        if callable(previous):
+            previous(sig, frame)
+
+    signal.signal(signal.SIGTERM, handle_term)
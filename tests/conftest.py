@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+# app.py reads its configuration at import time: in-memory state without a
+# write-ahead log, quiet logs and no metrics files
+os.environ.update(STATE_BACKEND='memory', LOG_LEVEL='WARNING', METRICS_DIR='')
+os.environ.pop('STATE_WAL_DIR', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def registry(request, tmp_path):
+    """A fresh device registry of each state backend"""
+    import app
+    if request.param == 'memory':
+        return app.DeviceRegistry()
+    return app.SQLiteDeviceRegistry(app.SQLiteStore(str(tmp_path / 'state.db')))
+
+
+@pytest.fixture
+def client():
+    import app
+    return app.app.test_client()
@@ -0,0 +1,48 @@
+import json
+import time
+
+import app
+
+NDJSON = 'application/x-ndjson'
+
+
+def test_json_array_applies_valid_records_and_reports_the_rest(client):
+    now = time.time()
+    resp = client.post('/edge/data/batch', json=[
+        {'device_id': 'bt-a', 'timestamp': now - 5, 'payload': {'t': 1}},
+        {'payload': {'t': 2}},
+        {'device_id': 'bt-a', 'timestamp': '2001-01-01T00:00:00', 'payload': {'t': 3}},
+        {'device_id': 'bt-b', 'payload': 'text'},
+        {'device_id': 'bt-b', 'timestamp': now, 'payload': {'t': 4}},
+    ])
+    body = resp.get_json()
+    assert resp.status_code == 200
+    assert body['accepted'] == 2
+    assert [e['index'] for e in body['errors']] == [1, 2, 3]
+    assert body['record_ids']['first'] < body['record_ids']['last']
+    assert app.registry.get('bt-a')['data_history'][-1]['payload'] == {'t': 1}
+
+
+def test_ndjson_body_is_read_line_by_line(client):
+    lines = [json.dumps({'device_id': 'bt-nd', 'payload': {'seq': i}}) for i in range(5)]
+    lines.insert(2, '{not json')
+    resp = client.post('/edge/data/batch', data='\n'.join(lines) + '\n\n', content_type=NDJSON)
+    body = resp.get_json()
+    assert body['accepted'] == 5
+    assert body['errors'][0]['index'] == 2 and 'invalid JSON' in body['errors'][0]['error']
+    assert [h['payload']['seq'] for h in app.registry.get('bt-nd')['data_history']] == list(range(5))
+
+
+def test_records_past_the_batch_limit_are_rejected(client, monkeypatch):
+    monkeypatch.setattr(app, 'BATCH_MAX_RECORDS', 3)
+    records = '\n'.join(json.dumps({'device_id': 'bt-limit', 'payload': {}}) for _ in range(5))
+    body = client.post('/edge/data/batch', data=records, content_type=NDJSON).get_json()
+    assert body['accepted'] == 3
+    assert 'batch limit' in body['errors'][0]['error']
+
+
+def test_legacy_endpoint_stays_lenient(client):
+    assert client.post('/edge/data', json={'device_id': 'bt-legacy', 'payload': [1, 2], 'timestamp': '12:00'}).status_code == 200
+    history = app.registry.get('bt-legacy')['data_history']
+    assert history[-1]['payload'] == [1, 2]
+    assert client.post('/edge/data', json={'payload': {}}).status_code == 400
@@ -0,0 +1,33 @@
+def test_metadata_selector_skips_devices_with_non_object_metadata(client):
+    client.post('/edge/register', json={'device_id': 'bc-list', 'metadata': ['not', 'an', 'object']})
+    client.post('/edge/register', json={'device_id': 'bc-text', 'metadata': 'plain'})
+    client.post('/edge/register', json={'device_id': 'bc-match', 'metadata': {'site': 'bc', 'labels': {'tier': 'x'}}})
+    for selector in ({'metadata': {'site': 'bc'}}, {'labels': 'tier=x'}):
+        resp = client.post('/command/broadcast', json={'command': 'ping', 'selector': selector, 'coalesce': False})
+        assert resp.status_code == 200
+        assert resp.get_json()['targeted'] == 1
+
+
+def test_broadcast_counters_follow_delivery_and_results(client):
+    devices = ['bc-d1', 'bc-d2', 'bc-d3']
+    for device_id in devices:
+        client.post('/edge/register', json={'device_id': device_id, 'metadata': {'fleet': 'bc-count'}})
+    resp = client.post('/command/broadcast', json={'command': 'update', 'selector': {'metadata': {'fleet': 'bc-count'}}})
+    broadcast = resp.get_json()
+    assert resp.status_code == 200
+    assert (broadcast['targeted'], broadcast['queued'], broadcast['pending']) == (3, 3, 3)
+
+    for device_id in devices[:2]:
+        command = client.get(f'/edge/commands/{device_id}').get_json()['commands'][0]
+        assert command['broadcast_id'] == broadcast['broadcast_id']
+        if device_id == 'bc-d1':
+            client.post('/edge/command/result', json={'command_id': command['command_id'], 'status': 'success'})
+    status = client.get(f"/command/broadcast/{broadcast['broadcast_id']}").get_json()
+    assert (status['delivered'], status['completed'], status['pending']) == (2, 1, 2)
+    assert client.get('/command/broadcast/bc_unknown').status_code == 404
+
+
+def test_selector_types_are_checked(client):
+    for selector in ({'status': 5}, {'device_ids': 'abc'}, {'metadata': ['x']}, 'all', {}):
+        resp = client.post('/command/broadcast', json={'command': 'ping', 'selector': selector})
+        assert resp.status_code == 400
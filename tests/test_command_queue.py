@@ -0,0 +1,54 @@
+import pytest
+
+import app
+
+
+def _command(name):
+    return {'command': name, 'params': {}, 'command_id': app.id_generator.new('cmd_')}
+
+
+def test_lease_orders_by_priority_and_redelivers(registry):
+    now = 1000.0
+    low, high = _command('low'), _command('high')
+    registry.enqueue('dev', low, priority=0, ttl=3600, now=now)
+    registry.enqueue('dev', high, priority=5, ttl=3600, now=now)
+    assert [c['command'] for c in registry.lease('dev', 1, now=now)] == ['high']
+    assert [c['command'] for c in registry.lease('dev', now=now)] == ['low']
+    assert registry.lease('dev', now=now + 1) == []
+    # not acknowledged within the lease: delivered again
+    again = registry.lease('dev', now=now + app.COMMAND_LEASE_SECONDS + 1)
+    assert [(c['command'], c['attempt']) for c in again] == [('high', 2), ('low', 2)]
+    assert registry.complete('dev', high['command_id']) is not None
+    assert registry.complete('dev', high['command_id']) is None
+    assert registry.locate_command(low['command_id']) == 'dev'
+
+
+def test_duplicate_commands_coalesce_until_delivered(registry):
+    now = 1000.0
+    first = registry.enqueue('dev', _command('sync'), ttl=3600, dedup_key='sync', now=now)
+    assert first[1] == 'queued'
+    assert registry.enqueue('dev', _command('sync'), ttl=3600, dedup_key='sync', now=now) == (first[0], 'coalesced')
+    registry.lease('dev', now=now)
+    assert registry.enqueue('dev', _command('sync'), ttl=3600, dedup_key='sync', now=now)[1] == 'queued'
+
+
+def test_expired_commands_are_dropped(registry):
+    registry.enqueue('dev', _command('short'), ttl=10, now=1000.0)
+    assert registry.lease('dev', now=1011.0) == []
+
+
+@pytest.mark.parametrize('options', [{'ttl': 'nan'}, {'ttl': 'inf'}, {'ttl': 0}, {'ttl': -5},
+                                     {'priority': 'nan'}, {'priority': 1e400}, {'priority': 2 ** 70}])
+def test_invalid_ttl_and_priority_are_rejected(client, options):
+    resp = client.post('/command/send', json=dict({'device_id': 'cq-invalid', 'command': 'x'}, **options))
+    assert resp.status_code == 400
+    assert client.get('/edge/commands/cq-invalid').get_json()['commands'] == []
+
+
+def test_poll_limit(client):
+    for name in ('a', 'b'):
+        client.post('/command/send', json={'device_id': 'cq-limit', 'command': name})
+    assert client.get('/edge/commands/cq-limit?limit=-1').status_code == 400
+    assert client.get('/edge/commands/cq-limit?limit=0').status_code == 400
+    assert len(client.get('/edge/commands/cq-limit?limit=1').get_json()['commands']) == 1
+    assert len(client.get('/edge/commands/cq-limit').get_json()['commands']) == 1
@@ -0,0 +1,35 @@
+def _send(client, device_id, command):
+    return client.post('/command/send', json={'device_id': device_id, 'command': command}).get_json()['command_id']
+
+
+def test_command_status_follows_queue_delivery_and_result(client):
+    command_id = _send(client, 'res-dev', 'reboot')
+    assert client.get(f"/command/{command_id}").get_json()['state'] == 'queued'
+    client.get('/edge/commands/res-dev')
+    status = client.get(f"/command/{command_id}").get_json()
+    assert status['state'] == 'delivered' and status['attempts'] == 1
+    resp = client.post('/edge/command/result', json={'command_id': command_id, 'success': True, 'output': 'ok'})
+    assert resp.get_json()['acknowledged'] is True
+    status = client.get(f"/command/{command_id}").get_json()
+    assert status['state'] == 'completed'
+    assert status['device_id'] == 'res-dev' and status['status'] == 'success'
+    assert status['result'] == {'success': True, 'output': 'ok'}
+    # completed commands are not delivered again
+    assert client.get('/edge/commands/res-dev').get_json()['commands'] == []
+
+
+def test_unknown_command_result_is_not_acknowledged(client):
+    resp = client.post('/edge/command/result', json={'command_id': 'no-such-command', 'status': 'failed'})
+    assert resp.status_code == 200 and resp.get_json()['acknowledged'] is False
+    assert client.get('/command/no-such-command').status_code == 404
+    assert client.post('/edge/command/result', json=['not', 'an', 'object']).get_json()['acknowledged'] is False
+
+
+def test_device_commands_lists_pending_and_results(client):
+    done = _send(client, 'res-list', 'sync')
+    client.get('/edge/commands/res-list')
+    client.post('/edge/command/result', json={'device_id': 'res-list', 'command_id': done, 'status': 'partial'})
+    pending = _send(client, 'res-list', 'restart')
+    body = client.get('/device/res-list/commands').get_json()
+    assert [c['command_id'] for c in body['pending']] == [pending]
+    assert [(r['command_id'], r['status']) for r in body['results']] == [(done, 'partial')]
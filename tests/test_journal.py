@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def _open(directory):
+    registry, telemetry = app.DeviceRegistry(), app.TelemetryStore()
+    journal = app.Journal(str(directory), {'registry': registry, 'telemetry': telemetry})
+    journal.start()
+    return registry, telemetry, journal
+
+
+def _command(name):
+    return {'command': name, 'params': {}, 'command_id': app.id_generator.new('cmd_')}
+
+
+def _state(registry, telemetry):
+    return list(registry.snapshot()), list(telemetry.snapshot())
+
+
+def _workload(registry, telemetry, now, devices=20):
+    for i in range(devices):
+        device_id = f"dev-{i}"
+        registry.register(device_id, {'zone': f"z{i % 3}"}, now=now)
+        for n in range(25):
+            payload = {'temperature': 20 + n, 'seq': n}
+            registry.record_data(device_id, payload, now + n, now + n)
+            telemetry.append(device_id, now + n, payload)
+        registry.enqueue(device_id, _command('reboot'), priority=i % 2, ttl=3600, now=now)
+        registry.enqueue(device_id, _command('get_status'), ttl=3600, now=now)
+    for i in range(0, devices, 2):
+        leased = registry.lease(f"dev-{i}", 1, now=now + 30)
+        registry.complete(f"dev-{i}", leased[0]['command_id'])
+    entry = {'command': 'update', 'params': {}, 'broadcast_id': app.id_generator.new('bc_')}
+    registry.broadcast([f"dev-{i}" for i in range(devices)], entry, ttl=3600, now=now + 40)
+    registry.lease('dev-1', now=now + 50)
+    registry.expire_liveness(now + 3600)
+
+
+def _snapshot(journal):
+    journal.flush()
+    journal._rotate()
+    while journal._snapshotting:
+        time.sleep(0.01)
+
+
+def test_recovery_round_trip(tmp_path):
+    registry, telemetry, journal = _open(tmp_path)
+    _workload(registry, telemetry, time.time() - 7200)
+    expected = _state(registry, telemetry)
+    journal.close()
+
+    registry, telemetry, journal = _open(tmp_path)
+    try:
+        assert _state(registry, telemetry) == expected
+        assert journal.recovered['log_records'] > 0
+        assert registry.total_messages() == 20 * app.DATA_HISTORY_LIMIT
+    finally:
+        journal.close()
+
+
+def test_recovery_from_snapshot_and_later_log(tmp_path):
+    registry, telemetry, journal = _open(tmp_path)
+    now = time.time() - 7200
+    _workload(registry, telemetry, now, devices=10)
+    _snapshot(journal)
+    # changes after the snapshot, including devices the snapshot already has
+    registry.record_data('dev-3', {'temperature': 99}, now + 100, now + 100)
+    telemetry.append('dev-3', now + 100, {'temperature': 99})
+    registry.register('late', {}, now=now + 100)
+    registry.enqueue('late', _command('ping'), ttl=3600, now=now + 100)
+    expected = _state(registry, telemetry)
+    journal.close()
+
+    assert [name for name in os.listdir(tmp_path) if name.startswith('snapshot-')]
+    registry, telemetry, journal = _open(tmp_path)
+    try:
+        assert _state(registry, telemetry) == expected
+        assert journal.recovered['snapshot_records'] > 0
+        # the next generation recovers the same state again
+        _snapshot(journal)
+    finally:
+        journal.close()
+    registry, telemetry, journal = _open(tmp_path)
+    try:
+        assert _state(registry, telemetry) == expected
+    finally:
+        journal.close()
+
+
+def test_torn_tail_is_truncated(tmp_path):
+    registry, telemetry, journal = _open(tmp_path)
+    registry.register('dev', {}, now=1000.0)
+    expected = _state(registry, telemetry)
+    journal.close()
+    segment = os.path.join(tmp_path, 'wal-0000000001.log')
+    size = os.path.getsize(segment)
+    with open(segment, 'ab') as f:
+        f.write(app._wal_frame([999, 'registry', 'register', 'torn', {}, 1000.0])[:-3])
+
+    registry, telemetry, journal = _open(tmp_path)
+    try:
+        assert _state(registry, telemetry) == expected
+        assert os.path.getsize(segment) == size
+    finally:
+        journal.close()
+
+
+def test_second_writer_is_refused(tmp_path):
+    registry, telemetry, journal = _open(tmp_path)
+    try:
+        with pytest.raises(RuntimeError):
+            app.Journal(str(tmp_path), {}).start(lock_timeout=0)
+    finally:
+        journal.close()
+
+
+def test_replacement_writer_waits_for_the_old_one(tmp_path):
+    registry, telemetry, journal = _open(tmp_path)
+    registry.register('before-reload', {}, now=1000.0)
+    # the old worker exits (flushing its log) while the new one is starting
+    threading.Timer(0.3, journal.close).start()
+    registry, telemetry, journal = _open(tmp_path)
+    try:
+        assert 'before-reload' in registry
+    finally:
+        journal.close()
@@ -0,0 +1,66 @@
+import time
+
+import app
+
+
+def test_timer_wheel_fires_due_keys_once():
+    wheel = app.TimerWheel(tick=1, slots=8)
+    wheel.advance(100)
+    wheel.schedule('a', 103)
+    wheel.schedule('b', 105)
+    wheel.schedule('far', 130)  # more than one revolution ahead
+    assert wheel.advance(102) == []
+    assert wheel.advance(103) == ['a']
+    assert sorted(wheel.advance(120)) == ['b']
+    assert 'far' in wheel and len(wheel) == 1
+    assert wheel.advance(130) == ['far']
+    assert len(wheel) == 0
+
+
+def test_timer_wheel_replace_and_cancel():
+    wheel = app.TimerWheel(tick=1, slots=8)
+    wheel.advance(100)
+    wheel.schedule('a', 103)
+    wheel.schedule('a', 110, replace=False)
+    wheel.schedule('b', 103)
+    wheel.schedule('b', 106)
+    wheel.schedule('c', 104)
+    wheel.cancel('c')
+    assert wheel.advance(104) == ['a']
+    assert wheel.advance(106) == ['b']
+    # an overdue deadline fires on the next advance
+    wheel.schedule('late', 50)
+    assert wheel.advance(107) == ['late']
+
+
+def test_silent_device_goes_stale_then_offline(registry):
+    now = 1_000_000.0
+    interval = app.DEVICE_HEARTBEAT_INTERVAL
+    registry.register('dev', {}, now=now)
+    registry.register('fast', {'heartbeat_interval': 5}, now=now)
+    stale_at = now + interval * app.DEVICE_STALE_MISSED
+    offline_at = now + interval * app.DEVICE_OFFLINE_MISSED
+
+    transitions = registry.expire_liveness(stale_at - 1)
+    assert [t[:3] for t in transitions] == [('fast', 'online', 'offline')]
+    assert [t[:3] for t in registry.expire_liveness(stale_at + 1)] == [('dev', 'online', 'stale')]
+    assert registry.expire_liveness(stale_at + 2) == []
+    assert [t[:3] for t in registry.expire_liveness(offline_at + 1)] == [('dev', 'stale', 'offline')]
+    assert registry.get('dev')['status'] == 'offline'
+
+    # a check-in brings the device back and restarts its deadlines
+    registry.record_data('dev', {}, offline_at + 10, offline_at + 10)
+    assert registry.get('dev')['status'] == 'online'
+    assert registry.expire_liveness(offline_at + 20) == []
+    assert [t[:3] for t in registry.expire_liveness(offline_at + 10 + interval * app.DEVICE_STALE_MISSED + 1)] == \
+        [('dev', 'online', 'stale')]
+
+
+def test_sweep_marks_device_offline_over_http(client, monkeypatch):
+    monkeypatch.setattr(app, 'registry', app.DeviceRegistry())
+    client.post('/edge/register', json={'device_id': 'live-http', 'metadata': {'heartbeat_interval': 5}})
+    etag = client.get('/devices').headers['ETag']
+    transitions = app.liveness_monitor.sweep(time.time() + 5 * app.DEVICE_OFFLINE_MISSED + 1)
+    assert [t[:3] for t in transitions] == [('live-http', 'online', 'offline')]
+    assert client.get('/device/live-http').get_json()['status'] == 'offline'
+    assert client.get('/devices', headers={'If-None-Match': etag}).status_code == 200
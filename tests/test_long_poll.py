@@ -0,0 +1,31 @@
+import threading
+import time
+
+import app
+
+
+def test_long_poll_returns_when_a_command_is_queued(client):
+    sender = app.app.test_client()
+    timer = threading.Timer(0.2, sender.post, args=('/command/send',),
+                            kwargs={'json': {'device_id': 'lp-wake', 'command': 'reboot'}})
+    started = time.monotonic()
+    timer.start()
+    resp = client.get('/edge/commands/lp-wake?wait=5')
+    elapsed = time.monotonic() - started
+    timer.join()
+    assert [c['command'] for c in resp.get_json()['commands']] == ['reboot']
+    assert 0.15 < elapsed < 2
+
+
+def test_long_poll_times_out_empty(client):
+    started = time.monotonic()
+    resp = client.get('/edge/commands/lp-idle?wait=0.3')
+    assert resp.get_json()['commands'] == []
+    assert time.monotonic() - started >= 0.3
+
+
+def test_queued_command_is_returned_without_waiting(client):
+    client.post('/command/send', json={'device_id': 'lp-ready', 'command': 'sync'})
+    started = time.monotonic()
+    assert len(client.get('/edge/commands/lp-ready?wait=5').get_json()['commands']) == 1
+    assert time.monotonic() - started < 1
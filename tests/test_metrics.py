@@ -0,0 +1,42 @@
+def _samples(client):
+    resp = client.get('/metrics')
+    assert resp.status_code == 200 and resp.mimetype == 'text/plain'
+    samples = {}
+    for line in resp.get_data(as_text=True).splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples, resp.get_data(as_text=True)
+
+
+def test_requests_are_counted_by_route_not_path(client):
+    client.post('/edge/data', json={'device_id': 'met-dev', 'payload': {'t': 1}})
+    client.get('/device/met-dev')
+    client.get('/device/met-missing')
+    samples, text = _samples(client)
+    route = 'route="/device/<device_id>"'
+    assert samples[f'http_requests_total{{{route},method="GET",status="200"}}'] >= 1
+    assert samples[f'http_requests_total{{{route},method="GET",status="404"}}'] >= 1
+    assert 'met-missing' not in text
+    assert samples['edge_ingest_records_total'] >= 1
+    assert samples['edge_devices'] >= 1
+    assert '# TYPE http_request_duration_seconds histogram' in text
+
+
+def test_latency_histogram_is_cumulative(client):
+    client.get('/devices')
+    samples, _ = _samples(client)
+    prefix = 'http_request_duration_seconds_bucket{route="/devices",'
+    buckets = [v for k, v in samples.items() if k.startswith(prefix)]
+    assert buckets == sorted(buckets)
+    count = samples['http_request_duration_seconds_count{route="/devices"}']
+    assert samples[prefix + 'le="+Inf"}'] == count >= 1
+    assert samples['http_request_duration_seconds_sum{route="/devices"}'] > 0
+
+
+def test_queue_depth_gauges(client):
+    client.post('/command/send', json={'device_id': 'met-queue', 'command': 'a'})
+    client.post('/command/send', json={'device_id': 'met-queue', 'command': 'b'})
+    samples, _ = _samples(client)
+    assert samples['command_queue_depth{device_id="met-queue"}'] == 2
+    assert samples['command_queue_depth_total'] >= 2
@@ -0,0 +1,22 @@
+import app
+
+
+def test_data_history_is_capped(registry):
+    registry.register('dev', {'zone': 'a'}, now=1000.0)
+    for n in range(app.DATA_HISTORY_LIMIT + 5):
+        registry.record_data('dev', {'seq': n}, 1000.0 + n, 1000.0 + n)
+    device = registry.get('dev')
+    assert device['status'] == 'online'
+    assert device['metadata'] == {'zone': 'a'}
+    assert [h['payload']['seq'] for h in device['data_history']] == list(range(5, app.DATA_HISTORY_LIMIT + 5))
+    assert registry.total_messages() == app.DATA_HISTORY_LIMIT
+    assert 'dev' in registry and len(registry) == 1
+
+
+def test_numeric_device_ids_are_coerced_to_strings(client):
+    assert client.post('/edge/register', json={'device_id': 6123, 'metadata': {}}).status_code == 201
+    assert client.get('/device/6123').get_json()['device_id'] == '6123'
+    resp = client.post('/command/send', json={'device_id': 6124, 'command': 'reboot'})
+    assert resp.status_code == 200
+    commands = client.get('/edge/commands/6124').get_json()['commands']
+    assert [c['command_id'] for c in commands] == [resp.get_json()['command_id']]
@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def sqlite_app(tmp_path, monkeypatch):
+    """app.py switched to a SQLite state file; returns the path so tests can act as another worker"""
+    path = str(tmp_path / 'state.db')
+    store = app.SQLiteStore(path)
+    monkeypatch.setattr(app, 'STATE_BACKEND', 'sqlite')
+    monkeypatch.setattr(app, 'registry', app.SQLiteDeviceRegistry(store))
+    monkeypatch.setattr(app, 'telemetry', app.SQLiteTelemetryStore(store))
+    monkeypatch.setattr(app, 'state_tracker', app.SQLiteStateTracker(store))
+    return path
+
+
+def test_sqlite_state_is_shared(tmp_path):
+    path = str(tmp_path / 'state.db')
+    writer = app.SQLiteDeviceRegistry(app.SQLiteStore(path))
+    reader = app.SQLiteDeviceRegistry(app.SQLiteStore(path))
+    writer.register('dev', {}, now=1000.0)
+    command = {'command': 'reboot', 'params': {}, 'command_id': app.id_generator.new('cmd_')}
+    writer.enqueue('dev', command, ttl=3600, now=1000.0)
+    assert reader.get('dev')['device_id'] == 'dev'
+    assert [c['command_id'] for c in reader.lease('dev', now=1000.0)] == [command['command_id']]
+
+
+def _events(chunks):
+    for chunk in chunks:
+        text = chunk.decode() if isinstance(chunk, bytes) else chunk
+        for block in text.split('\n\n'):
+            fields = dict(line.split(': ', 1) for line in block.splitlines() if ': ' in line and not line.startswith(':'))
+            if 'event' in fields:
+                yield fields['event'], json.loads(fields['data'])
+
+
+def test_stream_delivers_changes_made_by_other_workers(sqlite_app, client):
+    resp = client.get('/api/stream', buffered=False)
+    events = _events(iter(resp.response))
+    try:
+        assert next(events)[0] == 'snapshot'
+        # another worker: its own handles on the same database, no events published here
+        store = app.SQLiteStore(sqlite_app)
+        app.SQLiteDeviceRegistry(store).record_data('elsewhere', {'t': 1}, 1000.0, 1000.0)
+        app.SQLiteStateTracker(store).bump('elsewhere')
+        event, data = next(events)
+        assert event == 'delta'
+        assert [d['device_id'] for d in data['devices']] == ['elsewhere']
+        assert data['total_messages'] == 1
+    finally:
+        resp.close()
@@ -0,0 +1,27 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def sensor(client):
+    now = time.time() - 600
+    for i in range(100):
+        client.post('/edge/data/batch', json=[{'device_id': 'tm-sensor', 'timestamp': now + i, 'payload': {'temp': i % 7}}])
+    return 'tm-sensor'
+
+
+def test_downsampled_series(client, sensor):
+    body = client.get(f'/api/telemetry/{sensor}?metric=temp&mode=lttb&points=10').get_json()
+    assert body['samples'] == 20  # TELEMETRY_RETENTION
+    assert len(body['points']) == 10
+    body = client.get(f'/api/telemetry/{sensor}?metric=temp&step=5').get_json()
+    assert sum(p['count'] for p in body['points']) == 20 and body['step'] == 5
+    assert client.get(f'/api/telemetry/{sensor}').get_json()['metrics'] == ['temp']
+
+
+@pytest.mark.parametrize('query', ['step=nan', 'step=inf', 'step=0', 'from=nan', 'to=inf', 'from=junk',
+                                   'points=0', 'points=-5', 'points=2', 'mode=lttb&points=0'])
+def test_invalid_window_is_rejected(client, sensor, query):
+    assert client.get(f'/api/telemetry/{sensor}?metric=temp&{query}').status_code == 400
+    assert client.get(f'/api/telemetry/fleet?metric=temp&{query}').status_code == 400
@@ -0,0 +1,24 @@
+import pytest
+
+
+@pytest.mark.parametrize('path', ['/devices', '/api/dashboard-data'])
+def test_etag_revalidation(client, path):
+    client.post('/edge/register', json={'device_id': 'ver-etag'})
+    first = client.get(path)
+    etag = first.headers['ETag']
+    assert first.get_json()['full'] is True
+    assert client.get(path, headers={'If-None-Match': etag}).status_code == 304
+    client.post('/edge/data', json={'device_id': 'ver-etag', 'payload': {'t': 1}})
+    changed = client.get(path, headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
+
+
+@pytest.mark.parametrize('path', ['/devices', '/api/dashboard-data'])
+def test_since_returns_only_changed_devices(client, path):
+    client.post('/edge/register', json={'device_id': 'ver-old'})
+    version = int(client.get(path).headers['X-State-Version'])
+    client.post('/edge/data', json={'device_id': 'ver-new', 'payload': {'t': 1}})
+    delta = client.get(f'{path}?since={version}').get_json()
+    assert delta['full'] is False and delta['since'] == version
+    assert [d['device_id'] for d in delta['devices']] == ['ver-new']
+    assert client.get(f'{path}?since=-1').get_json()['full'] is True
@@ -0,0 +1,76 @@
+import gzip
+import json
+
+import cbor2
+import msgpack
+
+import app
+
+
+def test_msgpack_binary_payload_is_stored_as_base64(client):
+    body = msgpack.packb({'device_id': 'mp-bin', 'payload': {'blob': b'\x00\x01\xff', 'n': 1}}, use_bin_type=True)
+    resp = client.post('/edge/data', data=body, content_type='application/msgpack')
+    assert resp.status_code == 200
+    history = client.get('/device/mp-bin').get_json()['data_history']
+    assert history[-1]['payload'] == {'blob': 'AAH/', 'n': 1}
+    assert client.get('/devices').status_code == 200
+    assert client.get('/api/dashboard-data').status_code == 200
+
+
+def test_cbor_sets_and_integer_keys_become_json(client):
+    body = cbor2.dumps({'device_id': 'cbor-set', 'payload': {'tags': {'a'}, 1: b'\x01', 'ok': True}})
+    assert client.post('/edge/data', data=body, content_type='application/cbor').status_code == 200
+    payload = client.get('/device/cbor-set').get_json()['data_history'][-1]['payload']
+    assert payload == {'tags': ['a'], '1': 'AQ==', 'ok': True}
+
+
+def test_msgpack_extension_types_are_rejected(client):
+    body = msgpack.packb({'device_id': 'mp-ext', 'payload': {'x': msgpack.ExtType(5, b'raw')}})
+    resp = client.post('/edge/data', data=body, content_type='application/msgpack')
+    assert resp.status_code == 400
+    assert 'mp-ext' not in app.registry
+
+
+def test_sqlite_backend_stores_binary_payload(tmp_path, monkeypatch, client):
+    store = app.SQLiteStore(str(tmp_path / 'state.db'))
+    monkeypatch.setattr(app, 'registry', app.SQLiteDeviceRegistry(store))
+    monkeypatch.setattr(app, 'telemetry', app.SQLiteTelemetryStore(store))
+    monkeypatch.setattr(app, 'state_tracker', app.SQLiteStateTracker(store))
+    body = msgpack.packb({'device_id': 'mp-sql', 'payload': {'blob': b'\x01'}}, use_bin_type=True)
+    assert client.post('/edge/data', data=body, content_type='application/msgpack').status_code == 200
+    assert client.get('/device/mp-sql').get_json()['data_history'][-1]['payload'] == {'blob': 'AQ=='}
+
+
+def test_command_poll_negotiates_msgpack_and_gzip(client):
+    for i in range(10):
+        client.post('/command/send', json={'device_id': 'neg-poll', 'command': f"cmd-{i}", 'params': {'pad': 'x' * 64}})
+    resp = client.get('/edge/commands/neg-poll', headers={'Accept': 'application/msgpack', 'Accept-Encoding': 'gzip'})
+    assert resp.mimetype == 'application/msgpack'
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert len(msgpack.unpackb(gzip.decompress(resp.data))['commands']) == 10
+    resp = client.get('/edge/commands/neg-poll')
+    assert resp.mimetype == 'application/json' and 'Content-Encoding' not in resp.headers
+
+
+def test_gzipped_json_body(client):
+    body = gzip.compress(json.dumps({'device_id': 'neg-gzip', 'payload': {'t': 1}}).encode())
+    resp = client.post('/edge/data', data=body, content_type='application/json', headers={'Content-Encoding': 'gzip'})
+    assert resp.status_code == 200
+    assert 'neg-gzip' in app.registry
+    resp = client.post('/edge/data', data=body, content_type='application/json', headers={'Content-Encoding': 'br'})
+    assert resp.status_code == 415
+
+
+def test_decompression_limits(client, monkeypatch):
+    monkeypatch.setattr(app, 'MAX_DECODED_BODY', 1024)
+    monkeypatch.setattr(app, 'NDJSON_MAX_LINE', 256)
+    gzipped = {'Content-Encoding': 'gzip'}
+    bomb = gzip.compress(json.dumps({'device_id': 'neg-bomb', 'payload': {'x': 'y' * 4096}}).encode())
+    assert client.post('/edge/data', data=bomb, content_type='application/json', headers=gzipped).status_code == 413
+    long_line = gzip.compress(b'a' * 10000)
+    resp = client.post('/edge/data/batch', data=long_line, content_type='application/x-ndjson', headers=gzipped)
+    assert resp.status_code == 413
+    many = gzip.compress(b''.join(json.dumps({'device_id': 'neg-many', 'payload': {}}).encode() + b'\n'
+                                  for _ in range(100)))
+    resp = client.post('/edge/data/batch', data=many, content_type='application/x-ndjson', headers=gzipped)
+    assert resp.status_code == 413 and 0 < resp.get_json()['accepted'] < 100